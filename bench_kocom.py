@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Kocom Wallpad RS485 Benchmark
+kocom.py 핫패스 성능 측정 (실제 RS485/MQTT 연결 불필요)
+
+ - framing : read_serial 프레이밍 (기존 hex 문자열 상태머신 vs FrameScanner)
+ - parse   : parse() + 헤더 필드 디코딩
+ - devices : thermo_parse / light_parse / fan_parse / ac_parse
+ - process : packet_processor (fake MQTT client)
+ - publish : 상태 publish (프레임당 스레드 생성 vs MqttPublisher 큐), 스레드 수/지연/순서
+
+프레임 스트림은 합성 스트림(기본) 또는 --input 으로 지정한 녹화 파일(버스 캡처, hex 덤프, kocom 로그의 [recv] 줄 등).
+결과는 --save 로 JSON 기준선에 저장하고 --compare 로 기준선과 비교합니다.
+--repeat 개의 새 프로세스에서 반복 측정한 중앙값을 쓰며 (--save/--compare 는 기본 5회), 처리량과 지연은 각 측정 직전에
+잰 기준 루프 속도로 보정해 비교하고, p99 지연은 --p99-tolerance (기본 100%) 로 따로 판정합니다.
+
+Usage:
+    python3 bench_kocom.py [framing] [parse] [devices] [process] [publish] [--frames N] [--seed S]
+                           [--input FILE ...] [--save FILE] [--compare FILE] [--repeat N]
+                           [--tolerance PCT] [--p99-tolerance PCT]
+"""
+
+import argparse
+import configparser
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import kocom
+
+
+MIN_PASS = 0.05    # seconds, shortest timed pass of measure()
+
+
+def make_frame(type_h, seq_h, dest, src, cmd, value):
+    payload = type_h + seq_h + '00' + dest + src + cmd + value
+    return bytes.fromhex(kocom.header_h + payload + kocom.chksum(payload) + kocom.trailer_h)
+
+
+def synthetic_stream(frames, seed, noise=0.05, corrupt=0.02):
+    """Wallpad-like traffic with random noise bytes and corrupted frames mixed in"""
+    rnd = random.Random(seed)
+    templates = [
+        ('30b', 'c', '3600', '0100', '3a', '0' * 16),                  # thermo query
+        ('30d', 'c', '0100', '3600', '3a', '0' * 16),                  # thermo ack
+        ('30b', 'c', '0100', '3601', '00', '1100170000190000'),        # thermo state
+        ('30d', 'c', '3601', '0100', '00', '1100170000190000'),        # wallpad ack
+        ('30b', 'c', '0e00', '5400', '00', 'ff00ff0000000000'),        # light command
+        ('30d', 'd', '5400', '0e00', '00', 'ff00ff0000000000'),        # light ack
+        ('30b', 'c', '0100', '4800', '00', '1101800000000000'),        # fan state
+        ('30b', 'c', '0100', '3900', '00', '1001011800000000'),        # ac state
+    ]
+    out = bytearray()
+    valid = 0
+    for i in range(frames):
+        frame = bytearray(make_frame(*rnd.choice(templates)))
+        if rnd.random() < corrupt:
+            frame[rnd.randrange(4, 18)] ^= 0x5a
+        else:
+            valid += 1
+        out += frame
+        if rnd.random() < noise:
+            out += bytes(rnd.randrange(256) for _ in range(rnd.randrange(1, 8)))
+    return bytes(out), valid
+
+
+def chunked(data, seed, max_chunk=64):
+    rnd = random.Random(seed)
+    pos = 0
+    chunks = []
+    while pos < len(data):
+        n = rnd.randint(1, max_chunk)
+        chunks.append(data[pos:pos+n])
+        pos += n
+    return chunks
+
+
+def recorded_stream(paths):
+    """Concatenated bytes of bus captures ([RS485] capture) or text: hex dump lines (one frame per line or raw hex streams) and the [recv] lines of a kocom log"""
+    out = bytearray()
+    for path in paths:
+        with open(path, 'rb') as f:
+            is_capture = f.read(len(kocom.CAPTURE_MAGIC)) == kocom.CAPTURE_MAGIC
+        if is_capture:
+            for _, data in kocom.read_capture([path]):
+                if isinstance(data, bytes):     # not a session record
+                    out += data
+            continue
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                out += kocom.hex_line_bytes(line)
+    return bytes(out)
+
+
+def load_stream(args):
+    if args.input:
+        data = recorded_stream(args.input)
+        return data, 'recorded {}'.format(', '.join(args.input))
+    data, valid = synthetic_stream(args.frames, args.seed)
+    return data, 'synthetic, {} valid frames'.format(valid)
+
+
+def legacy_framing(chunks):
+    """hex string state machine formerly used by read_serial(), kept as the reference"""
+    header_h, trailer_h = kocom.header_h, kocom.trailer_h
+    packet_size, chksum_position = kocom.packet_size, kocom.chksum_position
+    out = []
+    buf = ''
+    not_parsed_buf = ''
+    for chunk in chunks:
+        for b in chunk:
+            hex_d = '{0:02x}'.format(b)
+            buf += hex_d
+            if buf[:len(header_h)] != header_h[:len(buf)]:
+                not_parsed_buf += buf
+                buf = ''
+                frame_start = not_parsed_buf.find(header_h, len(header_h))
+                if frame_start < 0:
+                    continue
+                else:
+                    not_parsed_buf = not_parsed_buf[:frame_start]
+                    buf = not_parsed_buf[frame_start:]
+            if not_parsed_buf != '':
+                logging.info('[comm] not parsed ' + not_parsed_buf)
+                not_parsed_buf = ''
+            if len(buf) == (packet_size * 2):
+                chksum_calc = kocom.chksum(buf[len(header_h):chksum_position*2])
+                chksum_buf = buf[chksum_position*2:chksum_position*2+2]
+                if chksum_calc == chksum_buf and buf[-len(trailer_h):] == trailer_h:
+                    out.append(buf)
+                    buf = ''
+                else:
+                    logging.info("[comm] invalid packet {} expected checksum {}".format(buf, chksum_calc))
+                    frame_start = buf.find(header_h, len(header_h))
+                    if frame_start < 0:
+                        not_parsed_buf += buf
+                        buf = ''
+                    else:
+                        not_parsed_buf += buf[:frame_start]
+                        buf = buf[frame_start:]
+    return out
+
+
+def scanner_framing(chunks):
+    scanner = kocom.FrameScanner()
+    out = []
+    for chunk in chunks:
+        out.extend(scanner.feed(memoryview(chunk)))
+    return out
+
+
+def reference_speed():
+    """Passes per second of a fixed pure Python loop, the fastest of a few.
+
+    Shared or throttled CPUs can run twice as fast or slow from one minute to
+    the next. Each timed pass is paired with this loop run right before it, and
+    --compare scales throughput and latency by it to compare at the baseline's
+    machine speed.
+    """
+    best = None
+    for _ in range(5):
+        t = time.perf_counter()
+        acc = 0
+        for i in range(5000):
+            acc += int('{:02x}'.format(i & 0xff), 16)
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return 1 / best
+
+
+def timed(fn, *args, repeat=3):
+    """Best of `repeat` passes: (seconds, fn's result, reference speed next to that pass)"""
+    best = None
+    for _ in range(repeat):
+        speed = reference_speed()
+        t = time.perf_counter()
+        ret = fn(*args)
+        elapsed = time.perf_counter() - t
+        if best is None or elapsed < best[0]:
+            best = (elapsed, speed)
+    return best[0], ret, best[1]
+
+
+def measure(fn, items, repeat=5):
+    """Throughput, per-item latency and retained allocations of fn over items.
+
+    fps is the best of `repeat` passes over items, each repeated to last at
+    least MIN_PASS seconds. p99 is the best of three passes timing
+    every call, at the reference speed of the fps pass. alloc is the memory
+    still held per item by fn's results, traced with tracemalloc while all of
+    them are kept alive.
+    """
+    def run():
+        for _ in range(rounds):
+            for item in items:
+                fn(item)
+    rounds = 1
+    once, _, _ = timed(run, repeat=1)
+    rounds = max(1, math.ceil(MIN_PASS / once))     # a pass of a few ms is mostly noise
+    elapsed, _, speed = timed(run, repeat=repeat)
+
+    def run_latencies():
+        latencies = []
+        clock = time.perf_counter_ns
+        for item in items:
+            t = clock()
+            fn(item)
+            latencies.append(clock() - t)
+        return percentile(latencies, 99)
+    p99 = None
+    for _ in range(3):
+        pass_speed = reference_speed()
+        ns = run_latencies() * pass_speed / speed
+        p99 = ns if p99 is None else min(p99, ns)
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    kept = [fn(item) for item in items]
+    alloc = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del kept
+    return {'fps': len(items) * rounds / elapsed, 'p99_us': p99 / 1000, 'alloc_bytes': alloc / max(len(items), 1), 'speed': speed}
+
+
+def report(results, name, result):
+    results[name] = result
+    print('  {:<22} {:>11.0f} items/s  p99 {:>8.2f} us  {:>7.0f} B/item retained'.format(name, result['fps'], result['p99_us'], result['alloc_bytes']))
+
+
+def stream_frames(args):
+    data, _ = load_stream(args)
+    return scanner_framing(chunked(data, args.seed))
+
+
+def bench_framing(args, results):
+    data, desc = load_stream(args)
+    chunks = chunked(data, args.seed)
+    print('[framing] {} bytes, {} chunks ({})'.format(len(data), len(chunks), desc))
+    for name, fn in (('legacy hex', legacy_framing), ('FrameScanner', scanner_framing)):
+        elapsed, frames, speed = timed(fn, chunks)
+        print('  {:<14} {:>8.3f}s  {:>10.0f} frames/s  {:>8.2f} MB/s  frames={}'.format(
+            name, elapsed, len(frames) / elapsed, len(data) / elapsed / 1e6, len(frames)))
+        results['framing.' + name.split()[0].lower()] = {'fps': len(frames) / elapsed, 'speed': speed}
+
+
+def decode_fields(frame):
+    p = kocom.parse(frame)
+    p.type, p.src, p.dest, p.cmd, p.value, p.src_subid, p.data_h
+    return p
+
+
+def bench_parse(args, results):
+    frames = stream_frames(args)
+    print('[parse] {} frames'.format(len(frames)))
+    report(results, 'parse', measure(kocom.parse, frames))
+    report(results, 'parse+fields', measure(decode_fields, frames))
+
+
+def bench_devices(args, results):
+    packets = [kocom.parse(frame) for frame in stream_frames(args)]
+    print('[devices] state values from {} frames'.format(len(packets)))
+    parsers = {'thermo': kocom.thermo_parse, 'light': kocom.light_parse, 'fan': kocom.fan_parse, 'ac': kocom.ac_parse}
+    for dev, fn in parsers.items():
+        values = [p.value for p in packets if p.cmd == 'state' and dev in (p.src, p.dest)]
+        if not values:
+            print('  {:<22} no {} state frames in the stream'.format(dev + '_parse', dev))
+            continue
+        report(results, dev + '_parse', measure(fn, values))
+
+
+def bench_process(args, results):
+    packets = [kocom.parse(frame) for frame in stream_frames(args)]
+    kocom.mqttc = FakeMqtt(0)
+    kocom.publisher = kocom.MqttPublisher(refresh_interval=0)
+    print('[process] packet_processor over {} frames, fake MQTT (unchanged states are suppressed)'.format(len(packets)))
+    report(results, 'packet_processor', measure(kocom.packet_processor, packets))
+
+
+class FakeMqtt:
+    """paho Client stand-in: publish() holds a lock for a fixed time like a socket write"""
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.messages = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self.lock:
+            time.sleep(self.delay)
+            self.messages.append((topic, payload))
+
+
+def fake_config():
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'Log': {'show_query_hex': 'False', 'show_recv_hex': 'False', 'show_mqtt_publish': 'False', 'show_mqtt_discovery': 'False'},
+        'User': {'init_temp': '23', 'init_fan_mode': 'Medium', 'light_count': '3', 'thermo_init_temp': '23'},
+        'Elevator': {'type': 'rs485', 'rs485_floor': '0'},
+        'Device': {'enabled': 'fan, light_livingroom, thermo_livingroom, thermo_room1, thermo_room2, thermo_room3'},
+    })
+    return config
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def bench_publish(args, results):
+    """50 frames/s of thermostat state responses through packet_processor"""
+    n = int(args.rate * args.duration)
+    frames = []
+    for i in range(n):
+        room = i % 4
+        value = '1100{:02x}00{:02x}000000'.format(20 + room, (i // 4) % 256)  # cur_temp counts up per room
+        frames.append(kocom.parse(make_frame('30b', 'c', '0100', '36{:02x}'.format(room), '00', value)))
+
+    print('[publish] {} frames at {:.0f} frames/s, broker publish {:.1f} ms'.format(n, args.rate, args.delay * 1000))
+    for name in ('thread per frame', 'MqttPublisher'):
+        kocom.mqttc = FakeMqtt(args.delay)
+        latencies = []
+        peak_threads = [threading.active_count()]
+        done = threading.Event()
+
+        def process(p, t0):
+            kocom.packet_processor(p)
+            latencies.append(time.perf_counter() - t0)
+            peak_threads.append(threading.active_count())
+            if len(latencies) == n:
+                done.set()
+
+        kocom.publisher = kocom.MqttPublisher(refresh_interval=0)
+        if name == 'MqttPublisher':
+            kocom.publisher.thread.daemon = True
+            kocom.publisher.start()
+            submit = lambda p, t0: kocom.publisher.submit(process, p, t0)
+        else:
+            submit = lambda p, t0: threading.Thread(target=process, args=(p, t0)).start()
+
+        base_threads = threading.active_count()
+        start = time.perf_counter()
+        for i, p in enumerate(frames):
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            submit(p, time.perf_counter())
+            peak_threads.append(threading.active_count())
+        done.wait(30)
+
+        out_of_order = 0
+        last = {}
+        for topic, payload in kocom.mqttc.messages:
+            cur = kocom.json.loads(payload)['cur_temp']
+            if cur < last.get(topic, -1):
+                out_of_order += 1
+            last[topic] = cur
+        print('  {:<17} peak threads {:>3} (+{:<3})  latency p50 {:>6.2f} ms  p99 {:>6.2f} ms  out of order {}'.format(
+            name, max(peak_threads), max(peak_threads) - base_threads,
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, out_of_order))
+        results['publish.' + name.split()[0].lower()] = {'p99_us': percentile(latencies, 99) * 1e6, 'threads': max(peak_threads) - base_threads,
+                                                         'out_of_order': out_of_order}
+
+
+def median_results(runs):
+    """Median of repeated runs, so one noisy run does not decide a comparison.
+    A result with a reference speed is taken whole from the run with the median
+    speed-scaled throughput, the others metric by metric."""
+    results = {}
+    for name in runs[0]:
+        if 'speed' in runs[0][name]:
+            results[name] = sorted((run[name] for run in runs), key=lambda r: r['fps'] / r['speed'])[len(runs) // 2]
+        else:
+            results[name] = {metric: sorted(run[name][metric] for run in runs)[len(runs) // 2] for metric in runs[0][name]}
+    return results
+
+
+def repeated_runs(args):
+    """Run the benchmarks args.repeat times, each in a new interpreter: hash seeds
+    and memory layout differ per process and move the results as much as the
+    passes inside one process do"""
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'results.json')
+        cmd = [sys.executable, os.path.abspath(__file__)] + args.bench + [
+            '--frames', str(args.frames), '--seed', str(args.seed), '--rate', str(args.rate),
+            '--duration', str(args.duration), '--delay', str(args.delay), '--repeat', '1', '--results', path]
+        if args.input:
+            cmd += ['--input'] + args.input
+        for i in range(args.repeat):
+            print('[run {}/{}]'.format(i + 1, args.repeat), flush=True)
+            if subprocess.run(cmd).returncode != 0:
+                sys.exit('benchmark run {} failed'.format(i + 1))
+            with open(path, 'r', encoding='utf-8') as f:
+                runs.append(json.load(f))
+    return runs
+
+
+def compare(results, path, tolerance, p99_tolerance):
+    """Print changes against a saved baseline, return the number of regressions"""
+    with open(path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    print('[compare] against {} (tolerance {:.0f}%, p99 {:.0f}%, fps and p99 scaled to the baseline machine speed)'.format(path, tolerance, p99_tolerance))
+    worse_if_lower = {'fps'}
+    counts = {'threads': 1, 'out_of_order': 0}      # compared by how many more, with this much slack
+    regressions = 0
+    for name, result in results.items():
+        for metric, value in sorted(result.items()):
+            old = baseline.get(name, {}).get(metric)
+            if old is None or metric == 'speed':
+                continue
+            note = ''
+            if metric in counts:
+                change = value - old
+                regressed = change > counts[metric]
+                print('  {:<22} {:<12} {:>12.0f} -> {:>12.0f}  {:>+7.0f} {}'.format(name, metric, old, value, change, '  REGRESSION' if regressed else ''))
+                regressions += regressed
+                continue
+            if not old:
+                continue
+            if 'speed' in result and baseline[name].get('speed'):
+                scale = baseline[name]['speed'] / result['speed']
+                value = value * scale if metric == 'fps' else value / scale if metric == 'p99_us' else value
+            change = (value - old) / old * 100
+            if metric == 'p99_us' and 'speed' not in result:
+                # wall clock latency of a paced load is mostly sleeps and scheduling, shown but not judged
+                regressed, note = False, '  (not judged)'
+            else:
+                # a single slow call moves a p99, so it gets a wider band than throughput
+                limit = p99_tolerance if metric == 'p99_us' else tolerance
+                regressed = -change > limit if metric in worse_if_lower else change > limit
+            regressions += regressed
+            print('  {:<22} {:<12} {:>12.1f} -> {:>12.1f}  {:>+7.1f}%{}'.format(name, metric, old, value, change, '  REGRESSION' if regressed else note))
+    return regressions
+
+
+def main():
+    benchmarks = {'framing': bench_framing, 'parse': bench_parse, 'devices': bench_devices, 'process': bench_process, 'publish': bench_publish}
+    parser = argparse.ArgumentParser(description='kocom.py hot path benchmark')
+    parser.add_argument('bench', nargs='*', help='benchmarks to run: {} (default: all)'.format(', '.join(benchmarks)))
+    parser.add_argument('--frames', type=int, default=20000, help='frames in the synthetic stream')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--input', nargs='+', metavar='FILE', help='bus capture or recorded hex frame files instead of the synthetic stream')
+    parser.add_argument('--rate', type=float, default=50, help='publish load in frames/s')
+    parser.add_argument('--duration', type=float, default=5, help='publish load duration in seconds')
+    parser.add_argument('--delay', type=float, default=0.002, help='simulated broker publish time in seconds')
+    parser.add_argument('--save', metavar='FILE', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare against a JSON baseline, exit 1 on regressions')
+    parser.add_argument('--repeat', type=int, default=None, help='run the benchmarks in this many fresh processes and keep the median (default: 5 with --save/--compare, else 1)')
+    parser.add_argument('--tolerance', type=float, default=20, help='allowed change in %% before --compare reports a regression')
+    parser.add_argument('--p99-tolerance', type=float, default=100, help='allowed change in %% of the per-item p99 latencies')
+    parser.add_argument('--results', metavar='FILE', help=argparse.SUPPRESS)   # a --repeat run's results, for the parent process
+    args = parser.parse_args()
+    for name in args.bench:
+        if name not in benchmarks:
+            parser.error('unknown benchmark: ' + name)
+    if args.repeat is None:
+        args.repeat = 5 if args.save or args.compare else 1
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.disable(logging.WARNING)    # [BATCH_DEBUG] warnings for 5400/309c frames would dominate the timings
+    kocom.load_json_config()
+    kocom.config = fake_config()
+    kocom.settings = kocom.build_settings(kocom.config)
+    if args.repeat > 1:
+        results = median_results(repeated_runs(args))
+    else:
+        results = {}
+        for name in args.bench or benchmarks:
+            benchmarks[name](args, results)
+    if args.results:
+        with open(args.results, 'w', encoding='utf-8') as f:
+            json.dump(results, f)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'frames': args.frames,
+                       'input': args.input, 'repeat': args.repeat, 'results': results}, f, indent=2)
+        print('[save] baseline written to ' + args.save)
+    if args.compare and compare(results, args.compare, args.tolerance, args.p99_tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
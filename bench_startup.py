@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Kocom Startup Benchmark
+kocom.py 기동 시간 측정 : 프로세스 시작부터 MQTT 접속, discovery, 첫 상태 publish 까지
+
+ - kocom_simulator.py (EW11 대용 RS485 버스) 와 이 스크립트 안의 최소 MQTT 브로커를 띄우고
+   임시 디렉토리의 kocom.conf 로 kocom.py 를 실행 (실제 장비/브로커 불필요)
+ - cold : 상태 스냅샷 없이 시작, 첫 상태는 버스 폴링 결과
+ - warm : 직전 실행이 남긴 상태 스냅샷([Device] state_snapshot)으로 재시작 (애드온 업데이트 후 재시작과 같은 경우)
+ - --rs485-delay : 시뮬레이터를 늦게 띄워 EW11 이 늦게 붙는 경우를 재현
+
+Usage:
+    python3 bench_startup.py [--runs 3] [--engine thread|asyncio] [--rs485-delay 0] [--timeout 30] [--json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CONFIG = """[RS485]
+type = socket
+socket_server = 127.0.0.1
+socket_port = {rs485_port}
+[Engine]
+type = {engine}
+[MQTT]
+mqtt_server = 127.0.0.1
+mqtt_port = {mqtt_port}
+mqtt_allow_anonymous = True
+[Device]
+enabled = light_livingroom, thermo_livingroom
+light_controller = 0100
+state_snapshot = {snapshot}
+state_snapshot_interval = 0.2
+[Elevator]
+type = rs485
+rs485_floor = 15
+[Log]
+show_query_hex = False
+show_recv_hex = False
+show_mqtt_publish = False
+show_mqtt_discovery = False
+[User]
+init_temp = 23
+init_fan_mode = Medium
+light_count = 3
+thermo_init_temp = 23
+ac_init_temp = 21
+ac_init_mode = cool
+fan_init_fan_mode = low
+ac_init_fan_mode = LOW
+"""
+
+
+class Broker:
+    """Just enough of an MQTT 3.1.1 broker to timestamp what kocom.py sends.
+    Keeps the last payload per topic and forwards publish() to every client that subscribed."""
+    def __init__(self):
+        self.port = free_port()
+        self.events = {}
+        self.topics = {}            # topic -> last payload received
+        self.subscribers = set()
+        self.cond = threading.Condition()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='broker', daemon=True).start()
+        asyncio.run_coroutine_threadsafe(asyncio.start_server(self.handle, '127.0.0.1', self.port), self.loop).result()
+
+    def reset(self):
+        with self.cond:
+            self.events = {}
+            self.topics = {}
+
+    def mark(self, name):
+        with self.cond:
+            self.events.setdefault(name, time.time())
+            self.cond.notify_all()
+
+    def wait(self, name, timeout):
+        end = time.time() + timeout
+        with self.cond:
+            while name not in self.events and time.time() < end:
+                self.cond.wait(end - time.time())
+            return self.events.get(name)
+
+    def wait_topic(self, topic, check, timeout):
+        """The topic's last payload once check(payload) is true, None on timeout"""
+        end = time.time() + timeout
+        with self.cond:
+            while not (topic in self.topics and check(self.topics[topic])) and time.time() < end:
+                self.cond.wait(end - time.time())
+            payload = self.topics.get(topic)
+            return payload if payload is not None and check(payload) else None
+
+    def publish(self, topic, payload):
+        """QoS 0 PUBLISH to the subscribed clients, as if Home Assistant sent it"""
+        body = len(topic).to_bytes(2, 'big') + topic.encode() + payload.encode()
+        packet = b'\x30' + remaining_length(len(body)) + body
+        def send():
+            for writer in self.subscribers:
+                writer.write(packet)
+        self.loop.call_soon_threadsafe(send)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                kind, flags, body = await read_packet(reader)
+                if kind == 1:           # CONNECT
+                    self.mark('connect')
+                    writer.write(b'\x20\x02\x00\x00')
+                elif kind == 3:         # PUBLISH
+                    n = int.from_bytes(body[:2], 'big')
+                    topic = body[2:2 + n].decode()
+                    if flags & 0x06:
+                        writer.write(b'\x40\x02' + body[2 + n:4 + n])
+                    with self.cond:
+                        self.topics[topic] = body[2 + n + (2 if flags & 0x06 else 0):].decode(errors='replace')
+                        self.cond.notify_all()
+                    if topic.startswith('homeassistant/'):
+                        self.mark('discovery')
+                    elif topic.endswith('/state'):
+                        self.mark('state')
+                elif kind == 8:         # SUBSCRIBE
+                    self.subscribers.add(writer)
+                    self.mark('subscribe')
+                    writer.write(bytes([0x90, 3]) + body[:2] + b'\x00')
+                elif kind == 12:        # PINGREQ
+                    writer.write(b'\xd0\x00')
+                elif kind == 14:        # DISCONNECT
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        self.subscribers.discard(writer)
+        writer.close()
+
+
+async def read_packet(reader):
+    head = (await reader.readexactly(1))[0]
+    size, mult = 0, 1
+    while True:
+        b = (await reader.readexactly(1))[0]
+        size += (b & 0x7f) * mult
+        mult *= 128
+        if not b & 0x80:
+            break
+    return head >> 4, head & 0x0f, await reader.readexactly(size)
+
+
+def remaining_length(n):
+    out = bytearray()
+    while True:
+        n, b = n // 128, n % 128
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_simulator(port):
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, 'kocom_simulator.py'), '--port', str(port), '--seed', '1'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    end = time.time() + 10
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    sys.exit('simulator did not start')
+
+
+def stop(proc):
+    if proc is not None and proc.poll() is None:
+        proc.kill()
+        proc.wait()
+
+
+def run_once(args, broker, workdir, rs485_port):
+    """Start kocom.py, return seconds from launch to each broker event (None if it never came)"""
+    broker.reset()
+    sim = None if args.rs485_delay > 0 else start_simulator(rs485_port)
+    started = time.time()
+    kocom = subprocess.Popen([sys.executable, os.path.join(HERE, 'kocom.py')], cwd=workdir,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if args.rs485_delay > 0:
+            time.sleep(args.rs485_delay)
+            sim = start_simulator(rs485_port)
+        broker.wait('state', args.timeout)
+        time.sleep(0.5)     # let the snapshot writer save the polled states for the warm run
+    finally:
+        stop(kocom)
+        stop(sim)
+    return {name: None if name not in broker.events else broker.events[name] - started
+            for name in ('connect', 'discovery', 'subscribe', 'state')}
+
+
+def median(values):
+    values = sorted(v for v in values if v is not None)
+    return values[len(values) // 2] if values else None
+
+
+def fmt(seconds):
+    return '   timeout' if seconds is None else '{:8.0f}ms'.format(seconds * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Kocom startup benchmark')
+    parser.add_argument('--runs', type=int, default=3, help='cold and warm starts to run, the median is reported')
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread', help='[Engine] type')
+    parser.add_argument('--rs485-delay', type=float, default=0, help='start the simulator this many seconds after kocom.py')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for the first state publish')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    broker = Broker()
+    results = {'cold': [], 'warm': []}
+    with tempfile.TemporaryDirectory() as workdir:
+        rs485_port = free_port()
+        snapshot = os.path.join(workdir, 'state.json')
+        with open(os.path.join(workdir, 'kocom.conf'), 'w') as f:
+            f.write(CONFIG.format(rs485_port=rs485_port, mqtt_port=broker.port, engine=args.engine, snapshot=snapshot))
+        for _ in range(args.runs):
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+            results['cold'].append(run_once(args, broker, workdir, rs485_port))
+            results['warm'].append(run_once(args, broker, workdir, rs485_port))
+
+    summary = {mode: {name: median(r[name] for r in runs) for name in ('connect', 'discovery', 'subscribe', 'state')}
+               for mode, runs in results.items()}
+    if args.json:
+        print(json.dumps({'engine': args.engine, 'rs485_delay': args.rs485_delay, 'runs': results, 'median': summary}, indent=2))
+        return
+    print('[startup] engine {}, rs485 delay {:g}s, median of {} runs (from process start)'.format(args.engine, args.rs485_delay, args.runs))
+    print('  {:<6} {:>10} {:>10} {:>10} {:>12}'.format('', 'connect', 'discovery', 'subscribe', 'first state'))
+    for mode, s in summary.items():
+        print('  {:<6} {} {} {} {}  '.format(mode, fmt(s['connect']), fmt(s['discovery']), fmt(s['subscribe']), fmt(s['state'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -21,8 +21,16 @@ import json
 import socket
 import serial
 import logging
+import math
 import configparser
-from typing import Optional, Dict, Any, Union
+import asyncio
+import concurrent.futures
+import signal
+import collections
+import http.server
+import re
+import struct
+from typing import Optional, Dict, Any, Union, NamedTuple, Tuple
 from pathlib import Path
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import MQTTMessage, Client
@@ -34,6 +42,14 @@ CONFIG_FILE = 'kocom.conf'
 PACKETS_FILE = 'packets.json'
 PROTOCOL_FILE = 'protocol.json'
 BUF_SIZE = 100
+READ_CHUNK_SIZE = 4096
+PUBLISH_QUEUE_SIZE = 256
+STATE_REFRESH_INTERVAL = 600
+LIGHT_MERGE_WINDOW = 0.1
+COMMAND_WORKERS = 4
+MQTT_CONNECT_TIMEOUT = 10   # seconds to wait for the CONNACK before publishing anyway
+FIRST_WRITE_WAIT = 1        # seconds to listen to a freshly connected bus before the first write
+STATE_DEVICES = ('light', 'thermo', 'ac', 'fan')   # devices whose state frames carry their full state
 
 # Global configuration dictionaries (loaded from JSON)
 protocol_config = {}
@@ -58,6 +74,26 @@ packet_size = 21
 chksum_position = 18
 BATCH_OFF_PACKET = ''
 
+# asyncio engine, None when running the threaded engine
+engine = None
+# MQTT client, None until connected (the asyncio engine reads RS485 before MQTT is up)
+mqttc = None
+# runtime objects read by the metrics endpoint, created in main
+frame_scanner = None
+msg_q = None
+tracer = None       # LatencyTracer when [Log] trace_latency = True
+bus_capture = None  # BusCapture when [RS485] capture is set
+bus_arbiter = None
+state_snapshot = None   # StateSnapshot when [Device] state_snapshot is set
+enabled_cache = (None, set())   # (settings, enabled_addresses() of those settings)
+publisher = None
+light_batcher = None
+command_executor = None
+poll_scheduler = None
+# startup readiness : CONNACK received, RS485 connected
+mqtt_ready = threading.Event()
+bus_ready = threading.Event()
+
 
 def load_json_config():
     """Load packet and protocol configuration from JSON files"""
@@ -114,10 +150,163 @@ def load_json_config():
     device_h_dic = {v: k for k, v in device_t_dic.items()}
     cmd_h_dic = {v: k for k, v in cmd_t_dic.items()}
 
+
+def load_config():
+    """Read kocom.conf, or translate the Home Assistant addon options into the same layout"""
+    # Try to read Home Assistant addon options first
+    ha_options = None
+    try:
+        with open('/data/options.json', 'r') as f:
+            ha_options = json.load(f)
+            logging.info('[CONFIG] Using Home Assistant addon options')
+    except:
+        logging.info('[CONFIG] No HA addon options found, using kocom.conf')
+    
+    config = configparser.ConfigParser()
+    
+    if ha_options:
+        # Convert HA options to config format
+        config.add_section('RS485')
+        config.set('RS485', 'type', ha_options.get('rs485_type', 'serial'))
+        if ha_options.get('rs485_type') == 'socket':
+            config.set('RS485', 'socket_server', ha_options.get('socket_server', ''))
+            config.set('RS485', 'socket_port', str(ha_options.get('socket_port', 8899)))
+        else:
+            config.set('RS485', 'serial_port', ha_options.get('serial_port', '/dev/ttyUSB0'))
+        
+        config.add_section('MQTT')
+        config.set('MQTT', 'mqtt_server', ha_options.get('mqtt_server', 'core-mosquitto'))
+        config.set('MQTT', 'mqtt_port', str(ha_options.get('mqtt_port', 1883)))
+        config.set('MQTT', 'mqtt_allow_anonymous', str(ha_options.get('mqtt_allow_anonymous', True)))
+        config.set('MQTT', 'mqtt_username', ha_options.get('mqtt_username', ''))
+        config.set('MQTT', 'mqtt_password', ha_options.get('mqtt_password', ''))
+        
+        config.add_section('Log')
+        config.set('Log', 'show_query_hex', str(ha_options.get('debug_mode', False)))
+        config.set('Log', 'show_recv_hex', str(ha_options.get('debug_mode', False)))
+        config.set('Log', 'show_mqtt_publish', str(ha_options.get('debug_mode', False)))
+        config.set('Log', 'show_mqtt_discovery', str(ha_options.get('debug_mode', False)))
+        
+        # Set default sections if not present
+        if not config.has_section('Device'):
+            config.add_section('Device')
+            config.set('Device', 'enabled', 'fan, elevator, light_livingroom, light_room1, light_room2, light_room3, light_kitchen, thermo_livingroom, thermo_room1, thermo_room2, thermo_room3')
+        
+        if not config.has_section('Elevator'):
+            config.add_section('Elevator')
+            config.set('Elevator', 'type', 'rs485')
+            config.set('Elevator', 'rs485_floor', str(ha_options.get('elevator_floor', 15)))
+        
+        if not config.has_section('User'):
+            config.add_section('User')
+            config.set('User', 'init_temp', str(ha_options.get('init_temp', 23)))
+            config.set('User', 'init_fan_mode', 'Medium')
+            config.set('User', 'light_count', '3')
+            config.set('User', 'thermo_init_temp', '23')
+            config.set('User', 'ac_init_temp', '21')
+            config.set('User', 'ac_init_mode', 'cool')
+            config.set('User', 'fan_init_fan_mode', 'low')
+            config.set('User', 'ac_init_fan_mode', 'LOW')
+        
+        logging.info('[CONFIG] RS485 type: {}'.format(config.get('RS485', 'type')))
+        if config.get('RS485', 'type') == 'socket':
+            logging.info('[CONFIG] Socket server: {}:{}'.format(
+                config.get('RS485', 'socket_server'),
+                config.get('RS485', 'socket_port')
+            ))
+    else:
+        # Fallback to reading kocom.conf file
+        config.read(CONFIG_FILE)
+
+    return config
+
+
+class Settings(NamedTuple):
+    """Runtime settings resolved once from the config. Hot paths read these attributes
+    instead of calling config.get(); a reload swaps the whole object."""
+    show_query_hex: bool
+    show_recv_hex: bool
+    show_mqtt_publish: bool
+    show_mqtt_discovery: bool
+    trace_latency: bool     # read at startup only, the tracer is not started or stopped by a reload
+    enabled_devices: Tuple[str, ...]
+    light_controller_addr: str
+    init_temp: int
+    thermo_init_temp: int
+    light_count: int
+    init_fan_mode: str
+    ac_init_mode: str
+    ac_init_fan_mode: str
+    elevator_type: str
+    elevator_rs485_floor: Optional[int]     # None when the wallpad doesn't report elevator floors
+    publish_queue_size: int
+    publish_overflow: str
+    state_refresh_interval: int
+    light_merge_window: float
+    passive_state: bool
+
+
+def build_settings(config):
+    def flag(section, option):
+        return config.get(section, option, fallback='False') == 'True'
+
+    # light controller address (for apartments with non-standard controller)
+    light_controller_addr = config.get('Device', 'light_controller', fallback=None)
+    if light_controller_addr:
+        logging.info('[CONFIG] Using custom light controller address: {}'.format(light_controller_addr))
+    else:
+        light_controller_addr = device_h_dic['wallpad'] + '00'  # default: 0100
+        logging.info('[CONFIG] Using default light controller address: {}'.format(light_controller_addr))
+
+    rs485_floor = config.get('Elevator', 'rs485_floor', fallback=None)
+    return Settings(
+        show_query_hex=flag('Log', 'show_query_hex'),
+        show_recv_hex=flag('Log', 'show_recv_hex'),
+        show_mqtt_publish=flag('Log', 'show_mqtt_publish'),
+        show_mqtt_discovery=flag('Log', 'show_mqtt_discovery'),
+        trace_latency=flag('Log', 'trace_latency'),
+        enabled_devices=tuple(x.strip() for x in config.get('Device', 'enabled', fallback='').split(',') if x.strip()),
+        light_controller_addr=light_controller_addr,
+        init_temp=int(config.get('User', 'init_temp', fallback=23)),
+        thermo_init_temp=int(config.get('User', 'thermo_init_temp', fallback=23)),
+        light_count=int(config.get('User', 'light_count', fallback=3)),
+        init_fan_mode=config.get('User', 'init_fan_mode', fallback='Medium'),
+        ac_init_mode=config.get('User', 'ac_init_mode', fallback='cool'),
+        ac_init_fan_mode=config.get('User', 'ac_init_fan_mode', fallback='LOW'),
+        elevator_type=config.get('Elevator', 'type', fallback='rs485'),
+        elevator_rs485_floor=int(rs485_floor) if rs485_floor != None else None,
+        publish_queue_size=int(config.get('MQTT', 'publish_queue_size', fallback=PUBLISH_QUEUE_SIZE)),
+        publish_overflow=config.get('MQTT', 'publish_overflow', fallback='drop_oldest'),
+        state_refresh_interval=int(config.get('MQTT', 'state_refresh_interval', fallback=STATE_REFRESH_INTERVAL)),
+        light_merge_window=float(config.get('Device', 'light_merge_window', fallback=LIGHT_MERGE_WINDOW)),
+        passive_state=flag('Device', 'passive_state'),
+    )
+
+
+def reload_settings():
+    """Re-read the config and swap in a new Settings object (SIGHUP).
+    The publish queue and light merge settings are applied to the running publisher and
+    light batcher; connection settings (RS485, MQTT server) still need a restart."""
+    global config, settings
+    try:
+        new_config = load_config()
+        new_settings = build_settings(new_config)
+    except Exception as e:
+        logging.error('[CONFIG] reload failed, keeping current settings : {}'.format(e))
+        return
+    config, settings = new_config, new_settings
+    if publisher is not None:
+        publisher.configure(settings.publish_queue_size, settings.publish_overflow, settings.state_refresh_interval)
+    if light_batcher is not None:
+        light_batcher.window = settings.light_merge_window
+    logging.info('[CONFIG] settings reloaded')
+
+
 # mqtt functions ----------------------------
 
-def init_mqttc():
+def init_mqttc(adapter=None):
     # Updated for paho-mqtt 2.x compatibility
+    # adapter : AsyncMqttAdapter driving the client from the asyncio engine instead of loop_start()
     # Generate unique client ID to avoid conflicts
     import random
     import string
@@ -134,9 +323,11 @@ def init_mqttc():
     mqttc.on_subscribe = mqtt_on_subscribe
     mqttc.on_connect = mqtt_on_connect
     mqttc.on_disconnect = mqtt_on_disconnect
+    if adapter is not None:
+        adapter.attach(mqttc)
     
     # Enable debug logging for MQTT
-    if config.get('Log', 'show_mqtt_publish', fallback='False') == 'True':
+    if settings.show_mqtt_publish:
         mqttc.enable_logger()
 
     mqtt_username = config.get('MQTT','mqtt_username', fallback='')
@@ -160,9 +351,11 @@ def init_mqttc():
         try:
             logging.info(f"{logtxt} to {mqtt_server}:{mqtt_port}")
             mqttc.connect(mqtt_server, mqtt_port, keepalive=60)
-            mqttc.loop_start()
-            # Wait a bit to ensure connection is established
-            time.sleep(0.5)
+            if adapter is None:
+                mqttc.loop_start()
+            # discovery right after this must not be published before the broker accepted us
+            if not mqtt_ready.wait(MQTT_CONNECT_TIMEOUT):
+                logging.warning('[MQTT] no CONNACK within {}s, continuing while the client keeps trying'.format(MQTT_CONNECT_TIMEOUT))
             return mqttc
         except Exception as e:
             logging.error(f'[MQTT] connection failure #{retry_cnt}: {str(e)}')
@@ -183,19 +376,129 @@ def mqtt_on_connect(mqttc, userdata, flags, rc, properties=None):
     # Updated for paho-mqtt 2.x with properties parameter
     if rc == 0:
         logging.info("[MQTT] Connected - 0: OK")
-        mqttc.subscribe('kocom/#', 0)
+        mqtt_ready.set()
+        command_router.subscribe(mqttc)       # command topics from discovery(), none yet on the first connect
+        publisher.submit(publisher.republish_all)   # broker may have lost non-retained states
     else:
         logging.error("[MQTT] Connection error - {}: {}".format(rc, mqtt.connack_string(rc)))
 
 def mqtt_on_disconnect(mqttc, userdata, disconnect_flags, reason_code, properties=None):
     # Updated for paho-mqtt 2.x with all required parameters
     # reason_code replaces rc in new version
+    mqtt_ready.clear()
     if reason_code == 0:
         logging.info("[MQTT] Disconnected normally")
     else:
         logging.error(f"[MQTT] Disconnected - Reason: {reason_code}")
 
 
+class MqttPublisher:
+    """Single publisher thread fed by a bounded queue.
+
+    Work items run in the order they were queued, so messages to the same topic
+    keep their order. When the queue is full, overflow='drop_oldest' discards the
+    oldest queued item and overflow='drop_new' discards the new one.
+
+    State topics are change-only: a payload identical to the last one published
+    on the topic is suppressed. Every refresh_interval seconds (0 = never) and on
+    MQTT reconnect all last-published states are sent again.
+    """
+    def __init__(self, maxsize=PUBLISH_QUEUE_SIZE, overflow='drop_oldest', refresh_interval=STATE_REFRESH_INTERVAL):
+        self.q = queue.Queue(maxsize)
+        self.overflow = overflow
+        self.high_water = 0
+        self.dropped = 0
+        self.refresh_interval = refresh_interval
+        self.next_refresh = 0
+        self.last = {}            # topic -> (payload, retain) last published
+        self.suppressed = 0
+        self.thread = threading.Thread(target=self.run, name='mqtt_publisher', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def depth(self):
+        return self.q.qsize()
+
+    def configure(self, maxsize, overflow, refresh_interval):
+        """Apply reloaded settings. Items already queued are kept when the queue shrinks."""
+        with self.q.mutex:
+            self.q.maxsize = maxsize
+        self.overflow = overflow
+        if refresh_interval != self.refresh_interval:
+            self.refresh_interval = refresh_interval
+            self.submit(self.reschedule)      # wakes the thread, which may be waiting for the old interval
+
+    def reschedule(self):
+        self.next_refresh = time.time() + self.refresh_interval
+
+    def submit(self, fn, *args):
+        item = (fn, args)
+        while True:
+            try:
+                self.q.put_nowait(item)
+                break
+            except queue.Full:
+                self.dropped += 1
+                if self.dropped % 100 == 1:
+                    logging.warning('[MQTT] publish queue full ({}), dropped {} so far ({})'.format(self.q.maxsize, self.dropped, self.overflow))
+                if self.overflow == 'drop_new':
+                    return False
+                try:
+                    self.q.get_nowait()
+                except queue.Empty:
+                    pass
+        depth = self.q.qsize()
+        if depth > self.high_water:
+            self.high_water = depth
+        return True
+
+    def publish(self, topic, payload, retain=False):
+        return self.submit(self.publish_state, topic, payload, retain)
+
+    def publish_state(self, topic, payload, retain=False):
+        """Publish a state unless it equals the last one on the topic. Runs on the publisher thread."""
+        if self.last.get(topic) == (payload, retain):
+            self.suppressed += 1
+            return False
+        self.last[topic] = (payload, retain)
+        mqtt_publish(topic, payload, retain)
+        return True
+
+    def republish_all(self):
+        for topic, (payload, retain) in list(self.last.items()):
+            mqtt_publish(topic, payload, retain)
+        if self.last:
+            logging.info('[MQTT] republished {} state topics'.format(len(self.last)))
+
+    def run(self):
+        self.reschedule()
+        while True:
+            try:
+                if self.refresh_interval > 0:
+                    fn, args = self.q.get(True, max(0, self.next_refresh - time.time()))
+                else:
+                    fn, args = self.q.get()
+            except queue.Empty:
+                fn, args = self.republish_all, ()
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.error('[MQTT] publish error : {}'.format(e))
+            if self.refresh_interval > 0 and time.time() >= self.next_refresh:
+                if fn != self.republish_all:
+                    self.republish_all()
+                self.reschedule()
+
+
+def mqtt_publish(topic, payload, retain=False):
+    if mqttc is None:
+        return None     # kept in MqttPublisher.last, republished once connected
+    topic_d = topic.split('/')
+    metrics.inc('kocom_mqtt_publish_total', topic_class=topic_d[2] if len(topic_d) > 2 else topic_d[-1])
+    return mqttc.publish(topic, payload, retain=retain)
+
+
 # serial/socket communication class & functions--------------------
 
 class RS485Wrapper:
@@ -209,10 +512,16 @@ class RS485Wrapper:
             self.socket_port = socket_port
         self.last_read_time = 0
         self.conn = False
+        self.write_lock = threading.Lock()     # one writer at a time waits for the bus
+        self.heard = threading.Event()         # set by the first read after connecting
+        # reusable receive buffer : read() hands out slices of it instead of allocating per byte
+        self.read_buf = bytearray(READ_CHUNK_SIZE)
+        self.read_view = memoryview(self.read_buf)
 
     def connect(self):
         self.close()
         self.last_read_time = 0
+        self.heard.clear()
         if self.type == 'serial':
             self.conn = self.connect_serial(self.serial_port)
         elif self.type == 'socket':
@@ -257,42 +566,56 @@ class RS485Wrapper:
         return sock
 
     def read(self):
+        """Read whatever is available on the bus, up to READ_CHUNK_SIZE bytes.
+
+        Returns a memoryview into the reusable receive buffer. It is only valid
+        until the next read() call, so the caller must consume it first.
+        """
         if self.conn == False:
-            return ''
-        ret = ''
+            raise Exception('RS485 not connected')
+        n = 0
         if self.type == 'serial':
             for i in range(polling_interval+15):
                 try:
-                    ret = self.conn.read()
+                    # block (timeout=1) for at least one byte, then take everything already waiting
+                    want = max(1, min(self.conn.in_waiting, READ_CHUNK_SIZE))
+                    n = self.conn.readinto(self.read_view[:want])
                 except AttributeError:
                     raise Exception('exception occured while reading serial')
                 except TypeError:
                     raise Exception('exception occured while reading serial')
-                if len(ret) != 0:
+                if n:
                     break
         elif self.type == 'socket':
-            ret = self.conn.recv(1)
+            n = self.conn.recv_into(self.read_buf, READ_CHUNK_SIZE)
 
-        if len(ret) == 0:
+        if not n:
             raise Exception('read byte errror')
-        else:
-            self.last_read_time = time.time()
-        return ret
+        # recv returns as soon as data arrives, so this is the arrival time of the chunk's last byte
+        self.last_read_time = time.time()
+        if not self.heard.is_set():
+            self.heard.set()
+        return self.read_view[:n]
 
     def write(self, data):
         if self.conn == False:
             return False
-        if self.last_read_time == 0:
-            time.sleep(1)
-        while time.time() - self.last_read_time < read_write_gap:
-            #logging.debug('pending write : time too short after last read')
-            time.sleep(max([0, read_write_gap - time.time() + self.last_read_time]))
-        if self.type == 'serial':
-            return self.conn.write(data)
-        elif self.type == 'socket':
-            return self.conn.send(data)
-        else:
-            return False
+        with self.write_lock:
+            started = time.time()
+            if self.last_read_time == 0:
+                self.heard.wait(FIRST_WRITE_WAIT)
+            wait = bus_arbiter.delay(time.time(), self.last_read_time, started)
+            while wait > 0:
+                #logging.debug('pending write : bus busy')
+                time.sleep(wait)
+                wait = bus_arbiter.delay(time.time(), self.last_read_time, started)
+            bus_arbiter.transmitted(data, time.time() - started)
+            if self.type == 'serial':
+                return self.conn.write(data)
+            elif self.type == 'socket':
+                return self.conn.send(data)
+            else:
+                return False
 
     def close(self):
         ret = False
@@ -313,12 +636,406 @@ class RS485Wrapper:
             time.sleep(10)
 
 
+# bus capture file : header (magic, wall clock and monotonic time at open), then
+# one record per received chunk (monotonic receive time, length, bytes).
+# Reopening an existing file after a restart appends a session record instead of
+# the header : monotonic time, length CAPTURE_SESSION, then a header without magic.
+CAPTURE_MAGIC = b'KCAP\x01'
+CAPTURE_HEADER = struct.Struct('<dd')
+CAPTURE_RECORD = struct.Struct('<dH')
+CAPTURE_SESSION = 0xffff
+REPLAY_MAX_GAP = 300        # seconds, a longer silence in a capture replays as a new session
+
+
+class BusCapture:
+    """Appends every chunk read from the bus to a binary capture file.
+
+    The file is rotated when it grows past max_bytes, keeping `backups` older
+    files as path.1 (newest) .. path.N. Writes are buffered and flushed at most
+    once a second so the reader thread never waits on the disk.
+    """
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.f = None
+        self.size = 0
+        self.flushed = 0
+        self.open()
+
+    def open(self):
+        self.f = open(self.path, 'ab')
+        self.size = self.f.tell()
+        now = time.monotonic()
+        if self.size == 0:
+            self.f.write(CAPTURE_MAGIC + CAPTURE_HEADER.pack(time.time(), now))
+            self.size = len(CAPTURE_MAGIC) + CAPTURE_HEADER.size
+        else:
+            # the monotonic clock of this run has nothing to do with the previous run's
+            self.f.write(CAPTURE_RECORD.pack(now, CAPTURE_SESSION) + CAPTURE_HEADER.pack(time.time(), now))
+            self.size += CAPTURE_RECORD.size + CAPTURE_HEADER.size
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self.path, i)):
+                os.replace('{}.{}'.format(self.path, i), '{}.{}'.format(self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def write(self, data, recv_time=None):
+        try:
+            if self.size + CAPTURE_RECORD.size + len(data) > self.max_bytes:
+                self.rotate()
+            now = time.monotonic()
+            self.f.write(CAPTURE_RECORD.pack(now if recv_time is None else recv_time, len(data)))
+            self.f.write(data)
+            self.size += CAPTURE_RECORD.size + len(data)
+            if now - self.flushed >= 1:
+                self.f.flush()
+                self.flushed = now
+        except Exception as e:
+            logging.error('[CAPTURE] write failed, capture stopped : {}'.format(e))
+            self.close()
+
+    def close(self):
+        global bus_capture
+        bus_capture = None
+        try:
+            self.f.close()
+        except Exception:
+            pass
+
+
+def capture_files(path):
+    """The capture file and its rotated backups, oldest first"""
+    backups = []
+    i = 1
+    while os.path.exists('{}.{}'.format(path, i)):
+        backups.append('{}.{}'.format(path, i))
+        i += 1
+    return backups[::-1] + ([path] if os.path.exists(path) else [])
+
+
+def read_capture(paths):
+    """Yield (monotonic time, bytes) for every chunk recorded in the capture files.
+    A session record (kocom restarted and appended to the file) yields
+    (monotonic time, (wall clock, monotonic time)) of the new run's clocks instead."""
+    for path in paths:
+        with open(path, 'rb') as f:
+            if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+                raise ValueError('{} is not a bus capture file'.format(path))
+            f.read(CAPTURE_HEADER.size)
+            while True:
+                head = f.read(CAPTURE_RECORD.size)
+                if len(head) < CAPTURE_RECORD.size:
+                    break
+                t, n = CAPTURE_RECORD.unpack(head)
+                if n == CAPTURE_SESSION:
+                    head = f.read(CAPTURE_HEADER.size)
+                    if len(head) < CAPTURE_HEADER.size:
+                        break
+                    yield t, CAPTURE_HEADER.unpack(head)
+                    continue
+                data = f.read(n)
+                if len(data) < n:
+                    break       # cut off by a crash while writing
+                yield t, data
+
+
+RECV_LOG = re.compile(r'\[recv\]([0-9a-fA-F\s]*)$')
+HEX_LINE = re.compile(r'[0-9a-fA-F\s]+')
+
+
+def hex_line_bytes(line):
+    """Bus bytes in one line of text : the payload of a [recv] log line (show_recv_hex)
+    or a line of nothing but hex, e.g. a hex dump. Any other line, and hex runs that
+    are not whole bytes, give nothing, so timestamps and numbers in log text never count."""
+    m = RECV_LOG.search(line)
+    if m is not None:
+        line = m.group(1)
+    elif not HEX_LINE.fullmatch(line):
+        return b''
+    return b''.join(bytes.fromhex(token) for token in line.split() if len(token) % 2 == 0)
+
+
+class ReplayRS485:
+    """Stands in for RS485Wrapper and feeds a bus capture back to the reader.
+
+    speed 1 keeps the recorded timing, N plays N times faster and 0 as fast as
+    the reader consumes it. Written frames go nowhere, but wait for the bus
+    arbiter like a real write so arbiter on/off can be compared on a replay
+    (collisions are then frames of the capture that overlap ours). The position survives
+    close()/connect() so a failed send does not restart the replay; at the end
+    of the capture the bus just stays silent.
+    """
+    def __init__(self, replay_file, replay_speed=1.0):
+        self.type = 'replay'
+        self.replay_file = replay_file
+        self.speed = replay_speed
+        self.records = None
+        self.anchor = None      # (recorded time, local monotonic time) of the replay start
+        self.prev = None
+        self.chunks = self.bytes = 0
+        self.finished = False
+        self.last_read_time = 0
+        self.conn = False
+        self.write_lock = threading.Lock()
+
+    def connect(self):
+        if self.records is None:
+            files = capture_files(self.replay_file)
+            if not files:
+                logging.error('[REPLAY] capture file not found : {}'.format(self.replay_file))
+                return False
+            logging.info('[REPLAY] replaying {} at {}'.format(', '.join(files), '{}x'.format(self.speed) if self.speed > 0 else 'maximum speed'))
+            self.records = read_capture(files)
+        self.conn = True
+        return True
+
+    def next_chunk(self):
+        """(seconds to wait, bytes) of the next recorded chunk, or None at the end"""
+        rec = next(self.records, None)
+        while rec is not None and isinstance(rec[1], tuple):
+            self.prev = None        # session record : the next chunk starts a new timeline
+            rec = next(self.records, None)
+        if rec is None:
+            if not self.finished:
+                logging.info('[REPLAY] finished : {} chunks, {} bytes'.format(self.chunks, self.bytes))
+                self.finished = True
+            return None
+        t, data = rec
+        self.chunks += 1
+        self.bytes += len(data)
+        if self.speed <= 0:
+            return 0, data
+        if self.prev is None or t < self.prev or t - self.prev > REPLAY_MAX_GAP:
+            # first chunk, a capture from another run, or downtime in a capture without session records
+            self.anchor = (t, time.monotonic())
+        self.prev = t
+        return self.anchor[1] + (t - self.anchor[0]) / self.speed - time.monotonic(), data
+
+    def read(self):
+        if self.conn == False:
+            raise Exception('RS485 not connected')
+        rec = self.next_chunk()
+        while rec is None:
+            time.sleep(3600)
+        delay, data = rec
+        if delay > 0:
+            time.sleep(delay)
+        self.last_read_time = time.time()
+        return data
+
+    def write(self, data):
+        if self.conn == False:
+            return False
+        with self.write_lock:
+            started = time.time()
+            wait = bus_arbiter.delay(started, self.last_read_time, started)
+            while wait > 0:
+                time.sleep(wait)
+                wait = bus_arbiter.delay(time.time(), self.last_read_time, started)
+            bus_arbiter.transmitted(data, time.time() - started)
+        return len(data)
+
+    def close(self):
+        self.conn = False
+
+    def reconnect(self):
+        self.connect()
+
+
+class BusArbiter:
+    """Picks the moment to transmit on the shared half-duplex bus.
+
+    Receive timestamps teach it how soon the next frame of an exchange follows
+    (p95 of the gaps shorter than arbiter_burst_gap) and the wallpad's cadence,
+    the period between the starts of its exchanges when that period is steady.
+    A write then waits until the exchange on the bus is over and does not start
+    right before the next predicted burst, for at most arbiter_max_wait. With
+    [RS485] arbiter = False only read_write_gap after the last read is kept.
+
+    Writes, retries (sequence code past the first) and collisions (a frame other
+    than our echo or ACK ending within two frame times of our write) are counted
+    in both modes, so the two can be compared on the simulator or a replay.
+    """
+    def __init__(self, timing, enabled):
+        self.enabled = enabled
+        self.burst_gap = timing.get('arbiter_burst_gap', 0.25)
+        self.max_wait = timing.get('arbiter_max_wait', 1.0)
+        self.min_samples = timing.get('arbiter_min_samples', 20)
+        self.frame_time = packet_size * 10 / 9600      # 8N1 at 9600 bps
+        self.lock = threading.Lock()
+        self.gaps = collections.deque(maxlen=timing.get('arbiter_window', 200))
+        self.periods = collections.deque(maxlen=32)
+        self.durations = collections.deque(maxlen=32)
+        self.last = 0               # time of the last frame received
+        self.burst_start = 0
+        self.follow = read_write_gap    # learned gap inside an exchange
+        self.period = None          # steady wallpad cadence, None while unknown
+        self.burst_len = 0
+        self.tx_time = 0
+        self.tx_frame = None
+        self.tx_collided = False
+        self.writes = self.retries = self.collisions = 0
+        self.waited = 0.0
+
+    def received(self, t, frame):
+        """A frame ended at t; frame is None for one that failed the checksum or trailer"""
+        with self.lock:
+            tx = self.tx_frame
+            if tx is not None and not self.tx_collided and self.tx_time < t < self.tx_time + 2 * self.frame_time:
+                # the frame was on the wire while ours was, unless it is our own echo or the ACK to it
+                if frame is None or frame != tx and not (frame[5:7] == tx[7:9] and frame[7:9] == tx[5:7]):
+                    self.tx_collided = True
+                    self.collisions += 1
+            if t != self.last:     # frames of one read chunk share its time, their gap was not observed
+                gap = max(0, t - self.last)
+                if gap < self.burst_gap:
+                    self.gaps.append(gap)
+                else:
+                    if self.burst_start:
+                        self.durations.append(self.last - self.burst_start)
+                        self.periods.append(t - self.burst_start)
+                        self.learn()
+                    self.burst_start = t
+            self.last = max(self.last, t)
+
+    def learn(self):
+        if len(self.gaps) >= self.min_samples:
+            ordered = sorted(self.gaps)
+            self.follow = max(read_write_gap, ordered[int(len(ordered) * 0.95)])
+        if len(self.periods) >= 8:
+            ordered = sorted(self.periods)
+            n = len(ordered)
+            median = ordered[n // 2]
+            steady = ordered[n * 3 // 4] - ordered[n // 4] < 0.2 * median
+            self.period = median if steady else None
+            self.burst_len = sorted(self.durations)[len(self.durations) // 2]
+
+    def delay(self, now, last_read_time, started):
+        """Seconds to wait before writing, 0 or less when the bus is free"""
+        if last_read_time == 0:
+            return started + FIRST_WRITE_WAIT - now     # nothing heard from the bus yet
+        wait = read_write_gap - (now - last_read_time)
+        if not self.enabled or now - started >= self.max_wait:
+            return wait
+        with self.lock:
+            wait = max(wait, self.last + self.follow - now)
+            if self.period is not None:
+                nxt = self.burst_start + self.period * math.ceil((now - self.burst_start) / self.period)
+                if nxt - now < 2 * self.frame_time + self.follow:   # our frame and its ACK would run into it
+                    wait = max(wait, nxt + self.burst_len + self.follow - now)
+        return min(wait, started + self.max_wait - now)
+
+    def transmitted(self, data, waited):
+        with self.lock:
+            self.tx_time = time.time()
+            self.tx_frame = bytes(data)
+            self.last = max(self.last, self.tx_time + self.frame_time)   # our own frame keeps the bus busy too
+            self.tx_collided = False
+            self.writes += 1
+            if len(data) == packet_size and seq_t_dic.get('{0:x}'.format(data[3] & 0x0f), 1) != 1:
+                self.retries += 1
+            self.waited += waited
+        metrics.observe('kocom_bus_wait_seconds', waited)
+
+    def stats(self):
+        with self.lock:
+            return {'writes': self.writes, 'retries': self.retries, 'collisions': self.collisions,
+                    'avg_wait_ms': round(1000 * self.waited / self.writes, 1) if self.writes else 0,
+                    'exchange_gap_ms': round(1000 * self.follow, 1),
+                    'cadence_s': None if self.period is None else round(self.period, 2)}
+
+
+class RttEstimator:
+    """Measured bus round trips per device type, used for the ACK/response timeouts.
+
+    'ack' is the time from writing a frame to its ACK, 'response' the time from
+    the ACK to the device's state frame. Until min_samples are collected the
+    fixed protocol.json timeouts are used; after that a timeout is the observed
+    p99 times rtt_margin, kept within the *_floor and *_ceiling bounds.
+    Each retry doubles the timeout, still capped at the ceiling.
+    """
+    def __init__(self, timing):
+        self.timing = timing
+        self.window = timing.get('rtt_window', 200)
+        self.min_samples = timing.get('rtt_min_samples', 20)
+        self.margin = timing.get('rtt_margin', 1.5)
+        self.lock = threading.Lock()
+        self.samples = {}      # (kind, device type) -> deque of seconds
+        self.timeouts = {}     # (kind, device type) -> number of timed out waits
+
+    def add(self, kind, dest, seconds):
+        key = (kind, device_t_dic.get(dest[:2], dest[:2]))
+        metrics.observe('kocom_{}_latency_seconds'.format(kind), seconds, device=key[1])
+        with self.lock:
+            if key not in self.samples:
+                self.samples[key] = collections.deque(maxlen=self.window)
+            self.samples[key].append(seconds)
+
+    def timed_out(self, kind, dest):
+        key = (kind, device_t_dic.get(dest[:2], dest[:2]))
+        with self.lock:
+            self.timeouts[key] = self.timeouts.get(key, 0) + 1
+
+    def percentile(self, kind, dest, pct):
+        with self.lock:
+            values = sorted(self.samples.get((kind, device_t_dic.get(dest[:2], dest[:2])), ()))
+        if len(values) < self.min_samples:
+            return None
+        return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+    def ack_timeout(self, dest, attempt=0):
+        p99 = self.percentile('ack', dest, 99)
+        if p99 is None:
+            # random wait between ack_timeout_min~max seconds for ACK
+            t_min, t_max = self.timing.get('ack_timeout_min', 1.3), self.timing.get('ack_timeout_max', 1.5)
+            return t_min + (t_max - t_min) * random.random()
+        timeout = max(p99 * self.margin, self.timing.get('ack_timeout_floor', 0.2)) * (2 ** attempt)
+        # keep the random spread so two controllers retrying don't collide again
+        return min(timeout * (1 + 0.15 * random.random()), self.timing.get('ack_timeout_ceiling', 3))
+
+    def response_timeout(self, dest):
+        p99 = self.percentile('response', dest, 99)
+        if p99 is None:
+            return self.timing.get('response_timeout', 2)
+        return min(max(p99 * self.margin, self.timing.get('response_timeout_floor', 0.3)), self.timing.get('response_timeout_ceiling', 4))
+
+    def stats(self):
+        """{'kind/device type': {samples, p50, p99, timeouts}} with times in ms"""
+        with self.lock:
+            keys = set(self.samples) | set(self.timeouts)
+            snapshot = {k: sorted(self.samples.get(k, ())) for k in keys}
+            timeouts = dict(self.timeouts)
+        ret = {}
+        for (kind, dev), values in sorted(snapshot.items()):
+            entry = {'samples': len(values), 'timeouts': timeouts.get((kind, dev), 0)}
+            if values:
+                entry['p50'] = round(values[len(values) // 2] * 1000, 1)
+                entry['p99'] = round(values[min(len(values) - 1, int(len(values) * 0.99))] * 1000, 1)
+            ret['{}/{}'.format(kind, dev)] = entry
+        return ret
+
 
 def send(dest, src, cmd, value, log=None, check_ack=True):
+    trace = tracer.command_take() if tracer is not None and cmd != cmd_h_dic['query'] else None
+    if engine is not None:
+        with send_lock:
+            return engine.call(engine.send(dest, src, cmd, value, log, check_ack, trace))
     send_lock.acquire()
     ack_data.clear()
+    drop_stale(ack_q)      # a duplicate ACK of the previous send must not ACK this one
+    if cmd != cmd_h_dic['query']:
+        state_store.invalidate(dest)   # cached state is outdated once we command the device
+        poll_scheduler.commanded(dest)
     ret = False
-    for seq_h in seq_t_dic.keys(): # if there's no ACK received, then repeat sending with next sequence code
+    sent_at = {}
+    for attempt, seq_h in enumerate(seq_t_dic.keys()): # if there's no ACK received, then repeat sending with next sequence code
         payload = type_h_dic['send'] + seq_h + '00' + dest + src + cmd + value
         send_data = header_h + payload + chksum(payload) + trailer_h
         try:
@@ -329,113 +1046,321 @@ def send(dest, src, cmd, value, log=None, check_ack=True):
             break
         if log != None:
             logging.info('[SEND|{}] {}'.format(log, send_data))
+        metrics.inc('kocom_send_attempts_total', seq=seq_h)
+        if trace is not None and attempt == 0:
+            trace.append(('written', time.time()))
         if check_ack == False:
             time.sleep(1)
             ret = send_data
             break
 
         # wait and checking for ACK
-        ack_data.append(type_h_dic['ack'] + seq_h + '00' +  src + dest + cmd + value)
+        expected = type_h_dic['ack'] + seq_h + '00' +  src + dest + cmd + value
+        sent_at[expected] = time.time()
+        ack_data.append(expected)
         try:
-            ack_q.get(True, 1.3+0.2*random.random()) # random wait between 1.3~1.5 seconds for ACK
-            if config.get('Log', 'show_recv_hex') == 'True':
+            ack_h, recv_time = ack_q.get(True, rtt.ack_timeout(dest, attempt))
+            if ack_h in sent_at:    # a late ACK of an earlier sequence is timed from its own send
+                rtt.add('ack', dest, recv_time - sent_at[ack_h])
+            if trace is not None:
+                tracer.finish('command', trace + [('acked', recv_time)])
+            if settings.show_recv_hex:
                 logging.info ('[ACK] OK')
             ret = send_data
             break
         except queue.Empty:
-            pass
+            rtt.timed_out('ack', dest)
+            metrics.inc('kocom_ack_timeouts_total', seq=seq_h)
 
     if ret == False:
         logging.info('[RS485] send failed. closing RS485. it will try to reconnect to RS485 shortly.')
+        metrics.inc('kocom_send_failures_total')
         rs485.close()
     ack_data.clear()
     send_lock.release()
     return ret
 
 
+def put_latest(q, item):
+    """Hand an item to a waiting sender without blocking the listener; it replaces one nobody took"""
+    drop_stale(q)
+    q.put_nowait(item)
+
+
+def drop_stale(q):
+    try:
+        q.get_nowait()
+    except queue.Empty:
+        pass
+
+
 def chksum(data_h):
     sum_buf = sum(bytearray.fromhex(data_h))
     return '{0:02x}'.format((sum_buf)%256)  # return chksum hex value in text format
 
 
-def send_batch_off_continuous(duration=None):
-    """일괄소등 OFF 패킷을 연속으로 전송하여 일괄소등 해제 유지
+class BatchOffKeepalive:
+    """일괄소등 OFF 패킷을 백그라운드에서 연속 전송하여 일괄소등 해제 유지
 
-    Args:
-        duration: 전송 지속 시간 (초), None이면 JSON 설정값 사용
+    extend() opens a keepalive window, or extends the active one, instead of
+    starting another transmission loop. Packets are only written while no
+    send() holds the bus, so the keepalive never delays a command or its ACK.
+    The bus arbiter's idle window is awaited before taking send_lock, and a slot
+    is skipped when the bus is busy again by then, so a command never queues
+    behind a keepalive packet waiting for the bus.
     """
-    try:
-        batch_config = packet_config['special_packets']['batch_off']
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.end_time = 0
+        self.thread = threading.Thread(target=self.run, name='batch_keepalive', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def extend(self, duration=None):
+        """Keep sending batch_off for `duration` seconds from now (None: JSON 설정값 사용)"""
         if duration is None:
-            duration = batch_config['duration']
-        interval = batch_config['interval']
-        packet_hex = batch_config['hex']
+            duration = packet_config['special_packets']['batch_off']['duration']
+        with self.cond:
+            active = self.end_time > time.time()
+            self.end_time = max(self.end_time, time.time() + duration)
+            self.cond.notify()
+        logging.info(f'[BATCH_DEBUG] batch_off keepalive {"extended" if active else "started"} - Duration: {duration}s')
+
+    def run(self):
+        while True:
+            with self.cond:
+                while time.time() >= self.end_time:
+                    self.cond.wait()
+            try:
+                self.transmit()
+            except Exception as ex:
+                logging.error(f'[BATCH_DEBUG] Batch_off error: {ex}')
 
-        logging.info(f'[BATCH_DEBUG] Starting continuous batch_off transmission - Duration: {duration}s, Interval: {interval}s')
-        logging.info(f'[BATCH_DEBUG] Batch_off packet: {packet_hex}')
+    def transmit(self):
+        batch_config = packet_config['special_packets']['batch_off']
+        interval = batch_config['interval']
+        packet = bytearray.fromhex(batch_config['hex'])
+        logging.info(f'[BATCH_DEBUG] Batch_off packet: {batch_config["hex"]}, Interval: {interval}s')
 
-        end_time = time.time() + duration
+        start = time.time()
         count = 0
+        skipped = 0
         failed_count = 0
-        while time.time() < end_time:
-            if rs485.write(bytearray.fromhex(packet_hex)) == False:
-                failed_count += 1
-                logging.warning(f'[BATCH_DEBUG] Batch_off packet write failed (attempt {count+1})')
-                break
-            count += 1
-            if count % 5 == 0:  # 5번마다 진행 상황 로깅
-                logging.info(f'[BATCH_DEBUG] Batch_off progress: {count} packets sent')
+        while time.time() < self.end_time:
+            # wait for the bus without holding send_lock, a command may need it meanwhile
+            slot = time.time()
+            wait = bus_arbiter.delay(slot, rs485.last_read_time, slot)
+            while wait > 0:
+                time.sleep(wait)
+                wait = bus_arbiter.delay(time.time(), rs485.last_read_time, slot)
+            # skip this slot while a command is on the bus; it has priority
+            if send_lock.acquire(blocking=False):
+                try:
+                    now = time.time()
+                    if bus_arbiter.delay(now, rs485.last_read_time, now) > 0:
+                        skipped += 1    # the bus got busy again, don't wait for it holding the lock
+                    elif rs485.write(packet) == False:
+                        failed_count += 1
+                    else:
+                        count += 1
+                finally:
+                    send_lock.release()
+                if count and count % 5 == 0:  # 5번마다 진행 상황 로깅
+                    logging.info(f'[BATCH_DEBUG] Batch_off progress: {count} packets sent')
+            else:
+                skipped += 1
             time.sleep(interval)
 
-        logging.info(f'[BATCH_DEBUG] Batch_off transmission complete - Sent: {count}, Failed: {failed_count}, Duration: {duration}s')
-    except Exception as ex:
-        logging.error(f'[BATCH_DEBUG] Batch_off error: {ex}')
+        logging.info(f'[BATCH_DEBUG] Batch_off transmission complete - Sent: {count}, Skipped: {skipped}, Failed: {failed_count}, Duration: {time.time() - start:.1f}s')
+
+
+# frame scanning --------------------------------
+
+class FrameScanner:
+    """Bytes-native framing engine for the aa55 ... chksum 0d0d packets.
+
+    feed() takes raw bytes (bytes/bytearray/memoryview) as they come off the bus
+    and returns the complete, valid frames as bytes. Bytes are only converted to
+    hex when something has to be logged.
+    """
+    def __init__(self):
+        self.header = bytes.fromhex(header_h)
+        self.trailer = bytes.fromhex(trailer_h)
+        self.size = packet_size
+        self.chksum_pos = chksum_position
+        self.buf = bytearray()
+        self.frames = 0           # valid frames handed out
+        self.invalid = 0          # frames with bad checksum or trailer
+        self.bad_checksum = 0
+        self.bad_trailer = 0
+        self.dropped = 0          # bytes discarded while resyncing to a header
+
+    def reset(self):
+        del self.buf[:]
+
+    def drop(self, start, end):
+        if end > start:
+            self.dropped += end - start
+            logging.info('[comm] not parsed ' + self.buf[start:end].hex())
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        header, trailer, size, ck = self.header, self.trailer, self.size, self.chksum_pos
+        hlen = len(header)
+        n = len(buf)
+        pos = 0
+        frames = []
+        while pos < n:
+            start = buf.find(header, pos)
+            if start < 0:
+                # keep a partial header at the tail, drop everything before it
+                tail = n
+                for k in range(min(hlen - 1, n - pos), 0, -1):
+                    if buf[n-k:] == header[:k]:
+                        tail = n - k
+                        break
+                self.drop(pos, tail)
+                pos = tail
+                break
+            self.drop(pos, start)
+            end = start + size
+            if end > n:
+                pos = start   # incomplete frame, wait for more bytes
+                break
+            if sum(buf[start+hlen:start+ck]) & 0xff == buf[start+ck] and buf[end-len(trailer):end] == trailer:
+                frames.append(bytes(buf[start:end]))
+                pos = end
+            else:
+                self.invalid += 1
+                if sum(buf[start+hlen:start+ck]) & 0xff != buf[start+ck]:
+                    self.bad_checksum += 1
+                else:
+                    self.bad_trailer += 1
+                logging.info("[comm] invalid packet {} expected checksum {:02x}".format(buf[start:end].hex(), sum(buf[start+hlen:start+ck]) & 0xff))
+                # if there's header packet in the middle of invalid packet, re-parse from that posistion
+                nxt = buf.find(header, start + 1, end)
+                if nxt < 0:
+                    nxt = end
+                self.drop(start, nxt)
+                pos = nxt
+        del buf[:pos]
+        self.frames += len(frames)
+        return frames
 
 
 # hex parsing --------------------------------
 
-def parse(hex_data):
-    header_h = hex_data[:4]       # header : aa55
-    type_h = hex_data[4:7]        # send/ack : 30b(send) 30d(ack)
-    seq_h = hex_data[7:8]         # sequence : c(1st) d(2nd)
-    monitor_h = hex_data[8:10]    # monitor : 00(wallpad) 02(KitchenTV)
-    dest_h = hex_data[10:14]      # dest addr : 0100(wallpad0) 0e00(light0) 3600(thermo0) 3601(thermo1) 3602(thermo2) 3603(thermo3)
-    src_h = hex_data[14:18]       # source addr
-    cmd_h = hex_data[18:20]       # command : 3e(query)
-    value_h = hex_data[20:36]     # value
-    chksum_h = hex_data[36:38]    # checksum
-    trailer_h = hex_data[38:42]   # trailer
-
-    data_h = hex_data[4:36]
-    payload_h = hex_data[18:36]
-    cmd = cmd_t_dic.get(cmd_h)
-
-    ret = { 'header_h':header_h, 'type_h':type_h, 'seq_h':seq_h, 'monitor_h':monitor_h, 'dest_h':dest_h, 'src_h':src_h, 'cmd_h':cmd_h,
-            'value_h':value_h, 'chksum_h':chksum_h, 'trailer_h':trailer_h, 'data_h':data_h, 'payload_h':payload_h,
-            'type':type_t_dic.get(type_h),
-            'seq':seq_t_dic.get(seq_h),
-            'dest':device_t_dic.get(dest_h[:2]),
-            'dest_subid':str(int(dest_h[2:4], 16)),
-            'dest_room':room_t_dic.get(dest_h[2:4]),
-            'src':device_t_dic.get(src_h[:2]),
-            'src_subid':str(int(src_h[2:4], 16)),
-            'src_room':room_t_dic.get(src_h[2:4]),
-            'cmd':cmd if cmd!=None else cmd_h,
-            'value':value_h,
-            'time':time.time(),
-            'flag':None}
+HEX_BYTE = ['{0:02x}'.format(i) for i in range(256)]
+
+
+class Packet:
+    """A received frame: the raw packet bytes plus its receive time.
+
+    Fields are decoded lazily from the raw bytes when accessed, so frames that
+    are only cached or forwarded never pay for hex conversion.
+    """
+    __slots__ = ('raw', 'time', 'flag', 'stamps')
+
+    def __init__(self, raw, recv_time=None, flag=None):
+        self.raw = raw
+        self.time = time.time() if recv_time is None else recv_time
+        self.flag = flag
+        self.stamps = None        # latency trace stages, only when tracing
+
+    # raw fields (hex text)
+    @property
+    def hex(self):          # full packet
+        return self.raw.hex()
+    @property
+    def header_h(self):     # header : aa55
+        return self.raw[0:2].hex()
+    @property
+    def type_h(self):       # send/ack : 30b(send) 30d(ack)
+        return self.raw[2:4].hex()[:3]
+    @property
+    def seq_h(self):        # sequence : c(1st) d(2nd)
+        return '{0:x}'.format(self.raw[3] & 0x0f)
+    @property
+    def monitor_h(self):    # monitor : 00(wallpad) 02(KitchenTV)
+        return HEX_BYTE[self.raw[4]]
+    @property
+    def dest_h(self):       # dest addr : 0100(wallpad0) 0e00(light0) 3600(thermo0) 3601(thermo1) 3602(thermo2) 3603(thermo3)
+        return self.raw[5:7].hex()
+    @property
+    def src_h(self):        # source addr
+        return self.raw[7:9].hex()
+    @property
+    def cmd_h(self):        # command : 3a(query)
+        return HEX_BYTE[self.raw[9]]
+    @property
+    def value_h(self):      # value
+        return self.raw[10:18].hex()
+    value = value_h
+    @property
+    def chksum_h(self):     # checksum
+        return HEX_BYTE[self.raw[18]]
+    @property
+    def trailer_h(self):    # trailer
+        return self.raw[19:21].hex()
+    @property
+    def data_h(self):
+        return self.raw[2:18].hex()
+    @property
+    def payload_h(self):
+        return self.raw[9:18].hex()
+
+    # decoded fields
+    @property
+    def type(self):
+        return type_t_dic.get(self.type_h)
+    @property
+    def seq(self):
+        return seq_t_dic.get(self.seq_h)
+    @property
+    def dest(self):
+        return device_t_dic.get(HEX_BYTE[self.raw[5]])
+    @property
+    def dest_subid(self):
+        return str(self.raw[6])
+    @property
+    def dest_room(self):
+        return room_t_dic.get(HEX_BYTE[self.raw[6]])
+    @property
+    def src(self):
+        return device_t_dic.get(HEX_BYTE[self.raw[7]])
+    @property
+    def src_subid(self):
+        return str(self.raw[8])
+    @property
+    def src_room(self):
+        return room_t_dic.get(HEX_BYTE[self.raw[8]])
+    @property
+    def cmd(self):
+        cmd_h = HEX_BYTE[self.raw[9]]
+        return cmd_t_dic.get(cmd_h, cmd_h)
+
+
+def empty_packet():
+    """Placeholder returned when a device did not answer (value all zero, flag False)"""
+    return Packet(bytes(packet_size), flag=False)
+
+
+def parse(frame, recv_time=None):
+    p = Packet(frame, recv_time)
 
     # 일괄소등 디버깅: 특수 패킷 타입(309c) 및 batch 관련 패킷 감지
-    if type_h == '309c':
+    if frame[2] == 0x30 and frame[3] == 0x9c:
         logging.warning(f'[BATCH_DEBUG] Special packet type 309c detected!')
-        logging.warning(f'[BATCH_DEBUG]   Src: {src_h}, Dest: {dest_h}, Cmd: {cmd_h}, Value: {value_h}')
-        logging.warning(f'[BATCH_DEBUG]   Full packet: {hex_data}')
-    elif cmd_h in ['65', '66']:  # batch_on, batch_off commands
-        logging.warning(f'[BATCH_DEBUG] Batch command detected - Cmd: {cmd_h} ({cmd})')
-        logging.warning(f'[BATCH_DEBUG]   Type: {type_h}, Src: {src_h}, Dest: {dest_h}, Value: {value_h}')
-        logging.warning(f'[BATCH_DEBUG]   Full packet: {hex_data}')
+        logging.warning(f'[BATCH_DEBUG]   Src: {p.src_h}, Dest: {p.dest_h}, Cmd: {p.cmd_h}, Value: {p.value_h}')
+        logging.warning(f'[BATCH_DEBUG]   Full packet: {p.hex}')
+    elif frame[9] in (0x65, 0x66):  # batch_on, batch_off commands
+        logging.warning(f'[BATCH_DEBUG] Batch command detected - Cmd: {p.cmd_h} ({p.cmd})')
+        logging.warning(f'[BATCH_DEBUG]   Type: {p.type_h}, Src: {p.src_h}, Dest: {p.dest_h}, Value: {p.value_h}')
+        logging.warning(f'[BATCH_DEBUG]   Full packet: {p.hex}')
 
-    return ret
+    return p
 
 
 def thermo_parse(value):
@@ -446,7 +1371,7 @@ def thermo_parse(value):
     ret = {
         'heat_mode': 'heat' if value[:2] == heat_mode_on else 'off',
         'away': 'true' if value[2:4] == thermo_cfg['away_on'] else 'false',
-        'set_temp': int(value[4:6], 16) if value[:2] == heat_mode_on else int(config.get('User', 'init_temp')),
+        'set_temp': int(value[4:6], 16) if value[:2] == heat_mode_on else settings.init_temp,
         'cur_temp': int(value[8:10], 16)
     }
     return ret
@@ -454,7 +1379,7 @@ def thermo_parse(value):
 
 def light_parse(value):
     ret = {}
-    for i in range(1, int(config.get('User', 'light_count'))+1):
+    for i in range(1, settings.light_count+1):
         ret['light_'+str(i)] = 'off' if value[i*2-2:i*2] == '00' else 'on'
     return ret
 
@@ -469,7 +1394,7 @@ def fan_parse(value):
     preset = 'Off' if state == 'off' else preset_dic.get(value[4:6])
 
     logtxt = f'[MQTT Parse | Fan] value[{value}], state[{state}]'
-    if config.get('Log', 'show_recv_hex') == 'True':
+    if settings.show_recv_hex:
         logging.info(logtxt)
     return {'state': state, 'preset': preset}
 
@@ -486,32 +1411,202 @@ def ac_parse(value):
     target = int(value[10:12], 16)
 
     logtxt = f'[MQTT Parse | AC] value[{value}], state[{state}]'
-    if config.get('Log', 'show_recv_hex') == 'True':
+    if settings.show_recv_hex:
         logging.info(logtxt)
     return {'state': state, 'fan': fan, 'temperature': temperature, 'target': target}
 
 
 # query device --------------------------
 
+class StateStore:
+    """Latest ACK'd state per device address (dest_h, e.g. 3601).
+
+    Entries older than ttl seconds (polling_interval) count as missing. Sending a
+    command to a device invalidates its entry so the next query goes to the bus.
+    Light bitmaps are also taken from the lights' own frames and ACKs, so light
+    commands can be built from a fresh peek() without a query.
+
+    States restored from the snapshot, and all states after an RS485 reconnect,
+    are unconfirmed: get() ignores them until the bus reports the device again,
+    but peek() still returns them as stale.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.states = {}
+        self.unconfirmed = set()
+
+    def update(self, device_h, packet):
+        self.states[device_h] = packet
+        self.unconfirmed.discard(device_h)
+
+    def restore(self, device_h, packet):
+        self.states[device_h] = packet
+        self.unconfirmed.add(device_h)
+
+    def get(self, device_h):
+        p = self.states.get(device_h)
+        if p is None or device_h in self.unconfirmed or time.time() - p.time > self.ttl:
+            return None
+        return p
+
+    def peek(self, device_h):
+        """Latest state regardless of age, and whether it is older than ttl or unconfirmed"""
+        p = self.states.get(device_h)
+        if p is None:
+            return None, True
+        return p, device_h in self.unconfirmed or time.time() - p.time > self.ttl
+
+    def invalidate(self, device_h):
+        self.states.pop(device_h, None)
+        self.unconfirmed.discard(device_h)
+
+    def expire(self):
+        """Keep every state but require the bus to confirm it again"""
+        self.unconfirmed.update(self.states)
+
+
+class StateSnapshot:
+    """Last known state of every device on disk, for warm restarts.
+
+    Holds the command and value of each device's latest state frame. A writer
+    thread saves them as compact JSON at most once per interval seconds, to a
+    temporary file that then replaces the snapshot, so a crash or power cut
+    leaves either the old or the new snapshot and never a torn one.
+    At startup restore() rebuilds the devices' state reports from the file;
+    they are published right after discovery and stay unconfirmed in the state
+    store until the bus reports each device again. An unreadable file or a bad
+    entry is skipped with a warning, so a snapshot never stops a restart.
+    """
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.states = {}        # device_h -> [cmd_h, value_h, wall clock time]
+        self.dirty = False
+        self.restored = []
+        self.writes = 0
+        self.thread = threading.Thread(target=self.run, name='state_snapshot', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def restore(self, store):
+        try:
+            with open(self.path, 'r') as f:
+                self.states = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ex:
+            logging.warning('[SNAPSHOT] ignoring unreadable snapshot {}: {}'.format(self.path, ex))
+            return
+        if not isinstance(self.states, dict):
+            logging.warning('[SNAPSHOT] ignoring snapshot {}: not a JSON object'.format(self.path))
+            self.states = {}
+            return
+        enabled = enabled_addresses()
+        for device_h, entry in list(self.states.items()):
+            p = self.rebuild(device_h, entry, enabled)
+            if p is None:
+                del self.states[device_h]
+                continue
+            store.restore(device_h, p)
+            self.restored.append(p)
+        if self.restored:
+            logging.info('[SNAPSHOT] restored {} device states from {}, saved {:.0f}s ago'.format(
+                len(self.restored), self.path, time.time() - max(p.time for p in self.restored)))
+
+    def rebuild(self, device_h, entry, enabled):
+        """The device's state report to the wallpad, as if it had just been received, or None for a bad entry"""
+        try:
+            cmd_h, value_h, saved = entry
+            if device_h not in enabled:
+                raise ValueError('not an enabled device')
+            if device_t_dic.get(device_h[:2]) not in STATE_DEVICES:
+                raise ValueError('not a state device')
+            if cmd_h not in cmd_t_dic:
+                raise ValueError('unknown command {}'.format(cmd_h))
+            if len(value_h) != 16:
+                raise ValueError('value is not 8 bytes')
+            payload = type_h_dic['send'] + seq_h_dic[1] + '00' + device_h_dic['wallpad'] + '00' + device_h + cmd_h + value_h
+            return Packet(bytes.fromhex(header_h + payload + chksum(payload) + trailer_h), float(saved))
+        except (TypeError, ValueError) as ex:
+            logging.warning('[SNAPSHOT] skipping entry {} {}: {}'.format(device_h, entry, ex))
+            return None
+
+    def record(self, device_h, p):
+        with self.cond:
+            old = self.states.get(device_h)
+            self.states[device_h] = [p.cmd_h, p.value_h, round(time.time())]
+            if old is None or old[:2] != self.states[device_h][:2]:
+                self.dirty = True
+                self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.dirty:
+                    self.cond.wait()
+                self.dirty = False
+                data = json.dumps(self.states, separators=(',', ':'), sort_keys=True)
+            try:
+                self.save(data)
+            except OSError as ex:
+                logging.warning('[SNAPSHOT] write failed: {}'.format(ex))
+            time.sleep(self.interval)
+
+    def save(self, data):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.writes += 1
+
+
+def publish_restored():
+    """Publish the snapshot's states right after discovery, before the first poll confirms them.
+    A device the bus has already reported, or that is no longer enabled, is skipped."""
+    if state_snapshot is None:
+        return
+    enabled = enabled_addresses()
+    for p in state_snapshot.restored:
+        if p.src_h in state_store.unconfirmed and p.src_h in enabled:
+            publish_status(p)
+
+
+def enabled_addresses():
+    """Device addresses (e.g. 3601) of settings.enabled_devices, rebuilt when a reload swaps the settings"""
+    global enabled_cache
+    if enabled_cache[0] is not settings:
+        addresses = set()
+        for t in settings.enabled_devices:
+            dev = t.split('_')
+            dev_id = device_h_dic.get(dev[0])
+            sub_id = room_h_dic.get(dev[1]) if len(dev) > 1 else '00'
+            if dev_id != None and sub_id != None:
+                addresses.add(dev_id + sub_id)
+        enabled_cache = (settings, addresses)
+    return enabled_cache[1]
+
+
 def query(device_h, publish=False, enforce=False):
-    # find from the cache first
-    for c in cache_data:
-        if enforce: break
-        if time.time() - c['time'] > polling_interval:  # if there's no data within polling interval, then exit cache search
-            break
-        if c['type'] == 'ack' and c['src'] == 'wallpad' and c['dest_h'] == device_h and c['cmd'] != 'query':
-            if (config.get('Log', 'show_query_hex') == 'True'):
-                logging.info('[cache|{}{}] query cache {}'.format(c['dest'], c['dest_subid'], c['data_h']))
+    # find from the state store first
+    if not enforce:
+        c = state_store.get(device_h)
+        if c is not None:
+            if settings.show_query_hex:
+                logging.info('[cache|{}{}] query cache {}'.format(c.dest, c.dest_subid, c.data_h))
             return c  # return the value in the cache
 
     # if there's no cache data within polling inteval, then send query packet
-    if (config.get('Log', 'show_query_hex') == 'True'):
+    if settings.show_query_hex:
         log = 'query ' + device_t_dic.get(device_h[:2]) + str(int(device_h[2:4],16))
     else:
         log = None
-    # Use light_controller_addr for light devices (some apartments use non-standard controller)
+    # Use light controller address for light devices (some apartments use non-standard controller)
     if device_h[:2] == device_h_dic['light']:
-        return send_wait_response(dest=device_h, src=light_controller_addr, cmd=cmd_h_dic['query'], log=log, publish=publish)
+        return send_wait_response(dest=device_h, src=settings.light_controller_addr, cmd=cmd_h_dic['query'], log=log, publish=publish)
     return send_wait_response(dest=device_h, cmd=cmd_h_dic['query'], log=log, publish=publish)
 
 
@@ -522,23 +1617,97 @@ def send_wait_response(dest, src=None, cmd=None, value='0'*16, log=None, check_a
     if cmd is None:
         cmd = cmd_h_dic['state']
 
+    if engine is not None:
+        trace = tracer.command_take() if tracer is not None and cmd != cmd_h_dic['query'] else None
+        with send_lock:
+            return engine.call(engine.send_wait_response(dest, src, cmd, value, log, check_ack, publish, trace))
+
     #logging.debug('waiting for send_wait_response :'+dest)
     wait_target.put(dest)
+    drop_stale(wait_q)     # a late duplicate response meant for the previous caller
     #logging.debug('entered send_wait_response :'+dest)
-    ret = { 'value':'0'*16, 'flag':False }
+    ret = empty_packet()
 
     if send(dest, src, cmd, value, log, check_ack) != False:
+        acked = time.time()
         try:
-            ret = wait_q.get(True, 2)
+            ret = wait_q.get(True, rtt.response_timeout(dest))
+            if ret.time > acked:    # a response queued before the ACK was handled has no usable round trip
+                rtt.add('response', dest, ret.time - acked)
             if publish == True:
                 publish_status(ret)
         except queue.Empty:
-            pass
+            rtt.timed_out('response', dest)
     wait_target.get()
     #logging.debug('exiting send_wait_response :'+dest)
     return ret
 
 
+class LightBatcher:
+    """Merges light on/off commands for the same room into a single state frame.
+
+    Commands arriving within `window` seconds of the first one for a room are
+    collected, then the room's current light value is updated with all of them
+    and sent once. window=0 sends immediately on the caller's thread.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = {}         # light dev_id (e.g. 0e00) -> {light number: 'ff'/'00'}
+        self.traces = {}          # light dev_id -> latency trace of the first merged command
+
+    def add(self, dev_id, changes):
+        trace = tracer.command_take() if tracer is not None else None
+        with self.lock:
+            room = self.pending.get(dev_id)
+            if room is not None:
+                room.update(changes)
+                return
+            self.pending[dev_id] = dict(changes)
+            if trace is not None:
+                self.traces[dev_id] = trace
+        if self.window > 0:
+            threading.Timer(self.window, self.flush, args=(dev_id,)).start()
+        else:
+            self.flush(dev_id)
+
+    def flush(self, dev_id):
+        with self.lock:
+            changes = self.pending.pop(dev_id, None)
+            trace = self.traces.pop(dev_id, None)
+        if changes is None:
+            return
+        if trace is not None:
+            tracer.command_resume(trace + [('merged', time.time())])
+        # build the command from the room's bitmap: a fresh one from the store, otherwise read
+        # it from the bus first so a restored or pre-reconnect bitmap never switches other lights
+        known, stale = state_store.peek(dev_id)
+        if known is not None and not stale:
+            value = known.value
+        else:
+            current = query(dev_id)
+            if current.flag != False:
+                value = current.value
+            elif known is not None:
+                logging.warning('[LIGHT] {} did not answer, building the command from its last known state'.format(dev_id))
+                value = known.value
+            else:
+                value = current.value
+        for n, onoff_hex in sorted(changes.items()):
+            value = value[:n*2-2] + onoff_hex + value[n*2:]
+        logging.info(f'[BATCH_DEBUG] Sending light packet - dest: {dev_id}, src: {settings.light_controller_addr}, value: {value}')
+        send_wait_response(dest=dev_id, src=settings.light_controller_addr, value=value, log='light')
+
+        # the light's ACK refreshes the store; have the poller re-read the room if it didn't
+        if state_store.get(dev_id) is None:
+            poll_scheduler.refresh(dev_id)
+
+        # 덕계역금강펜트리움: 조명 제어 후 일괄소등 자동 활성화 방지
+        # 309c 패킷을 5초간 연속 전송하여 일괄소등 해제 유지
+        logging.info(f'[BATCH_DEBUG] Starting batch_off keepalive to prevent auto-activation')
+        batch_keepalive.extend(duration=5)
+
+
 #===== elevator call via TCP/IP =====
 
 def call_elevator_tcpip():
@@ -589,254 +1758,412 @@ def call_elevator_tcpip():
 
 #===== parse MQTT --> send hex packet =====
 
-def mqtt_on_message(mqttc, obj, msg):
-    command = msg.payload.decode('ascii')
-    topic_d = msg.topic.split('/')
+class CommandRouter:
+    """Maps MQTT command topics to their handler with the device address resolved.
 
-    # do not process other than command topic
-    if topic_d[-1] != 'command':
-        return
+    Topics are registered from the discovery configs, so only the command topics
+    Home Assistant was told about are subscribed instead of kocom/#. Light rooms
+    subscribe with a + wildcard since several lights can be switched at once
+    (kocom/livingroom/light/12/command); such topics are resolved on first use
+    and cached like the registered ones.
+    """
+    def __init__(self, patterns):
+        self.patterns = [(re.compile(p), handler, args, wildcard) for p, handler, args, wildcard in patterns]
+        self.routes = {}        # topic -> (handler, args)
+        self.filters = {}       # subscription filters, in registration order
+
+    def compile(self, topic):
+        for regex, handler, args, wildcard in self.patterns:
+            m = regex.fullmatch(topic)
+            if m is None:
+                continue
+            resolved = args(m)
+            if resolved is None:
+                return None, None
+            return (handler, resolved), (wildcard.format(*m.groups()) if wildcard else topic)
+        return None, None
+
+    def add(self, topic):
+        route, topic_filter = self.compile(topic)
+        if route is None:
+            logging.warning('[MQTT] no command handler for {}'.format(topic))
+            return
+        self.routes[topic] = route
+        self.filters[topic_filter] = True
+
+    def resolve(self, topic):
+        route = self.routes.get(topic)
+        if route is None and any(mqtt.topic_matches_sub(f, topic) for f in self.filters):
+            route = self.compile(topic)[0]
+            if route is not None:
+                self.routes[topic] = route
+        return route
+
+    def subscribe(self, client):
+        if self.filters:
+            client.subscribe([(f, 0) for f in self.filters])
+
+
+class CommandExecutor:
+    """Runs MQTT command handlers off the paho network thread.
+
+    Commands queue per device address and run in arrival order, one at a time
+    per device on a few worker threads; different devices run side by side and
+    still take turns on the bus through send(). A command for a topic that is
+    still waiting replaces the queued one (latest wins), so dragging a set_temp
+    slider sends only the last value.
+    """
+    def __init__(self, workers=COMMAND_WORKERS):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.ready = queue.Queue()  # devices with queued commands and no worker on them yet
+        self.queues = {}        # device address -> OrderedDict of topic -> (handler, args, command, stamps)
+        self.running = set()    # devices handed to a worker
+        self.depth = 0
+        self.high_water = 0
+        self.collapsed = 0
+        self.executed = 0
+
+    def submit(self, key, topic, handler, args, command, stamps=None):
+        with self.lock:
+            q = self.queues.setdefault(key, collections.OrderedDict())
+            if q.pop(topic, None) is not None:
+                self.collapsed += 1
+                logging.info('[COMMAND] {} replaced by a newer command'.format(topic))
+            else:
+                self.depth += 1
+                self.high_water = max(self.high_water, self.depth)
+            q[topic] = (handler, args, command, stamps)     # the latest command keeps its place in the order
+            if key not in self.running:
+                self.running.add(key)
+                self.ready.put(key)
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self.run, name='command_{}'.format(i), daemon=True).start()
+
+    def run(self):
+        bus_ready.wait()    # commands that arrive while RS485 is still connecting wait for it
+        while True:
+            self.drain(self.ready.get())
 
-    logging.info("[MQTT RECV] " + msg.topic + " " + str(msg.qos) + " " + str(msg.payload))
+    def drain(self, key):
+        while True:
+            with self.lock:
+                q = self.queues[key]
+                if not q:
+                    del self.queues[key]
+                    self.running.discard(key)
+                    return
+                topic, (handler, args, command, stamps) = q.popitem(last=False)
+                self.depth -= 1
+            if stamps is not None:
+                stamps.append(('started', time.time()))
+                tracer.command_resume(stamps)
+            try:
+                handler(command, *args)
+            except Exception as e:
+                logging.exception('[COMMAND] {} failed : {}'.format(topic, e))
+            self.executed += 1
 
-    # thermo heat/off : kocom/room/thermo/3/heat_mode/command
-    if 'thermo' in topic_d and 'heat_mode' in topic_d:
-        thermo_cfg = packet_config['parsing']['thermo']
-        heatmode_dic = {'heat': thermo_cfg['heat_mode_on'], 'off': thermo_cfg['heat_mode_off']}
-
-        dev_id = device_h_dic['thermo']+'{0:02x}'.format(int(topic_d[3]))
-        q = query(dev_id)
-        settemp_hex = '{0:02x}'.format(int(config.get('User', 'thermo_init_temp'))) if q['flag']!=False else '14'
-        value = heatmode_dic.get(command) + '00' + settemp_hex + '0000000000'
-        send_wait_response(dest=dev_id, value=value, log='thermo heatmode')
-
-    # thermo set temp : kocom/room/thermo/3/set_temp/command
-    elif 'thermo' in topic_d and 'set_temp' in topic_d:
-        thermo_cfg = packet_config['parsing']['thermo']
-        dev_id = device_h_dic['thermo']+'{0:02x}'.format(int(topic_d[3]))
-        settemp_hex = '{0:02x}'.format(int(float(command)))
-
-        value = thermo_cfg['heat_mode_on'] + '00' + settemp_hex + '0000000000'
-        send_wait_response(dest=dev_id, value=value, log='thermo settemp')
-
- # 2023.08 AC 추가
-    elif 'ac' in topic_d and 'ac_mode' in topic_d:
-        ac_cfg = packet_config['parsing']['ac']
-        is_on = ac_cfg['state_on'] if command != 'off' else ac_cfg['state_off']
-        acmode_dic = {mode: code for code, mode in ac_cfg['modes'].items()}
-        acmode_dic['off'] = '00'  # off mode uses cool mode code
-        dev_id = device_h_dic['ac']+'{0:02x}'.format(int(topic_d[3]))
-        #q = query(dev_id)
-        #settemp_hex = '{0:02x}'.format(int(config.get('User', 'ac_init_temp'))) if q['flag'] != False else '12'
-
-        value = is_on + acmode_dic.get(command, config.get('User', 'ac_init_mode')) + '000000000000'
-        send_wait_response(dest=dev_id, value=value, log='ac mode')
-
-    elif 'ac' in topic_d and 'fan_mode' in topic_d:
-        ac_cfg = packet_config['parsing']['ac']
-        fan_dic = {speed: code for code, speed in ac_cfg['fan_speeds'].items()}
-        dev_id = device_h_dic['ac']+'{0:02x}'.format(int(topic_d[3]))
-        #q = query(dev_id)
-        #settemp_hex = '{0:02x}'.format(int(config.get('User', 'ac_init_temp'))) if q['flag'] != False else '12'
-
-        value = '1010' + fan_dic.get(command, config.get('User', 'ac_init_fan_mode')) + '0000000000'
-        send_wait_response(dest=dev_id, value=value, log='ac mode')
-        
-    # ac set temp : kocom/room/ac/3/set_temp/command
-    elif 'ac' in topic_d and 'set_temp' in topic_d:
-        ac_cfg = packet_config['parsing']['ac']
-        dev_id = device_h_dic['ac']+'{0:02x}'.format(int(topic_d[3]))
-        settemp_hex = '{0:02x}'.format(int(float(command)))
-
-        value = ac_cfg['state_on'] + '10000000' + settemp_hex + '0000'
-        send_wait_response(dest=dev_id, value=value, log='ac settemp')
- 
- 
-    # light on/off : kocom/livingroom/light/1/command
-    elif 'light' in topic_d:
-        dev_id = device_h_dic['light'] + room_h_dic.get(topic_d[1])
-        light_id = int(topic_d[3])
-
-        # 방별 조명 개수 확인 (덕계역금강펜트리움 전용)
-        room_code = room_h_dic.get(topic_d[1])
-        max_lights = packet_config.get('room_lights', {}).get(room_code, 4)
-
-        # 유효하지 않은 조명 번호는 무시
-        if light_id > max_lights:
-            logging.warning(f'[LIGHT] Invalid light number {light_id} for room {topic_d[1]} (max: {max_lights}) - ignored')
-            return
 
-        value = query(dev_id)['value']
-        onoff_hex = 'ff' if command == 'on' else '00'
+def room_device(dev):
+    """Route args for kocom/<room>/<dev>/... topics : the device address in that room"""
+    def args(m):
+        room_code = room_h_dic.get(m[1])
+        return None if room_code is None else (device_h_dic[dev] + room_code,)
+    return args
 
-        # 일괄소등 디버깅: 조명 제어 시작 로깅
-        logging.info(f'[BATCH_DEBUG] Light control start - Room: {topic_d[1]}, Light: {light_id}, Command: {command}')
 
-        # turn on/off multiple lights at once : e.g) kocom/livingroom/light/12/command
-        if light_id > 0:
-            while light_id > 0:
-                n = light_id % 10
-                value = value[:n*2-2] + onoff_hex + value[n*2:]
-                logging.info(f'[BATCH_DEBUG] Sending light packet - dest: {dev_id}, src: {light_controller_addr}, value: {value}')
-                send_wait_response(dest=dev_id, src=light_controller_addr, value=value, log='light')
-                light_id = int(light_id/10)
-        else:
-            logging.info(f'[BATCH_DEBUG] Sending light packet - dest: {dev_id}, src: {light_controller_addr}, value: {value}')
-            send_wait_response(dest=dev_id, src=light_controller_addr, value=value, log='light')
+def numbered_device(dev):
+    """Route args for kocom/room/<dev>/<num>/... topics"""
+    return lambda m: (device_h_dic[dev] + '{0:02x}'.format(int(m[1])),)
 
-        # 덕계역금강펜트리움: 조명 제어 후 일괄소등 자동 활성화 방지
-        # 309c 패킷을 5초간 연속 전송하여 일괄소등 해제 유지
-        logging.info(f'[BATCH_DEBUG] Starting batch_off_continuous to prevent auto-activation')
-        send_batch_off_continuous(duration=5)
-
-    # gas off : kocom/livingroom/gas/command
-    elif 'gas' in topic_d:
-        dev_id = device_h_dic['gas'] + room_h_dic.get(topic_d[1])
-        if command == 'off':
-            send_wait_response(dest=dev_id, cmd=cmd_h_dic.get(command), log='gas')
-        else:
-            logging.info('You can only turn off gas.')
-
-    # elevator on/off : kocom/myhome/elevator/command
-    elif 'elevator' in topic_d:
-        dev_id = device_h_dic['elevator'] + room_h_dic.get(topic_d[1])
-        state_on = json.dumps({'state': 'on'})
-        state_off = json.dumps({'state': 'off'})
-        if command == 'on':
-            ret_elevator = None
-            if config.get('Elevator', 'type', fallback='rs485') == 'rs485':
-                ret_elevator = send(dest=device_h_dic['wallpad']+'00', src=dev_id, cmd=cmd_h_dic['on'], value='0'*16, log='elevator', check_ack=False)
-            elif config.get('Elevator', 'type', fallback='rs485') == 'tcpip':
-                ret_elevator = call_elevator_tcpip()
-
-            if ret_elevator == False:
-                logging.debug('elevator send failed')
-                return
 
-            threading.Thread(target=mqttc.publish, args=("kocom/myhome/elevator/state", state_on)).start()
-            if config.get('Elevator', 'rs485_floor', fallback=None) == None:
-                threading.Timer(5, mqttc.publish, args=("kocom/myhome/elevator/state", state_off)).start()
+def light_route(m):
+    room_code = room_h_dic.get(m[1])
+    if room_code is None:
+        return None
+    # 방별 조명 개수 확인 (덕계역금강펜트리움 전용)
+    max_lights = packet_config.get('room_lights', {}).get(room_code, 4)
+    return device_h_dic['light'] + room_code, m[1], m[2], max_lights
 
-        elif command == 'off':
-            threading.Thread(target=mqttc.publish, args=("kocom/myhome/elevator/state", state_off)).start()
 
-    # all lights control : kocom/myhome/batch/command
-    elif 'batch' in topic_d:
-        batch_on_packet = packet_config['special_packets']['batch_on']['hex']
-        batch_off_packet = packet_config['special_packets']['batch_off']['hex']
-        state_on = json.dumps({'state': 'on'})
-        state_off = json.dumps({'state': 'off'})
+# thermo heat/off : kocom/room/thermo/3/heat_mode/command
+def handle_thermo_heat_mode(command, dev_id):
+    thermo_cfg = packet_config['parsing']['thermo']
+    heatmode_dic = {'heat': thermo_cfg['heat_mode_on'], 'off': thermo_cfg['heat_mode_off']}
 
-        if command == 'on':
-            # All Lights ON - Disable batch mode (일괄소등 해제 = 모든 조명 켜기 가능)
-            try:
-                rs485.write(bytearray.fromhex(batch_off_packet))
-                logging.info('[ALL LIGHTS] ON - Batch mode disabled, lights can be turned on')
-                threading.Thread(target=mqttc.publish, args=("kocom/myhome/batch/state", state_on)).start()
-            except Exception as e:
-                logging.error(f'[ALL LIGHTS] ON failed: {e}')
+    q = query(dev_id)
+    settemp_hex = '{0:02x}'.format(settings.thermo_init_temp) if q.flag!=False else '14'
+    value = heatmode_dic.get(command) + '00' + settemp_hex + '0000000000'
+    send_wait_response(dest=dev_id, value=value, log='thermo heatmode')
 
-        elif command == 'off':
-            # All Lights OFF - Turn off all lights (일괄소등 활성화 = 모든 조명 끄기)
-            try:
-                rs485.write(bytearray.fromhex(batch_on_packet))
-                logging.info('[ALL LIGHTS] OFF - All lights turned off')
-                threading.Thread(target=mqttc.publish, args=("kocom/myhome/batch/state", state_off)).start()
-            except Exception as e:
-                logging.error(f'[ALL LIGHTS] OFF failed: {e}')
-
-    # kocom/livingroom/fan/set_preset_mode/command
-    elif 'fan' in topic_d and 'set_preset_mode' in topic_d:
-        fan_cfg = packet_config['parsing']['fan']
-        dev_id = device_h_dic['fan'] + room_h_dic.get(topic_d[1])
-        onoff_dic = {'off': fan_cfg['state_off'], 'on': fan_cfg['state_on']}
-        speed_dic = {preset: code for code, preset in fan_cfg['presets'].items()}
-        speed_dic['Off'] = '00'  # Off preset uses 00 speed code
-        if command == 'Off':
-            onoff = onoff_dic['off']
-        elif command in speed_dic.keys(): # fan on with specified speed
-            onoff = onoff_dic['on']
-
-        speed = speed_dic.get(command)
-        value = onoff + speed + '0'*10
-        send_wait_response(dest=dev_id, value=value, log='fan')
-
-        # Immediately publish expected state to prevent HA from reverting
-        fan_state = 'off' if command == 'Off' else 'on'
-        fan_preset = command
-        state_data = json.dumps({'state': fan_state, 'preset': fan_preset})
-        threading.Thread(target=mqttc.publish, args=("kocom/livingroom/fan/state", state_data)).start()
-        logging.info(f'[FAN] Preset mode set to {command} - Published state: {fan_state}, preset: {fan_preset}')
-
-    # kocom/livingroom/fan/command
-    elif 'fan' in topic_d:
-        fan_cfg = packet_config['parsing']['fan']
-        dev_id = device_h_dic['fan'] + room_h_dic.get(topic_d[1])
-        onoff_dic = {'off': fan_cfg['state_off'], 'on': fan_cfg['state_on']}
-        speed_dic = {preset: code for code, preset in fan_cfg['presets'].items()}
-        init_fan_mode = config.get('User', 'init_fan_mode')
-        if command in onoff_dic.keys(): # fan on off with previous speed
-            onoff = onoff_dic.get(command)
-            speed = speed_dic.get(init_fan_mode)  #value = query(dev_id)['value']  #speed = value[4:6]
-
-        value = onoff + speed + '0'*10
-        send_wait_response(dest=dev_id, value=value, log='fan')
-
-        # Immediately publish expected state to prevent HA from reverting
-        fan_state = command  # 'on' or 'off'
-        fan_preset = 'Off' if command == 'off' else init_fan_mode
-        state_data = json.dumps({'state': fan_state, 'preset': fan_preset})
-        threading.Thread(target=mqttc.publish, args=("kocom/livingroom/fan/state", state_data)).start()
-        logging.info(f'[FAN] State set to {command} - Published state: {fan_state}, preset: {fan_preset}')
-
-    # kocom/myhome/query/command
-    elif 'query' in topic_d:
-        if command == 'PRESS':
-            poll_state(enforce=True)
 
+# thermo set temp : kocom/room/thermo/3/set_temp/command
+def handle_thermo_set_temp(command, dev_id):
+    thermo_cfg = packet_config['parsing']['thermo']
+    settemp_hex = '{0:02x}'.format(int(float(command)))
 
-#===== parse hex packet --> publish MQTT =====
+    value = thermo_cfg['heat_mode_on'] + '00' + settemp_hex + '0000000000'
+    send_wait_response(dest=dev_id, value=value, log='thermo settemp')
 
-def publish_status(p):
-    threading.Thread(target=packet_processor, args=(p,)).start()
 
-def packet_processor(p):
-    logtxt = ""
+# 2023.08 AC 추가
+# ac mode : kocom/room/ac/3/ac_mode/command
+def handle_ac_mode(command, dev_id):
+    ac_cfg = packet_config['parsing']['ac']
+    is_on = ac_cfg['state_on'] if command != 'off' else ac_cfg['state_off']
+    acmode_dic = {mode: code for code, mode in ac_cfg['modes'].items()}
+    acmode_dic['off'] = '00'  # off mode uses cool mode code
+    #q = query(dev_id)
+    #settemp_hex = '{0:02x}'.format(int(config.get('User', 'ac_init_temp'))) if q.flag != False else '12'
 
-    # 일괄소등 디버깅: batch device 패킷 감지
-    if p['src'] == 'batch' or p['dest'] == 'batch' or p['src_h'][:2] == '54' or p['dest_h'][:2] == '54':
-        logging.warning(f'[BATCH_DEBUG] Batch packet detected!')
-        logging.warning(f'[BATCH_DEBUG]   Type: {p["type"]}, Src: {p["src"]}({p["src_h"]}), Dest: {p["dest"]}({p["dest_h"]})')
-        logging.warning(f'[BATCH_DEBUG]   Cmd: {p["cmd"]}({p["cmd_h"]}), Value: {p["value"]}')
-        logging.warning(f'[BATCH_DEBUG]   Full packet: {p["header_h"]}{p["data_h"]}{p["chksum_h"]}{p["trailer_h"]}')
-
-    if p['type'] == 'send' and p['dest'] == 'wallpad':  # response packet to wallpad
-        if p['src'] == 'thermo' and p['cmd'] == 'state':
-            state = thermo_parse(p['value'])
-            logtxt='[MQTT publish|thermo] id[{}] data[{}]'.format(p['src_subid'], state)
-            mqttc.publish("kocom/room/thermo/" + p['src_subid'] + "/state", json.dumps(state))
-        elif p['src'] == 'ac' and p['cmd'] == 'state':
-            state = ac_parse(p['value'])
-            logtxt = '[MQTT publish|ac] id[{}] data[{}]'.format(p['src_subid'], state)
-            mqttc.publish('kocom/room/ac/' + p['src_subid'] + '/state', json.dumps(state), retain=True)
-        elif p['src'] == 'light' and p['cmd'] == 'state':
-            state = light_parse(p['value'])
-            logtxt='[MQTT publish|light] room[{}] data[{}]'.format(p['src_room'], state)
-            mqttc.publish("kocom/{}/light/state".format(p['src_room']), json.dumps(state))
-        elif p['src'] == 'fan' and p['cmd'] == 'state':
-            state = fan_parse(p['value'])
+    value = is_on + acmode_dic.get(command, settings.ac_init_mode) + '000000000000'
+    send_wait_response(dest=dev_id, value=value, log='ac mode')
+
+
+# ac fan speed : kocom/room/ac/3/fan_mode/command
+def handle_ac_fan_mode(command, dev_id):
+    ac_cfg = packet_config['parsing']['ac']
+    fan_dic = {speed: code for code, speed in ac_cfg['fan_speeds'].items()}
+    #q = query(dev_id)
+    #settemp_hex = '{0:02x}'.format(int(config.get('User', 'ac_init_temp'))) if q.flag != False else '12'
+
+    value = '1010' + fan_dic.get(command, settings.ac_init_fan_mode) + '0000000000'
+    send_wait_response(dest=dev_id, value=value, log='ac mode')
+
+
+# ac set temp : kocom/room/ac/3/set_temp/command
+def handle_ac_set_temp(command, dev_id):
+    ac_cfg = packet_config['parsing']['ac']
+    settemp_hex = '{0:02x}'.format(int(float(command)))
+
+    value = ac_cfg['state_on'] + '10000000' + settemp_hex + '0000'
+    send_wait_response(dest=dev_id, value=value, log='ac settemp')
+
+
+# light on/off : kocom/livingroom/light/1/command
+def handle_light(command, dev_id, room, light_digits, max_lights):
+    light_id = int(light_digits)
+
+    # 유효하지 않은 조명 번호는 무시
+    if any(int(n) > max_lights for n in light_digits):
+        logging.warning(f'[LIGHT] Invalid light number {light_id} for room {room} (max: {max_lights}) - ignored')
+        return
+
+    onoff_hex = 'ff' if command == 'on' else '00'
+
+    # 일괄소등 디버깅: 조명 제어 시작 로깅
+    logging.info(f'[BATCH_DEBUG] Light control start - Room: {room}, Light: {light_id}, Command: {command}')
+
+    # turn on/off multiple lights at once : e.g) kocom/livingroom/light/12/command
+    # all digits go into one state frame, merged with other commands for the room within light_merge_window
+    changes = {}
+    while light_id > 0:
+        if light_id % 10 != 0:
+            changes[light_id % 10] = onoff_hex
+        light_id = int(light_id/10)
+    light_batcher.add(dev_id, changes)
+
+
+# gas off : kocom/livingroom/gas/command
+def handle_gas(command, dev_id):
+    if command == 'off':
+        send_wait_response(dest=dev_id, cmd=cmd_h_dic.get(command), log='gas')
+    else:
+        logging.info('You can only turn off gas.')
+
+
+# elevator on/off : kocom/myhome/elevator/command
+def handle_elevator(command, dev_id):
+    state_on = json.dumps({'state': 'on'})
+    state_off = json.dumps({'state': 'off'})
+    if command == 'on':
+        ret_elevator = None
+        if settings.elevator_type == 'rs485':
+            ret_elevator = send(dest=device_h_dic['wallpad']+'00', src=dev_id, cmd=cmd_h_dic['on'], value='0'*16, log='elevator', check_ack=False)
+        elif settings.elevator_type == 'tcpip':
+            ret_elevator = call_elevator_tcpip()
+
+        if ret_elevator == False:
+            logging.debug('elevator send failed')
+            return
+
+        publisher.publish("kocom/myhome/elevator/state", state_on)
+        if settings.elevator_rs485_floor == None:
+            threading.Timer(5, publisher.publish, args=("kocom/myhome/elevator/state", state_off)).start()
+
+    elif command == 'off':
+        publisher.publish("kocom/myhome/elevator/state", state_off)
+
+
+# all lights control : kocom/myhome/batch/command
+def handle_batch(command):
+    batch_on_packet = packet_config['special_packets']['batch_on']['hex']
+    batch_off_packet = packet_config['special_packets']['batch_off']['hex']
+    state_on = json.dumps({'state': 'on'})
+    state_off = json.dumps({'state': 'off'})
+
+    if command == 'on':
+        # All Lights ON - Disable batch mode (일괄소등 해제 = 모든 조명 켜기 가능)
+        try:
+            rs485.write(bytearray.fromhex(batch_off_packet))
+            logging.info('[ALL LIGHTS] ON - Batch mode disabled, lights can be turned on')
+            publisher.publish("kocom/myhome/batch/state", state_on)
+        except Exception as e:
+            logging.error(f'[ALL LIGHTS] ON failed: {e}')
+
+    elif command == 'off':
+        # All Lights OFF - Turn off all lights (일괄소등 활성화 = 모든 조명 끄기)
+        try:
+            rs485.write(bytearray.fromhex(batch_on_packet))
+            logging.info('[ALL LIGHTS] OFF - All lights turned off')
+            publisher.publish("kocom/myhome/batch/state", state_off)
+        except Exception as e:
+            logging.error(f'[ALL LIGHTS] OFF failed: {e}')
+
+
+# kocom/livingroom/fan/set_preset_mode/command
+def handle_fan_preset(command, dev_id):
+    fan_cfg = packet_config['parsing']['fan']
+    onoff_dic = {'off': fan_cfg['state_off'], 'on': fan_cfg['state_on']}
+    speed_dic = {preset: code for code, preset in fan_cfg['presets'].items()}
+    speed_dic['Off'] = '00'  # Off preset uses 00 speed code
+    if command == 'Off':
+        onoff = onoff_dic['off']
+    elif command in speed_dic.keys(): # fan on with specified speed
+        onoff = onoff_dic['on']
+
+    speed = speed_dic.get(command)
+    value = onoff + speed + '0'*10
+    send_wait_response(dest=dev_id, value=value, log='fan')
+
+    # Immediately publish expected state to prevent HA from reverting
+    fan_state = 'off' if command == 'Off' else 'on'
+    fan_preset = command
+    state_data = json.dumps({'state': fan_state, 'preset': fan_preset})
+    publisher.publish("kocom/livingroom/fan/state", state_data)
+    logging.info(f'[FAN] Preset mode set to {command} - Published state: {fan_state}, preset: {fan_preset}')
+
+
+# kocom/livingroom/fan/command
+def handle_fan(command, dev_id):
+    fan_cfg = packet_config['parsing']['fan']
+    onoff_dic = {'off': fan_cfg['state_off'], 'on': fan_cfg['state_on']}
+    speed_dic = {preset: code for code, preset in fan_cfg['presets'].items()}
+    init_fan_mode = settings.init_fan_mode
+    if command in onoff_dic.keys(): # fan on off with previous speed
+        onoff = onoff_dic.get(command)
+        speed = speed_dic.get(init_fan_mode)  #value = query(dev_id).value  #speed = value[4:6]
+
+    value = onoff + speed + '0'*10
+    send_wait_response(dest=dev_id, value=value, log='fan')
+
+    # Immediately publish expected state to prevent HA from reverting
+    fan_state = command  # 'on' or 'off'
+    fan_preset = 'Off' if command == 'off' else init_fan_mode
+    state_data = json.dumps({'state': fan_state, 'preset': fan_preset})
+    publisher.publish("kocom/livingroom/fan/state", state_data)
+    logging.info(f'[FAN] State set to {command} - Published state: {fan_state}, preset: {fan_preset}')
+
+
+# kocom/myhome/query/command
+def handle_query(command):
+    if command == 'PRESS':
+        poll_scheduler.poll_all()
+
+
+# topic pattern, handler, route args from the match, subscription filter (None = the topic itself)
+COMMAND_PATTERNS = [
+    (r'kocom/room/thermo/(\d+)/heat_mode/command', handle_thermo_heat_mode, numbered_device('thermo'), None),
+    (r'kocom/room/thermo/(\d+)/set_temp/command', handle_thermo_set_temp, numbered_device('thermo'), None),
+    (r'kocom/room/ac/(\d+)/ac_mode/command', handle_ac_mode, numbered_device('ac'), None),
+    (r'kocom/room/ac/(\d+)/fan_mode/command', handle_ac_fan_mode, numbered_device('ac'), None),
+    (r'kocom/room/ac/(\d+)/set_temp/command', handle_ac_set_temp, numbered_device('ac'), None),
+    (r'kocom/([^/]+)/light/(\d+)/command', handle_light, light_route, 'kocom/{0}/light/+/command'),
+    (r'kocom/([^/]+)/gas/command', handle_gas, room_device('gas'), None),
+    (r'kocom/([^/]+)/elevator/command', handle_elevator, room_device('elevator'), None),
+    (r'kocom/myhome/batch/command', handle_batch, lambda m: (), None),
+    (r'kocom/([^/]+)/fan/set_preset_mode/command', handle_fan_preset, room_device('fan'), None),
+    (r'kocom/([^/]+)/fan/command', handle_fan, room_device('fan'), None),
+    (r'kocom/myhome/query/command', handle_query, lambda m: (), None),
+]
+command_router = CommandRouter(COMMAND_PATTERNS)
+
+
+def mqtt_on_message(mqttc, obj, msg):
+    route = command_router.resolve(msg.topic)
+    if route is None:
+        return
+    stamps = [('mqtt', time.time())] if tracer is not None else None
+    command = msg.payload.decode('ascii')
+
+    logging.info("[MQTT RECV] " + msg.topic + " " + str(msg.qos) + " " + str(msg.payload))
+
+    # handlers block on bus round trips, so they run on the executor, queued per device
+    handler, args = route
+    command_executor.submit(args[0] if args else msg.topic, msg.topic, handler, args, command, stamps)
+
+
+#===== parse hex packet --> publish MQTT =====
+
+def publish_status(p):
+    publisher.submit(packet_processor, p)
+
+def packet_processor(p):
+    logtxt = ""
+    if p.stamps is not None:
+        p.stamps.append(('publisher', time.time()))
+
+    # 일괄소등 디버깅: batch device 패킷 감지
+    p_type, p_src, p_dest, p_cmd = p.type, p.src, p.dest, p.cmd
+    if p_src == 'batch' or p_dest == 'batch' or p.raw[7] == 0x54 or p.raw[5] == 0x54:
+        logging.warning(f'[BATCH_DEBUG] Batch packet detected!')
+        logging.warning(f'[BATCH_DEBUG]   Type: {p_type}, Src: {p_src}({p.src_h}), Dest: {p_dest}({p.dest_h})')
+        logging.warning(f'[BATCH_DEBUG]   Cmd: {p_cmd}({p.cmd_h}), Value: {p.value}')
+        logging.warning(f'[BATCH_DEBUG]   Full packet: {p.hex}')
+
+    if p_type == 'send' and p_dest == 'wallpad':  # response packet to wallpad
+        dev, dev_subid, dev_room = p_src, p.src_subid, p.src_room
+    elif settings.passive_state and p_cmd == 'state' and state_device(p) is not None:
+        # passive mode: state reports to other controllers, light ACKs and the wallpad's ACK echoes
+        if p_src == 'wallpad':
+            dev, dev_subid, dev_room = p_dest, p.dest_subid, p.dest_room
+        else:
+            dev, dev_subid, dev_room = p_src, p.src_subid, p.src_room
+        if dev not in STATE_DEVICES:
+            dev = None
+    else:
+        dev = None
+
+    if dev is not None:
+        if dev == 'thermo' and p_cmd == 'state':
+            state = thermo_parse(p.value)
+            logtxt='[MQTT publish|thermo] id[{}] data[{}]'.format(dev_subid, state)
+            publisher.publish_state("kocom/room/thermo/" + dev_subid + "/state", json.dumps(state))
+        elif dev == 'ac' and p_cmd == 'state':
+            state = ac_parse(p.value)
+            logtxt = '[MQTT publish|ac] id[{}] data[{}]'.format(dev_subid, state)
+            publisher.publish_state('kocom/room/ac/' + dev_subid + '/state', json.dumps(state), retain=True)
+        elif dev == 'light' and p_cmd == 'state':
+            state = light_parse(p.value)
+            logtxt='[MQTT publish|light] room[{}] data[{}]'.format(dev_room, state)
+            publisher.publish_state("kocom/{}/light/state".format(dev_room), json.dumps(state))
+        elif dev == 'fan' and p_cmd == 'state':
+            state = fan_parse(p.value)
             logtxt='[MQTT publish|fan] data[{}]'.format(state)
-            mqttc.publish("kocom/livingroom/fan/state", json.dumps(state))
-        elif p['src'] == 'gas':
-            state = {'state': p['cmd']}
+            publisher.publish_state("kocom/livingroom/fan/state", json.dumps(state))
+        elif dev == 'gas':
+            state = {'state': p_cmd}
             logtxt='[MQTT publish|gas] data[{}]'.format(state)
-            mqttc.publish("kocom/livingroom/gas/state", json.dumps(state))
-        elif p['src'] == 'batch':
+            publisher.publish_state("kocom/livingroom/gas/state", json.dumps(state))
+        elif dev == 'batch':
             # 일괄소등 디버깅: batch device 상태 변경 감지
-            logging.warning(f'[BATCH_DEBUG] Batch state packet - Cmd: {p["cmd"]}, Value: {p["value"]}')
-    elif p['type'] == 'send' and p['dest'] == 'elevator':
-        floor = int(p['value'][2:4],16)
-        rs485_floor = int(config.get('Elevator','rs485_floor', fallback=0))
+            logging.warning(f'[BATCH_DEBUG] Batch state packet - Cmd: {p_cmd}, Value: {p.value}')
+    elif p_type == 'send' and p_dest == 'elevator':
+        floor = int(p.value[2:4],16)
+        rs485_floor = settings.elevator_rs485_floor or 0
         if rs485_floor != 0 :
             state = {'floor': floor}
             if rs485_floor == floor:
@@ -844,17 +2171,19 @@ def packet_processor(p):
         else:
             state = {'state': 'off'}
         logtxt='[MQTT publish|elevator] data[{}]'.format(state)
-        mqttc.publish("kocom/myhome/elevator/state", json.dumps(state))
+        publisher.publish_state("kocom/myhome/elevator/state", json.dumps(state))
         # aa5530bc0044000100010300000000000000350d0d
 
-    if logtxt != "" and config.get('Log', 'show_mqtt_publish') == 'True':
+    if logtxt != "" and p.stamps is not None:
+        tracer.finish('frame', p.stamps + [('published', time.time())])
+    if logtxt != "" and settings.show_mqtt_publish:
         logging.info(logtxt)
 
 
 #===== publish MQTT Devices Discovery =====
 
 def discovery():
-    dev_list = [x.strip() for x in config.get('Device','enabled').split(',')]
+    dev_list = settings.enabled_devices
     for t in dev_list:
         dev = t.split('_')
         sub = ''
@@ -862,10 +2191,19 @@ def discovery():
             sub = dev[1]
         logtxt='[MQTT Discovery|{}] data[{}]'.format(dev[0], sub)
         publish_discovery(dev[0], sub)
-        if logtxt != "" and config.get('Log', 'show_mqtt_discovery') == 'True':
+        if logtxt != "" and settings.show_mqtt_discovery:
             logging.info(logtxt)
     publish_discovery('query')
     publish_discovery('batch')
+    command_router.subscribe(mqttc)
+
+
+def publish_config(topic, payload):
+    """Publish a discovery config and route the command topics it declares"""
+    for key, value in payload.items():
+        if key.endswith('cmd_t'):
+            command_router.add(value)
+    mqttc.publish(topic, json.dumps(payload), retain=True)
 
 #https://www.home-assistant.io/docs/mqtt/discovery/
 #<discovery_prefix>/<component>/<object_id>/config
@@ -895,8 +2233,8 @@ def publish_discovery(dev, sub=''):
             }
         }
         logtxt='[MQTT Discovery|{}] data[{}]'.format(dev, topic)
-        mqttc.publish(topic, json.dumps(payload), retain=True)
-        if logtxt != "" and config.get('Log', 'show_mqtt_publish') == 'True':
+        publish_config(topic, payload)
+        if logtxt != "" and settings.show_mqtt_publish:
             logging.info(logtxt)
     elif dev == 'gas':
         topic = 'homeassistant/switch/kocom_wallpad_gas/config'
@@ -919,8 +2257,8 @@ def publish_discovery(dev, sub=''):
             }
         }
         logtxt='[MQTT Discovery|{}] data[{}]'.format(dev, topic)
-        mqttc.publish(topic, json.dumps(payload), retain=True)
-        if logtxt != "" and config.get('Log', 'show_mqtt_publish') == 'True':
+        publish_config(topic, payload)
+        if logtxt != "" and settings.show_mqtt_publish:
             logging.info(logtxt)
     elif dev == 'elevator':
         topic = 'homeassistant/button/kocom_wallpad_elevator/config'
@@ -940,8 +2278,8 @@ def publish_discovery(dev, sub=''):
             }
         }
         logtxt='[MQTT Discovery|{}] data[{}]'.format(dev, topic)
-        mqttc.publish(topic, json.dumps(payload), retain=True)
-        if logtxt != "" and config.get('Log', 'show_mqtt_publish') == 'True':
+        publish_config(topic, payload)
+        if logtxt != "" and settings.show_mqtt_publish:
             logging.info(logtxt)
     elif dev == 'light':
         # 방별 조명 개수 가져오기
@@ -979,8 +2317,8 @@ def publish_discovery(dev, sub=''):
                 }
             }
             logtxt='[MQTT Discovery|{}{}] data[{}]'.format(dev, num, topic)
-            mqttc.publish(topic, json.dumps(payload), retain=True)
-            if logtxt != "" and config.get('Log', 'show_mqtt_publish') == 'True':
+            publish_config(topic, payload)
+            if logtxt != "" and settings.show_mqtt_publish:
                 logging.info(logtxt)
     elif dev == 'thermo':
         num = int(room_h_dic.get(sub))
@@ -1015,8 +2353,8 @@ def publish_discovery(dev, sub=''):
             }
         }
         logtxt='[MQTT Discovery|{}{}] data[{}]'.format(dev, num, topic)
-        mqttc.publish(topic, json.dumps(payload), retain=True)
-        if logtxt != "" and config.get('Log', 'show_mqtt_publish') == 'True':
+        publish_config(topic, payload)
+        if logtxt != "" and settings.show_mqtt_publish:
             logging.info(logtxt)
     elif dev == 'ac':
         num = int(room_h_dic.get(sub))
@@ -1054,8 +2392,8 @@ def publish_discovery(dev, sub=''):
             }
         }
         logtxt = '[MQTT Discovery|{}{}] data[{}]'.format(dev, sub, topic)
-        mqttc.publish(topic, json.dumps(payload), retain=True)
-        if logtxt != '' and config.get('Log', 'show_mqtt_publish') == 'True':
+        publish_config(topic, payload)
+        if logtxt != '' and settings.show_mqtt_publish:
             logging.info(logtxt)
     elif dev == 'query':
         topic = 'homeassistant/button/kocom_wallpad_query/config'
@@ -1073,8 +2411,8 @@ def publish_discovery(dev, sub=''):
             }
         }
         logtxt='[MQTT Discovery|{}] data[{}]'.format(dev, topic)
-        mqttc.publish(topic, json.dumps(payload), retain=True)
-        if logtxt != "" and config.get('Log', 'show_mqtt_publish') == 'True':
+        publish_config(topic, payload)
+        if logtxt != "" and settings.show_mqtt_publish:
             logging.info(logtxt)
     elif dev == 'batch':
         topic = 'homeassistant/switch/kocom_wallpad_batch/config'
@@ -1097,248 +2435,948 @@ def publish_discovery(dev, sub=''):
             }
         }
         logtxt='[MQTT Discovery|{}] data[{}]'.format(dev, topic)
-        mqttc.publish(topic, json.dumps(payload), retain=True)
-        if logtxt != "" and config.get('Log', 'show_mqtt_publish') == 'True':
+        publish_config(topic, payload)
+        if logtxt != "" and settings.show_mqtt_publish:
             logging.info(logtxt)
 
 
 #===== thread functions =====
 
-def poll_state(enforce=False):
-    global poll_timer
-    poll_timer.cancel()
-
-    dev_list = [x.strip() for x in config.get('Device','enabled').split(',')]
-    no_polling_list = protocol_config.get('no_polling_devices', ['wallpad', 'elevator', 'light'])
-
-    #thread health check
-    for thread_instance in thread_list:
-        if thread_instance.is_alive() == False:
-            logging.error('[THREAD] {} is not active. starting.'.format( thread_instance.name))
-            thread_instance.start()
-
-    for t in dev_list:
-        dev = t.split('_')
-        if dev[0] in no_polling_list:
-            continue
-
-        dev_id = device_h_dic.get(dev[0])
-        if len(dev) > 1:
-            sub_id = room_h_dic.get(dev[1])
-        else:
-            sub_id = '00'
+class PollScheduler:
+    """Polls each device on its own interval instead of sweeping all of them.
+
+    Every polled device starts at polling_interval. A poll or passively seen
+    state that differs from the last one halves the interval (down to
+    poll_interval_min), an unchanged one stretches it by 1.5x (up to
+    poll_interval_max). Seeing a device's state on the bus pushes its next poll
+    out, and commanding a device brings a confirming poll forward. A failed
+    query only backs off that device. Queries wait for poll_idle_gap seconds of
+    bus silence instead of a fixed sleep. refresh() asks for one query of any
+    device, polled or not, on the next round.
+    """
+    def __init__(self, timing):
+        self.interval = timing.get('polling_interval', polling_interval)
+        self.min_interval = timing.get('poll_interval_min', 60)
+        self.max_interval = timing.get('poll_interval_max', 1800)
+        self.idle_gap = timing.get('poll_idle_gap', 0.3)
+        self.cond = threading.Condition()
+        self.entries = {}       # device_h -> {'due', 'interval', 'value', 'seen', 'failures'}
+        self.requested = set()  # devices without an entry (lights) to query once
+        self.polling = None     # device being queried by poll()
+        self.active = 0         # refreshes from our own queries
+        self.passive = 0        # refreshes from other controllers' traffic
+        self.thread = threading.Thread(target=self.run, name='poll_scheduler')
+        self.last_stats = time.time()
+
+    def start(self):
+        self.thread.start()
+
+    def sync_devices(self):
+        """Follow settings.enabled_devices, which may change on reload"""
+        no_polling_list = protocol_config.get('no_polling_devices', ['wallpad', 'elevator', 'light'])
+        devices = [d for d in sorted(enabled_addresses()) if device_t_dic.get(d[:2]) not in no_polling_list]
+        with self.cond:
+            for device_h in devices:
+                if device_h not in self.entries:
+                    self.entries[device_h] = {'due': time.time(), 'interval': self.interval, 'value': None, 'seen': 0, 'failures': 0}
+            for device_h in set(self.entries) - set(devices):
+                del self.entries[device_h]
+
+    def poll_all(self, delay=0):
+        with self.cond:
+            for entry in self.entries.values():
+                entry['due'] = min(entry['due'], time.time() + delay)
+            self.cond.notify()
+
+    def seen(self, device_h, value):
+        """State of a device observed on the bus, from our poll or anyone else's traffic"""
+        with self.cond:
+            entry = self.entries.get(device_h)
+            if entry is None:
+                return
+            now = time.time()
+            if value == entry['value'] and now - entry['seen'] < 1:
+                return      # the wallpad's ACK echoing the report just seen
+            if device_h == self.polling:
+                self.active += 1
+            else:
+                self.passive += 1
+            if entry['value'] is not None:
+                if value != entry['value']:
+                    entry['interval'] = max(self.min_interval, entry['interval'] / 2)
+                else:
+                    entry['interval'] = min(self.max_interval, entry['interval'] * 1.5)
+            entry['value'] = value
+            entry['seen'] = now
+            entry['failures'] = 0
+            entry['due'] = now + entry['interval']
+
+    def commanded(self, device_h):
+        with self.cond:
+            entry = self.entries.get(device_h)
+            if entry is None:
+                return
+            entry['interval'] = self.min_interval
+            entry['due'] = min(entry['due'], time.time() + 5)   # confirm unless the device reports first
+            self.cond.notify()
+
+    def refresh(self, device_h):
+        """Query a device on the next round; repeated requests before then query it once"""
+        with self.cond:
+            entry = self.entries.get(device_h)
+            if entry is not None:
+                entry['due'] = min(entry['due'], time.time())
+            else:
+                self.requested.add(device_h)
+            self.cond.notify()
 
-        if dev_id != None and sub_id != None:
-            if query(dev_id + sub_id, publish=True, enforce=enforce)['flag'] == False:
-                break
-            time.sleep(1)
+    def wait_idle(self):
+        """Wait for a quiet bus, at most a few gaps so a chatty bus still gets polled"""
+        deadline = time.time() + self.idle_gap * 10
+        while True:
+            quiet = time.time() - rs485.last_read_time
+            if quiet >= self.idle_gap or time.time() >= deadline:
+                return
+            time.sleep(self.idle_gap - quiet)
 
-    poll_timer.cancel()
-    poll_timer = threading.Timer(polling_interval, poll_state)
-    poll_timer.start()
+    def poll(self, device_h):
+        self.polling = device_h
+        try:
+            ok = query(device_h, publish=True, enforce=True).flag != False
+        finally:
+            self.polling = None
+        metrics.inc('kocom_polls_total', result='ok' if ok else 'failed')
+        with self.cond:
+            entry = self.entries.get(device_h)
+            if entry is None:
+                return
+            if not ok:
+                entry['failures'] += 1
+                entry['due'] = time.time() + min(entry['interval'], 10 * 2 ** entry['failures'])
+                logging.info('[POLL] {} query failed {} times, retry in {:.0f}s'.format(device_h, entry['failures'], entry['due'] - time.time()))
+            elif entry['due'] <= time.time():   # normally seen() has already rescheduled it
+                entry['due'] = time.time() + entry['interval']
+
+    def run(self):
+        while True:
+            try:
+                self.sync_devices()
+                if engine is None:
+                    #thread health check
+                    for thread_instance in thread_list:
+                        if thread_instance.is_alive() == False:
+                            logging.error('[THREAD] {} is not active. starting.'.format( thread_instance.name))
+                            thread_instance.start()
+
+                with self.cond:
+                    due = sorted((e['due'], d) for d, e in self.entries.items() if e['due'] <= time.time())
+                    due += [(0, d) for d in sorted(self.requested)]
+                    self.requested.clear()
+                started = time.time()
+                for _, device_h in due:
+                    self.wait_idle()
+                    self.poll(device_h)
+                if due:
+                    metrics.observe('kocom_poll_round_seconds', time.time() - started)
+
+                if time.time() - self.last_stats >= polling_interval:
+                    self.last_stats = time.time()
+                    log_stats()
+            except Exception as e:
+                logging.exception('[POLL] scheduler error : {}'.format(e))
+                time.sleep(1)
+
+            with self.cond:
+                next_due = min((e['due'] for e in self.entries.values()), default=time.time() + polling_interval)
+                if not self.requested:
+                    self.cond.wait(max(0, min(next_due - time.time(), polling_interval)))
+
+
+def log_stats():
+    if publisher.high_water > 0:
+        logging.info('[MQTT] publish queue depth {} (high water {}, dropped {}, unchanged suppressed {})'.format(publisher.depth(), publisher.high_water, publisher.dropped, publisher.suppressed))
+    if command_executor.executed > 0:
+        logging.info('[COMMAND] executed {}, queue depth {} (high water {}, collapsed {})'.format(command_executor.executed, command_executor.depth, command_executor.high_water, command_executor.collapsed))
+    for name, entry in rtt.stats().items():
+        logging.info('[RTT] {} {}'.format(name, entry))
+    arbiter = bus_arbiter.stats()
+    if arbiter['writes']:
+        logging.info('[ARBITER] {} writes, retry rate {:.1f}%, collision rate {:.1f}%, avg wait {} ms, exchange gap {} ms, cadence {} ({})'.format(
+            arbiter['writes'], 100 * arbiter['retries'] / arbiter['writes'], 100 * arbiter['collisions'] / arbiter['writes'],
+            arbiter['avg_wait_ms'], arbiter['exchange_gap_ms'],
+            'unsteady' if arbiter['cadence_s'] is None else '{} s'.format(arbiter['cadence_s']), 'on' if bus_arbiter.enabled else 'off'))
+    with poll_scheduler.cond:
+        refreshed = poll_scheduler.active + poll_scheduler.passive
+        if refreshed:
+            logging.info('[POLL] state refreshed passively {}, actively {} ({:.0f}% passive)'.format(poll_scheduler.passive, poll_scheduler.active, 100 * poll_scheduler.passive / refreshed))
+        for device_h, entry in sorted(poll_scheduler.entries.items()):
+            logging.info('[POLL] {} interval {:.0f}s, next in {:.0f}s, failures {}'.format(device_h, entry['interval'], entry['due'] - time.time(), entry['failures']))
 
 
 def read_serial():
-    global poll_timer
-    buf = ''
-    not_parsed_buf = ''
+    scanner = frame_scanner
     while True:
         try:
-            d = rs485.read()
-            hex_d = '{0:02x}'.format(ord(d))
-
-            buf += hex_d
-            if buf[:len(header_h)] != header_h[:len(buf)]:
-                not_parsed_buf += buf
-                buf=''
-                frame_start = not_parsed_buf.find(header_h, len(header_h))
-                if frame_start < 0:
-                    continue
-                else:
-                    not_parsed_buf = not_parsed_buf[:frame_start]
-                    buf = not_parsed_buf[frame_start:]
-
-            if not_parsed_buf != '':
-                logging.info('[comm] not parsed '+not_parsed_buf)
-                not_parsed_buf = ''
-
-
-            if len(buf) == (packet_size * 2):
-                chksum_calc = chksum(buf[len(header_h):chksum_position*2])
-                chksum_buf = buf[chksum_position*2:chksum_position*2+2]
-                if chksum_calc == chksum_buf and buf[-len(trailer_h):] == trailer_h:
-                    if msg_q.full():
-                        logging.error('msg_q is full. probably error occured while running listen_hexdata thread. please manually restart the program.')
-                    msg_q.put(buf)  # valid packet
-                    buf=''
-                else:
-                    logging.info("[comm] invalid packet {} expected checksum {}".format(buf, chksum_calc))
-                    frame_start = buf.find(header_h, len(header_h))
-                    # if there's header packet in the middle of invalid packet, re-parse from that posistion
-                    if frame_start < 0:
-                        not_parsed_buf += buf
-                        buf=''
-                    else:
-                        not_parsed_buf += buf[:frame_start]
-                        buf = buf[frame_start:]
+            data = rs485.read()
+            if bus_capture is not None:
+                bus_capture.write(data)
+            invalid = scanner.invalid
+            for frame in scanner.feed(data):
+                if msg_q.full():
+                    logging.error('msg_q is full. probably error occured while running listen_hexdata thread. please manually restart the program.')
+                msg_q.put((frame, rs485.last_read_time, time.time() if tracer is not None else None))  # valid packet
+                metrics.set_max('kocom_msg_queue_high_water', msg_q.qsize())
+            if scanner.invalid != invalid:
+                bus_arbiter.received(rs485.last_read_time, None)   # garbled frame, possibly a collision with our write
         except Exception as ex:
             logging.error("*** Read error.[{}]".format(ex) )
-            poll_timer.cancel()
-            del cache_data[:]
+            state_store.expire()
+            scanner.reset()
+            metrics.inc('kocom_rs485_reconnects_total')
             rs485.reconnect()
-            poll_timer = threading.Timer(2, poll_state)
-            poll_timer.start()
+            poll_scheduler.poll_all(delay=2)
 
 
-def listen_hexdata():
-    while True:
-        d = msg_q.get()
+def record_frame(d, recv_time, stamps=None):
+    if settings.show_recv_hex:
+        logging.info("[recv] " + d.hex())
+
+    p = parse(d, recv_time)
+    if stamps is not None:
+        stamps.append(('parsed', time.time()))
+        p.stamps = stamps
+    bus_arbiter.received(recv_time, d)
 
-        if config.get('Log', 'show_recv_hex') == 'True':
-            logging.info("[recv] " + d)
+    # keep recent frames for debugging, and the latest known state per device
+    recent_frames.append(p)
+    device_h = state_device(p)
+    if device_h is not None:
+        state_store.update(device_h, p)
+        poll_scheduler.seen(device_h, p.value)
+        if state_snapshot is not None and device_t_dic.get(device_h[:2]) in STATE_DEVICES and device_h in enabled_addresses():
+            state_snapshot.record(device_h, p)
+    return p
 
-        p_ret = parse(d)
 
-        # store recent packets in cache
-        cache_data.insert(0, p_ret)
-        if len(cache_data) > BUF_SIZE:
-            del cache_data[-1]
+def state_device(p):
+    """Address of the device whose full current state the frame carries, or None"""
+    if p.type == 'ack' and p.src == 'wallpad' and p.cmd != 'query':
+        return p.dest_h     # wallpad ACK echoes the device's state report
+    if p.src == 'light' and p.cmd == 'state':
+        return p.src_h      # light bitmap reported, or ACK'd by the light for any controller's command
+    if settings.passive_state and p.type == 'send' and p.cmd == 'state' and p.src in STATE_DEVICES:
+        return p.src_h      # state report to the wallpad or another controller
+    return None
 
-        if p_ret['data_h'] in ack_data:
-            ack_q.put(d)
+
+def listen_hexdata():
+    while True:
+        d, recv_time, framed_time = msg_q.get()
+        stamps = None if framed_time is None else [('read', recv_time), ('framed', framed_time), ('dequeued', time.time())]
+        p_ret = record_frame(d, recv_time, stamps)
+
+        if ack_data and p_ret.data_h in ack_data:
+            put_latest(ack_q, (p_ret.data_h, recv_time))
             continue
 
         if wait_target.empty() == False:
-            if p_ret['dest_h'] == wait_target.queue[0] and p_ret['type'] == 'ack':
-            #if p_ret['src_h'] == wait_target.queue[0] and p_ret['type'] == 'send':
+            if p_ret.dest_h == wait_target.queue[0] and p_ret.type == 'ack':
+            #if p_ret.src_h == wait_target.queue[0] and p_ret.type == 'send':
                 if len(ack_data) != 0:
                     logging.info("[ACK] No ack received, but responce packet received before ACK. Assuming ACK OK")
-                    ack_q.put(d)
+                    put_latest(ack_q, (p_ret.data_h, recv_time))
                     time.sleep(0.5)
-                wait_q.put(p_ret)
+                # the wallpad polling the same device can answer twice; never block the listener on it
+                put_latest(wait_q, p_ret)
                 continue
         publish_status(p_ret)
 
 
+#===== metrics =====
+
+class Metrics:
+    """Counters and histograms for the /metrics endpoint, in the Prometheus text format.
+
+    Samples are keyed by metric name and label values. Values that already live
+    elsewhere (queue depths, FrameScanner and poll scheduler counters) are read
+    when the endpoint is scraped.
+    """
+    LATENCY_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3)
+    WAIT_BUCKETS = (0.01, 0.03, 0.05, 0.1, 0.2, 0.5, 1)
+    POLL_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}          # name -> (type, help, buckets)
+        self.values = {}        # name -> {label tuple: value, or [bucket counts..., sum, count] for histograms}
+        for name, kind, text, buckets in (
+            ('kocom_frames_total', 'counter', 'Valid frames received from RS485', None),
+            ('kocom_invalid_frames_total', 'counter', 'Frames rejected by checksum or trailer', None),
+            ('kocom_dropped_bytes_total', 'counter', 'Bytes discarded while resyncing to a frame header', None),
+            ('kocom_msg_queue_depth', 'gauge', 'Frames waiting for listen_hexdata', None),
+            ('kocom_msg_queue_high_water', 'gauge', 'Highest msg_q depth seen', None),
+            ('kocom_send_attempts_total', 'counter', 'Frames written by send(), per sequence code', None),
+            ('kocom_ack_timeouts_total', 'counter', 'ACK waits that timed out, per sequence code', None),
+            ('kocom_ack_latency_seconds', 'histogram', 'Time from writing a frame to its ACK', self.LATENCY_BUCKETS),
+            ('kocom_response_latency_seconds', 'histogram', 'Time from the ACK to the device state frame', self.LATENCY_BUCKETS),
+            ('kocom_send_failures_total', 'counter', 'send() calls that got no ACK and closed RS485', None),
+            ('kocom_rs485_reconnects_total', 'counter', 'RS485 reconnects after a read error', None),
+            ('kocom_polls_total', 'counter', 'Poll queries by result', None),
+            ('kocom_poll_round_seconds', 'histogram', 'Duration of a poll scheduler round over the due devices', self.POLL_BUCKETS),
+            ('kocom_state_refresh_total', 'counter', 'Polled device states refreshed, by our queries or passively', None),
+            ('kocom_mqtt_publish_total', 'counter', 'MQTT state publishes per topic class', None),
+            ('kocom_mqtt_queue_depth', 'gauge', 'Jobs waiting for the MQTT publisher thread', None),
+            ('kocom_mqtt_queue_high_water', 'gauge', 'Highest MQTT publisher queue depth seen', None),
+            ('kocom_mqtt_dropped_total', 'counter', 'Publisher jobs dropped on queue overflow', None),
+            ('kocom_mqtt_suppressed_total', 'counter', 'State publishes skipped as unchanged', None),
+            ('kocom_bus_writes_total', 'counter', 'Frames written to RS485', None),
+            ('kocom_bus_retries_total', 'counter', 'Frames written with a retry sequence code', None),
+            ('kocom_bus_collisions_total', 'counter', 'Writes overlapped by another frame on the bus', None),
+            ('kocom_bus_wait_seconds', 'histogram', 'Time a write waited for the bus to go idle', self.WAIT_BUCKETS),
+            ('kocom_command_queue_depth', 'gauge', 'MQTT commands waiting for the command executor', None),
+            ('kocom_command_queue_high_water', 'gauge', 'Highest command executor queue depth seen', None),
+            ('kocom_commands_total', 'counter', 'MQTT commands executed', None),
+            ('kocom_commands_collapsed_total', 'counter', 'Queued commands replaced by a newer one for the same topic', None),
+            ('kocom_state_snapshot_writes_total', 'counter', 'State snapshots written to disk', None)):
+            self.meta[name] = (kind, text, buckets)
+            self.values[name] = {}
+
+    def inc(self, name, n=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.values[name]
+            samples[key] = samples.get(key, 0) + n
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def set_max(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.values[name]
+            if value > samples.get(key, 0):
+                samples[key] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self.meta[name][2]
+        with self.lock:
+            samples = self.values[name]
+            h = samples.get(key)
+            if h is None:
+                h = samples[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def collect(self):
+        """Copy the values kept by other objects into the gauges and counters"""
+        if frame_scanner is not None:
+            self.set('kocom_frames_total', frame_scanner.frames)
+            self.set('kocom_invalid_frames_total', frame_scanner.bad_checksum, reason='checksum')
+            self.set('kocom_invalid_frames_total', frame_scanner.bad_trailer, reason='trailer')
+            self.set('kocom_dropped_bytes_total', frame_scanner.dropped)
+        if engine is None and msg_q is not None:
+            self.set('kocom_msg_queue_depth', msg_q.qsize())
+        if publisher is not None:
+            self.set('kocom_mqtt_queue_depth', publisher.depth())
+            self.set('kocom_mqtt_queue_high_water', publisher.high_water)
+            self.set('kocom_mqtt_dropped_total', publisher.dropped)
+            self.set('kocom_mqtt_suppressed_total', publisher.suppressed)
+        if bus_arbiter is not None:
+            self.set('kocom_bus_writes_total', bus_arbiter.writes)
+            self.set('kocom_bus_retries_total', bus_arbiter.retries)
+            self.set('kocom_bus_collisions_total', bus_arbiter.collisions)
+        if state_snapshot is not None:
+            self.set('kocom_state_snapshot_writes_total', state_snapshot.writes)
+        if command_executor is not None:
+            self.set('kocom_command_queue_depth', command_executor.depth)
+            self.set('kocom_command_queue_high_water', command_executor.high_water)
+            self.set('kocom_commands_total', command_executor.executed)
+            self.set('kocom_commands_collapsed_total', command_executor.collapsed)
+        if poll_scheduler is not None:
+            self.set('kocom_state_refresh_total', poll_scheduler.active, source='active')
+            self.set('kocom_state_refresh_total', poll_scheduler.passive, source='passive')
+
+    def render(self):
+        self.collect()
+        lines = []
+        with self.lock:
+            for name, (kind, text, buckets) in self.meta.items():
+                lines.append('# HELP {} {}'.format(name, text))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for key, value in sorted(self.values[name].items()):
+                    if kind != 'histogram':
+                        lines.append('{}{} {}'.format(name, self.labels(key), value))
+                        continue
+                    for bound, count in zip(buckets + ('+Inf',), value[:-2] + [value[-1]]):
+                        lines.append('{}_bucket{} {}'.format(name, self.labels(key + (('le', str(bound)),)), count))
+                    lines.append('{}_sum{} {}'.format(name, self.labels(key), round(value[-2], 6)))
+                    lines.append('{}_count{} {}'.format(name, self.labels(key), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def labels(key):
+        if not key:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, v) for k, v in key) + '}'
+
+
+class LatencyTracer:
+    """Opt-in per-stage latency samples, enabled by [Log] trace_latency = True.
+
+    A frame collects (stage, time) stamps from the RS485 read to the MQTT
+    publish (read, framed, dequeued, parsed, publisher, published), and a
+    command from mqtt_on_message to its ACK (mqtt, started, merged, written, acked).
+    A finished trace adds the time spent reaching each stage to a window of
+    recent samples. When tracing is off the global tracer is None and the hot
+    paths only test for that.
+    """
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}         # path ('frame'/'command') -> {stage: deque of seconds}
+        self.local = threading.local()
+
+    def finish(self, path, stamps):
+        with self.lock:
+            stages = self.samples.setdefault(path, {})
+            durations = [(stage, t - prev) for (_, prev), (stage, t) in zip(stamps, stamps[1:])]
+            for stage, seconds in durations + [('total', stamps[-1][1] - stamps[0][1])]:
+                if stage not in stages:
+                    stages[stage] = collections.deque(maxlen=self.window)
+                stages[stage].append(seconds)
+
+    # a command's trace starts in mqtt_on_message, is resumed on the handler
+    # thread that runs it and follows that thread until send() takes it
+    def command_resume(self, stamps):
+        self.local.stamps = stamps
+
+    def command_take(self):
+        stamps = getattr(self.local, 'stamps', None)
+        self.local.stamps = None
+        return stamps
+
+    def report(self):
+        lines = ['{:<8} {:<10} {:>6} {:>9} {:>9} {:>9} {:>9}'.format('path', 'stage', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+        with self.lock:
+            snapshot = {path: {stage: sorted(v) for stage, v in stages.items()} for path, stages in self.samples.items()}
+        for path, stages in sorted(snapshot.items()):
+            for stage, values in sorted(stages.items(), key=lambda item: item[0] == 'total'):
+                pct = lambda q: values[min(len(values) - 1, int(len(values) * q))] * 1000
+                lines.append('{:<8} {:<10} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(path, stage, len(values), pct(0.5), pct(0.9), pct(0.99), values[-1] * 1000))
+        return lines
+
+    def dump(self):
+        for line in self.report():
+            logging.info('[TRACE] ' + line)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/trace' and tracer is not None:
+            body = ('\n'.join(tracer.report()) + '\n').encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(bind, port):
+    server = http.server.ThreadingHTTPServer((bind, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics_http', daemon=True).start()
+    logging.info('[METRICS] serving http://{}:{}/metrics'.format(bind, port))
+    return server
+
+
+metrics = Metrics()
+
+
+#===== asyncio engine =====
+
+class AsyncSerial:
+    """Non-blocking pyserial adapter: the event loop watches the port's fd.
+
+    Exposes the StreamReader/StreamWriter calls the engine uses (read, write,
+    drain, close), so serial and socket gateways are handled the same way.
+    """
+    def __init__(self, loop, ser):
+        self.loop = loop
+        self.ser = ser
+        self.buf = bytearray()
+        self.waiter = None
+        self.error = None
+        loop.add_reader(ser.fileno(), self.on_readable)
+
+    def on_readable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+            if not data:
+                raise Exception('read byte errror')
+            self.buf += data
+        except Exception as e:
+            self.error = e
+            self.loop.remove_reader(self.ser.fileno())
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def read(self, n):
+        while not self.buf:
+            if self.error is not None:
+                raise self.error
+            self.waiter = self.loop.create_future()
+            await self.waiter
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def write(self, data):
+        self.ser.write(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        if self.error is None:
+            self.error = Exception('serial closed')
+            self.loop.remove_reader(self.ser.fileno())
+        self.ser.close()
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+
+class AsyncReplay:
+    """ReplayRS485 behind the StreamReader/StreamWriter calls the engine uses"""
+    def __init__(self, replay):
+        self.replay = replay
+
+    async def read(self, n):
+        rec = self.replay.next_chunk()
+        if rec is None:
+            await asyncio.Event().wait()    # end of the capture : silent bus
+        delay, data = rec
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return data
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class AsyncMqttAdapter:
+    """Drives a paho client from the event loop through its socket callbacks
+    instead of loop_start()'s network thread. mqtt_on_message only queues the
+    command there; the blocking handlers run on the command executor."""
+    def __init__(self, engine):
+        self.engine = engine
+        self.loop = engine.loop
+        self.misc_task = None
+
+    def attach(self, client):
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    # paho may call these from the worker or publisher thread, so hop onto the loop
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_reader, sock, client.loop_read)
+        if self.misc_task is None:
+            self.misc_task = asyncio.run_coroutine_threadsafe(self.misc_loop(client), self.loop)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_reader, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock)
+
+    async def misc_loop(self, client):
+        delay = 1
+        while True:
+            if client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                await asyncio.sleep(delay)
+                try:
+                    await self.loop.run_in_executor(None, client.reconnect)
+                    delay = 1
+                except Exception as e:
+                    logging.error('[MQTT] reconnect failed : {}'.format(e))
+                    delay = min(delay * 2, 120)
+            else:
+                await asyncio.sleep(1)
+
+
+class AsyncEngine:
+    """Single event loop for RS485 I/O, ACK/response matching and MQTT.
+
+    ACK and response waits are futures keyed by the expected ACK data and by the
+    device address, resolved directly by the reader task. Blocking helpers
+    (send, send_wait_response, query) run on one persistent worker thread, the
+    command executor's threads or the poll scheduler's thread, and call into
+    the loop with call().
+    """
+    def __init__(self, serial_port=None, socket_server=None, socket_port=0, replay_file=None, replay_speed=1.0):
+        if replay_file is not None:
+            self.type = 'replay'
+            self.replay = ReplayRS485(replay_file, replay_speed)
+        else:
+            self.type = 'serial' if socket_server == None else 'socket'
+        self.serial_port = serial_port
+        self.socket_server = socket_server
+        self.socket_port = socket_port
+        self.loop = None
+        self.reader = self.writer = None
+        self.last_read_time = 0
+        self.heard = asyncio.Event()    # set by the first read after connecting
+        self.scanner = FrameScanner()
+        self.ack_waiters = {}         # expected ACK data_h -> future of the running send()
+        self.response_waiters = {}    # device address (dest_h) -> future
+        self.worker = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='kocom_worker')
+
+    # ----- thread bridge -----
+    def call(self, coro):
+        """Run a coroutine on the loop from another thread and wait for its result"""
+        if threading.current_thread() is self.loop_thread:
+            raise RuntimeError('blocking engine call from the event loop thread')
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def run_in_worker(self, fn, *args):
+        def run():
+            try:
+                return fn(*args)
+            except Exception as e:
+                logging.exception('[ENGINE] {} failed : {}'.format(getattr(fn, '__name__', fn), e))
+        return self.loop.run_in_executor(self.worker, run)
+
+    # ----- RS485 -----
+    async def connect(self):
+        self.close()
+        self.last_read_time = 0
+        self.heard.clear()
+        try:
+            if self.type == 'socket':
+                self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.socket_server, self.socket_port), 10)
+                logging.info('[RS485] Socket connected | server {}, port {}'.format(self.socket_server, self.socket_port))
+            elif self.type == 'replay':
+                if not self.replay.connect():
+                    raise Exception('capture not available')
+                self.reader = self.writer = AsyncReplay(self.replay)
+            else:
+                port = self.serial_port or ('/dev/ttyUSB0' if platform.system() == 'Linux' else 'com3')
+                ser = serial.Serial(port, 9600, timeout=0)
+                self.reader = self.writer = AsyncSerial(self.loop, ser)
+                logging.info('[RS485] Serial connected : {}'.format(ser))
+        except Exception as e:
+            logging.error('[RS485] connection failure : {}'.format(e))
+            self.reader = self.writer = None
+            return False
+        return True
+
+    def close(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+        self.reader = self.writer = None
+
+    async def write(self, data):
+        if self.writer is None:
+            raise Exception('Not ready')
+        started = time.time()
+        if self.last_read_time == 0:
+            try:
+                await asyncio.wait_for(self.heard.wait(), FIRST_WRITE_WAIT)
+            except asyncio.TimeoutError:
+                pass
+        wait = bus_arbiter.delay(time.time(), self.last_read_time, started)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = bus_arbiter.delay(time.time(), self.last_read_time, started)
+        bus_arbiter.transmitted(data, time.time() - started)
+        self.writer.write(data)
+        await self.writer.drain()
+        return len(data)
+
+    async def read_loop(self):
+        while True:
+            try:
+                if self.reader is None:
+                    raise Exception('RS485 not connected')
+                # a finished replay stays silent, so only a live bus has a read timeout
+                data = await asyncio.wait_for(self.reader.read(READ_CHUNK_SIZE), None if self.type == 'replay' else polling_interval+15)
+                if not data:
+                    raise Exception('read byte errror')
+                self.last_read_time = time.time()
+                self.heard.set()
+                if bus_capture is not None:
+                    bus_capture.write(data)
+                invalid = self.scanner.invalid
+                for frame in self.scanner.feed(data):
+                    self.handle_frame(frame, self.last_read_time)
+                if self.scanner.invalid != invalid:
+                    bus_arbiter.received(self.last_read_time, None)
+            except Exception as ex:
+                logging.error("*** Read error.[{}]".format(ex) )
+                state_store.expire()
+                self.scanner.reset()
+                self.close()
+                metrics.inc('kocom_rs485_reconnects_total')
+                while True:
+                    logging.info('[RS485] reconnecting to RS485...')
+                    if await self.connect():
+                        break
+                    await asyncio.sleep(10)
+                poll_scheduler.poll_all(delay=2)
+
+    def handle_frame(self, frame, recv_time):
+        p = record_frame(frame, recv_time, [('read', recv_time), ('framed', time.time())] if tracer is not None else None)
+        if self.ack_waiters:
+            fut = self.ack_waiters.get(p.data_h)
+            if fut is not None:
+                if not fut.done():
+                    fut.set_result(p)
+                return
+        if self.response_waiters and p.type == 'ack':
+            fut = self.response_waiters.get(p.dest_h)
+            if fut is not None:
+                if self.ack_waiters:
+                    logging.info("[ACK] No ack received, but responce packet received before ACK. Assuming ACK OK")
+                    for ack in self.ack_waiters.values():
+                        if not ack.done():
+                            ack.set_result(p)
+                if not fut.done():
+                    fut.set_result(p)
+                return
+        publish_status(p)
+
+    async def send(self, dest, src, cmd, value, log=None, check_ack=True, trace=None):
+        async with self.bus_lock:
+            if cmd != cmd_h_dic['query']:
+                state_store.invalidate(dest)   # cached state is outdated once we command the device
+                poll_scheduler.commanded(dest)
+            ret = False
+            ack = self.loop.create_future()
+            sent_at = {}
+            try:
+                for attempt, seq_h in enumerate(seq_t_dic.keys()): # if there's no ACK received, then repeat sending with next sequence code
+                    payload = type_h_dic['send'] + seq_h + '00' + dest + src + cmd + value
+                    send_data = header_h + payload + chksum(payload) + trailer_h
+                    try:
+                        await self.write(bytearray.fromhex(send_data))
+                    except Exception as ex:
+                        logging.error("[RS485] Write error.[{}]".format(ex) )
+                        break
+                    if log != None:
+                        logging.info('[SEND|{}] {}'.format(log, send_data))
+                    metrics.inc('kocom_send_attempts_total', seq=seq_h)
+                    if trace is not None and attempt == 0:
+                        trace.append(('written', time.time()))
+                    if check_ack == False:
+                        await asyncio.sleep(1)
+                        ret = send_data
+                        break
+
+                    # wait and checking for ACK
+                    expected = type_h_dic['ack'] + seq_h + '00' + src + dest + cmd + value
+                    sent_at[expected] = time.time()
+                    self.ack_waiters[expected] = ack
+                    try:
+                        p = await asyncio.wait_for(asyncio.shield(ack), rtt.ack_timeout(dest, attempt))
+                        if p.data_h in sent_at:
+                            rtt.add('ack', dest, p.time - sent_at[p.data_h])
+                        if trace is not None:
+                            tracer.finish('command', trace + [('acked', p.time)])
+                        if settings.show_recv_hex:
+                            logging.info ('[ACK] OK')
+                        ret = send_data
+                        break
+                    except asyncio.TimeoutError:
+                        rtt.timed_out('ack', dest)
+                        metrics.inc('kocom_ack_timeouts_total', seq=seq_h)
+            finally:
+                self.ack_waiters.clear()
+
+            if ret == False:
+                logging.info('[RS485] send failed. closing RS485. it will try to reconnect to RS485 shortly.')
+                metrics.inc('kocom_send_failures_total')
+                self.close()
+            return ret
+
+    async def send_wait_response(self, dest, src, cmd, value, log=None, check_ack=True, publish=True, trace=None):
+        async with self.response_lock:
+            ret = empty_packet()
+            response = self.loop.create_future()
+            self.response_waiters[dest] = response
+            try:
+                if await self.send(dest, src, cmd, value, log, check_ack, trace) != False:
+                    acked = time.time()
+                    try:
+                        ret = await asyncio.wait_for(response, rtt.response_timeout(dest))
+                        if ret.time > acked:    # a response read before the ACK was handled has no usable round trip
+                            rtt.add('response', dest, ret.time - acked)
+                        if publish == True:
+                            publish_status(ret)
+                    except asyncio.TimeoutError:
+                        rtt.timed_out('response', dest)
+            finally:
+                self.response_waiters.pop(dest, None)
+            return ret
+
+    # ----- main -----
+    async def start_mqtt(self):
+        """Connect MQTT, then publish discovery and the snapshot's states without waiting for RS485"""
+        global mqttc
+        mqttc = await self.run_in_worker(init_mqttc, AsyncMqttAdapter(self))
+        if mqttc == False:
+            logging.error('[MQTT] conection error. exit')
+            exit(1)
+        await self.run_in_worker(discovery)
+        publish_restored()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.current_thread()
+        self.bus_lock = asyncio.Lock()
+        self.response_lock = asyncio.Lock()
+
+        # RS485 and MQTT connect side by side
+        mqtt_up = self.loop.create_task(self.start_mqtt())
+        for retry_count in range(1, MAX_RETRIES+1):
+            if await self.connect():
+                logging.info('[RS485] Successfully connected')
+                break
+            if retry_count == MAX_RETRIES:
+                logging.error('[RS485] Failed to connect after {} attempts. Please check your configuration.'.format(MAX_RETRIES))
+                exit(1)
+            wait_time = rs485_retry_wait(retry_count)
+            logging.warning('[RS485] Connection attempt {} of {} failed. Retrying in {} seconds...'.format(retry_count, MAX_RETRIES, wait_time))
+            await asyncio.sleep(wait_time)
+        bus_ready.set()
+
+        if self.type == 'replay':
+            # a replay starts once MQTT is up, so none of its states are lost
+            await mqtt_up
+        reader = self.loop.create_task(self.read_loop())
+        poll_scheduler.start()
+        await asyncio.gather(reader, mqtt_up)
+
+
+class AsyncRS485Bridge:
+    """Stands in for the RS485Wrapper global when the asyncio engine is used,
+    for code that writes to the bus directly from other threads."""
+    def __init__(self, engine):
+        self.engine = engine
+
+    @property
+    def last_read_time(self):
+        return self.engine.last_read_time
+
+    def write(self, data):
+        return self.engine.call(self.engine.write(data))
+
+    def close(self):
+        self.engine.loop.call_soon_threadsafe(self.engine.close)
+
+
+def rs485_retry_wait(retry_count):
+    """Seconds before the next RS485 connection attempt : 1, 2, 4 ... up to 5 minutes"""
+    return min(RETRY_DELAY * 2 ** (retry_count - 1), 300)
+
+
+def connect_rs485():
+    """Threaded engine : connect RS485 with retries while MQTT connects on the main thread"""
+    for retry_count in range(1, MAX_RETRIES+1):
+        if rs485.connect():
+            logging.info('[RS485] Successfully connected')
+            bus_ready.set()
+            return
+        if retry_count < MAX_RETRIES:
+            wait_time = rs485_retry_wait(retry_count)
+            logging.warning('[RS485] Connection attempt {} of {} failed. Retrying in {} seconds...'.format(retry_count, MAX_RETRIES, wait_time))
+            time.sleep(wait_time)
+    logging.error('[RS485] Failed to connect after {} attempts. Please check your configuration.'.format(MAX_RETRIES))
+    logging.error('[RS485] Verify: 1) Device IP and port, 2) Network connectivity, 3) Device power status')
+
+
 #========== Main ==========
 
 if __name__ == "__main__":
-    # Global variables that will be configured
-    global light_controller_addr
-    light_controller_addr = None
-
     logging.basicConfig(format='%(levelname)s[%(asctime)s]:%(message)s ', level=logging.DEBUG)
 
     # Load JSON configuration files
     load_json_config()
 
-    # Try to read Home Assistant addon options first
-    ha_options = None
-    try:
-        with open('/data/options.json', 'r') as f:
-            ha_options = json.load(f)
-            logging.info('[CONFIG] Using Home Assistant addon options')
-    except:
-        logging.info('[CONFIG] No HA addon options found, using kocom.conf')
-    
-    config = configparser.ConfigParser()
-    
-    if ha_options:
-        # Convert HA options to config format
-        config.add_section('RS485')
-        config.set('RS485', 'type', ha_options.get('rs485_type', 'serial'))
-        if ha_options.get('rs485_type') == 'socket':
-            config.set('RS485', 'socket_server', ha_options.get('socket_server', ''))
-            config.set('RS485', 'socket_port', str(ha_options.get('socket_port', 8899)))
-        else:
-            config.set('RS485', 'serial_port', ha_options.get('serial_port', '/dev/ttyUSB0'))
-        
-        config.add_section('MQTT')
-        config.set('MQTT', 'mqtt_server', ha_options.get('mqtt_server', 'core-mosquitto'))
-        config.set('MQTT', 'mqtt_port', str(ha_options.get('mqtt_port', 1883)))
-        config.set('MQTT', 'mqtt_allow_anonymous', str(ha_options.get('mqtt_allow_anonymous', True)))
-        config.set('MQTT', 'mqtt_username', ha_options.get('mqtt_username', ''))
-        config.set('MQTT', 'mqtt_password', ha_options.get('mqtt_password', ''))
-        
-        config.add_section('Log')
-        config.set('Log', 'show_query_hex', str(ha_options.get('debug_mode', False)))
-        config.set('Log', 'show_recv_hex', str(ha_options.get('debug_mode', False)))
-        config.set('Log', 'show_mqtt_publish', str(ha_options.get('debug_mode', False)))
-        config.set('Log', 'show_mqtt_discovery', str(ha_options.get('debug_mode', False)))
-        
-        # Set default sections if not present
-        if not config.has_section('Device'):
-            config.add_section('Device')
-            config.set('Device', 'enabled', 'fan, elevator, light_livingroom, light_room1, light_room2, light_room3, light_kitchen, thermo_livingroom, thermo_room1, thermo_room2, thermo_room3')
-        
-        if not config.has_section('Elevator'):
-            config.add_section('Elevator')
-            config.set('Elevator', 'type', 'rs485')
-            config.set('Elevator', 'rs485_floor', str(ha_options.get('elevator_floor', 15)))
-        
-        if not config.has_section('User'):
-            config.add_section('User')
-            config.set('User', 'init_temp', str(ha_options.get('init_temp', 23)))
-            config.set('User', 'init_fan_mode', 'Medium')
-            config.set('User', 'light_count', '3')
-            config.set('User', 'thermo_init_temp', '23')
-            config.set('User', 'ac_init_temp', '21')
-            config.set('User', 'ac_init_mode', 'cool')
-            config.set('User', 'fan_init_fan_mode', 'low')
-            config.set('User', 'ac_init_fan_mode', 'LOW')
-        
-        logging.info('[CONFIG] RS485 type: {}'.format(config.get('RS485', 'type')))
-        if config.get('RS485', 'type') == 'socket':
-            logging.info('[CONFIG] Socket server: {}:{}'.format(
-                config.get('RS485', 'socket_server'),
-                config.get('RS485', 'socket_port')
-            ))
-    else:
-        # Fallback to reading kocom.conf file
-        config.read(CONFIG_FILE)
+    config = load_config()
+    settings = build_settings(config)
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_settings())
 
-    # Load light controller address (for apartments with non-standard controller)
-    try:
-        light_controller_addr = config.get('Device', 'light_controller')
-        logging.info('[CONFIG] Using custom light controller address: {}'.format(light_controller_addr))
-    except:
-        light_controller_addr = device_h_dic['wallpad'] + '00'  # default: 0100
-        logging.info('[CONFIG] Using default light controller address: {}'.format(light_controller_addr))
+    if settings.trace_latency:
+        tracer = LatencyTracer()
+        signal.signal(signal.SIGUSR1, lambda signum, frame: tracer.dump())
+        logging.info('[TRACE] latency tracing enabled, send SIGUSR1 to log the per-stage percentiles')
 
     # Connection retry configuration
     MAX_RETRIES = 10
-    RETRY_DELAY = 30  # seconds
+    RETRY_DELAY = 1  # seconds, doubled on every failed attempt
 
     if config.get('RS485', 'type') == 'serial':
-        import serial
-        rs485 = RS485Wrapper(serial_port = config.get('RS485', 'serial_port', fallback=None))
+        rs485_args = {'serial_port': config.get('RS485', 'serial_port', fallback=None)}
     elif config.get('RS485', 'type') == 'socket':
-        import socket
-        rs485 = RS485Wrapper(socket_server = config.get('RS485', 'socket_server'), socket_port = int(config.get('RS485', 'socket_port')))
+        rs485_args = {'socket_server': config.get('RS485', 'socket_server'), 'socket_port': int(config.get('RS485', 'socket_port'))}
+    elif config.get('RS485', 'type') == 'replay':
+        rs485_args = {'replay_file': config.get('RS485', 'replay_file'), 'replay_speed': float(config.get('RS485', 'replay_speed', fallback=1))}
     else:
-        logging.error('[CONFIG] invalid type value in [RS485]: only "serial" or "socket" is allowed. exit')
+        logging.error('[CONFIG] invalid type value in [RS485]: only "serial", "socket" or "replay" is allowed. exit')
         exit(1)
-    
-    # Retry connection with exponential backoff
-    retry_count = 0
-    while retry_count < MAX_RETRIES:
-        if rs485.connect():
-            logging.info('[RS485] Successfully connected')
-            break
-        retry_count += 1
-        if retry_count < MAX_RETRIES:
-            wait_time = min(RETRY_DELAY * retry_count, 300)  # Max 5 minutes
-            logging.warning('[RS485] Connection attempt {} of {} failed. Retrying in {} seconds...'.format(retry_count, MAX_RETRIES, wait_time))
-            time.sleep(wait_time)
-        else:
-            logging.error('[RS485] Failed to connect after {} attempts. Please check your configuration.'.format(MAX_RETRIES))
-            logging.error('[RS485] Verify: 1) Device IP and port, 2) Network connectivity, 3) Device power status')
-            exit(1)
 
-    mqttc = init_mqttc()
-    if mqttc == False:
-        logging.error('[MQTT] conection error. exit')
-        exit(1)
+    bus_arbiter = BusArbiter(protocol_config['timing'], config.get('RS485', 'arbiter', fallback='False') == 'True')
+
+    capture_file = config.get('RS485', 'capture', fallback='')
+    if capture_file:
+        bus_capture = BusCapture(capture_file, int(float(config.get('RS485', 'capture_max_mb', fallback=10)) * 1024 * 1024),
+                                 int(config.get('RS485', 'capture_backups', fallback=3)))
+        logging.info('[CAPTURE] recording bus traffic to {}'.format(capture_file))
+
+    if config.get('Engine', 'type', fallback='thread') == 'asyncio':
+        logging.info('[ENGINE] using asyncio engine')
+        engine = AsyncEngine(**rs485_args)
+        rs485 = AsyncRS485Bridge(engine)
+        frame_scanner = engine.scanner
+    else:
+        rs485 = ReplayRS485(**rs485_args) if 'replay_file' in rs485_args else RS485Wrapper(**rs485_args)
+        frame_scanner = FrameScanner()
+
+    publisher = MqttPublisher(settings.publish_queue_size, settings.publish_overflow, settings.state_refresh_interval)
+    command_executor = CommandExecutor()
+    command_executor.start()
+    publisher.start()
 
     msg_q = queue.Queue(BUF_SIZE)
     ack_q = queue.Queue(1)
@@ -1346,16 +3384,45 @@ if __name__ == "__main__":
     wait_q = queue.Queue(1)
     wait_target = queue.Queue(1)
     send_lock = threading.Lock()
-    poll_timer = threading.Timer(1, poll_state)
-
-    cache_data = []
 
-    thread_list = []
-    thread_list.append(threading.Thread(target=read_serial, name='read_serial'))
-    thread_list.append(threading.Thread(target=listen_hexdata, name='listen_hexdata'))
-    for thread_instance in thread_list:
-        thread_instance.start()
+    state_store = StateStore(polling_interval)
+    snapshot_file = config.get('Device', 'state_snapshot', fallback='')
+    if snapshot_file:
+        state_snapshot = StateSnapshot(snapshot_file, float(config.get('Device', 'state_snapshot_interval', fallback=10)))
+        state_snapshot.restore(state_store)
+        state_snapshot.start()
+    rtt = RttEstimator(protocol_config['timing'])
+    poll_scheduler = PollScheduler(protocol_config['timing'])
+
+    metrics_port = int(config.get('Metrics', 'port', fallback=0))
+    if metrics_port > 0:
+        start_metrics_server(config.get('Metrics', 'bind', fallback='127.0.0.1'), metrics_port)
+    light_batcher = LightBatcher(settings.light_merge_window)
+    batch_keepalive = BatchOffKeepalive()
+    batch_keepalive.start()
+    recent_frames = collections.deque(maxlen=BUF_SIZE)
+
+    if engine is not None:
+        # connects RS485 and MQTT side by side, then runs the reader and MQTT I/O on one loop
+        asyncio.run(engine.run())
+    else:
+        # RS485 connects in the background; discovery and the snapshot's states go out as soon as the broker is up
+        rs485_connect = threading.Thread(target=connect_rs485, name='rs485_connect', daemon=True)
+        rs485_connect.start()
+        mqttc = init_mqttc()
+        if mqttc == False:
+            logging.error('[MQTT] conection error. exit')
+            exit(1)
+        discovery()
+        publish_restored()
 
-    poll_timer.start()
+        rs485_connect.join()
+        if not bus_ready.is_set():
+            exit(1)
+        thread_list = []
+        thread_list.append(threading.Thread(target=read_serial, name='read_serial'))
+        thread_list.append(threading.Thread(target=listen_hexdata, name='listen_hexdata'))
+        for thread_instance in thread_list:
+            thread_instance.start()
 
-    discovery()
+        poll_scheduler.start()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Kocom RS485 Capture Analyzer
+버스 캡처(kocom.conf [RS485] capture) 또는 hex 로그를 kocom.py 와 같은 FrameScanner / parse() 로 분석
+
+ - 장치별 / 명령별 / 방별 프레임 빈도
+ - packets.json 에 없는 장치, 명령, 패킷 타입 코드
+ - checksum / trailer 오류 비율, 버려진 바이트
+ - 프레임 간격, 전송 → ACK 지연 히스토그램 (타임스탬프가 있는 캡처 파일만)
+ - 파일을 스트리밍으로 읽어 메모리 사용량이 일정하고, 여러 파일(회전된 캡처)은 프로세스 풀로 병렬 처리
+
+Usage:
+    python3 kocom_analyze.py /share/kocom/bus.cap            # 회전된 bus.cap.N 포함
+    python3 kocom_analyze.py day1.cap day2.cap --jobs 4
+    python3 kocom_analyze.py kocom.log --json > report.json  # [recv] 로그 (타이밍 제외)
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+
+import kocom
+
+
+# histogram bucket upper bounds in seconds, the last bucket is open ended
+GAP_BOUNDS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+ACK_STALE = 5               # a send not ACK'd within this many seconds is forgotten
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def add(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+
+    def labels(self):
+        out = []
+        lower = 0
+        for bound in self.bounds:
+            out.append('{:>6} - {:<6}'.format(fmt_seconds(lower), fmt_seconds(bound)))
+            lower = bound
+        out.append('{:>6} +       '.format(fmt_seconds(lower)))
+        return out
+
+    def to_dict(self):
+        return {label.strip(): n for label, n in zip(self.labels(), self.counts)}
+
+
+def fmt_seconds(s):
+    return '{:g}ms'.format(s * 1000) if s < 1 else '{:g}s'.format(s)
+
+
+class Stats:
+    """Counters for one or more files; small enough to send back from a worker process"""
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.frames = 0
+        self.bad_checksum = 0
+        self.bad_trailer = 0
+        self.dropped = 0
+        self.first = self.last = None       # capture wall clock span
+        self.types = collections.Counter()
+        self.devices = collections.Counter()
+        self.commands = collections.Counter()
+        self.rooms = collections.Counter()
+        self.unknown_devices = collections.Counter()
+        self.unknown_commands = collections.Counter()
+        self.unknown_types = collections.Counter()
+        self.gaps = Histogram(GAP_BOUNDS)
+        self.acks = Histogram(GAP_BOUNDS)
+        self.unacked = 0
+
+    def merge(self, other):
+        for name in ('files', 'bytes', 'frames', 'bad_checksum', 'bad_trailer', 'dropped', 'unacked'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name in ('types', 'devices', 'commands', 'rooms', 'unknown_devices', 'unknown_commands', 'unknown_types'):
+            getattr(self, name).update(getattr(other, name))
+        if other.first is not None:
+            self.first = other.first if self.first is None else min(self.first, other.first)
+            self.last = other.last if self.last is None else max(self.last, other.last)
+        self.gaps.merge(other.gaps)
+        self.acks.merge(other.acks)
+
+    def frame(self, p):
+        self.types[p.type or 'unknown'] += 1
+        if p.type is None:
+            self.unknown_types[p.raw[2:4].hex()] += 1
+        for addr_h in (p.dest_h, p.src_h):
+            if kocom.device_t_dic.get(addr_h[:2]) is None:
+                self.unknown_devices[addr_h[:2]] += 1
+        if p.cmd_h not in kocom.cmd_t_dic:
+            self.unknown_commands[p.cmd_h] += 1
+        # the device a frame is about : the side that is not the wallpad
+        if p.src == 'wallpad':
+            device, room = p.dest or p.dest_h[:2], p.dest_room or p.dest_h[2:]
+        else:
+            device, room = p.src or p.src_h[:2], p.src_room or p.src_h[2:]
+        self.devices[device] += 1
+        self.commands[device, p.cmd] += 1
+        self.rooms[device, room] += 1
+
+
+def capture_kind(path):
+    with open(path, 'rb') as f:
+        return 'capture' if f.read(len(kocom.CAPTURE_MAGIC)) == kocom.CAPTURE_MAGIC else 'text'
+
+
+def clock_offset(path):
+    """Offset from a capture's monotonic timestamps to wall clock time"""
+    with open(path, 'rb') as f:
+        f.read(len(kocom.CAPTURE_MAGIC))
+        wall, mono = kocom.CAPTURE_HEADER.unpack(f.read(kocom.CAPTURE_HEADER.size))
+    return wall - mono
+
+
+def read_chunks(path):
+    """(monotonic time or None, bytes) chunks of a capture file or a hex dump / kocom log.
+    Where kocom restarted and appended a new session to the capture, the bytes are
+    replaced by the (wall clock, monotonic time) pair of the new run's clocks."""
+    if capture_kind(path) == 'capture':
+        yield from kocom.read_capture([path])
+        return
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            data = kocom.hex_line_bytes(line)
+            if data:
+                yield None, data
+
+
+def analyze_file(path):
+    stats = Stats()
+    stats.files = 1
+    scanner = kocom.FrameScanner()
+    pending = {}        # expected ACK key -> send time
+    prev = None
+    offset = clock_offset(path) if capture_kind(path) == 'capture' else None
+    for t, data in read_chunks(path):
+        if isinstance(data, tuple):
+            # kocom restarted : its monotonic clock and the bus exchanges start over
+            wall, mono = data
+            offset = wall - mono
+            prev = None
+            stats.unacked += len(pending)
+            pending.clear()
+            continue
+        stats.bytes += len(data)
+        for frame in scanner.feed(data):
+            p = kocom.parse(frame, t)
+            stats.frame(p)
+            if t is None:
+                continue
+            if prev is not None and t >= prev:
+                stats.gaps.add(t - prev)
+            prev = t
+            if p.type == 'send':
+                if len(pending) > 64:
+                    for key in [k for k, sent in pending.items() if t - sent > ACK_STALE]:
+                        del pending[key]
+                        stats.unacked += 1
+                pending[(frame[3] & 0x0f, frame[5:7], frame[7:9], frame[9:18])] = t
+            elif p.type == 'ack':
+                sent = pending.pop((frame[3] & 0x0f, frame[7:9], frame[5:7], frame[9:18]), None)
+                if sent is not None:
+                    stats.acks.add(t - sent)
+        if offset is not None:
+            stats.first = t + offset if stats.first is None else stats.first
+            stats.last = t + offset
+    stats.unacked += len(pending)
+    stats.frames = scanner.frames
+    stats.bad_checksum = scanner.bad_checksum
+    stats.bad_trailer = scanner.bad_trailer
+    stats.dropped = scanner.dropped
+    return stats
+
+
+def init_worker():
+    logging.disable(logging.WARNING)        # parse() and the scanner log every odd frame
+    kocom.load_json_config()
+
+
+def expand(paths):
+    """Capture files expand to their rotated backups, oldest first"""
+    out = []
+    for path in paths:
+        if not os.path.exists(path):
+            sys.exit('{}: no such file'.format(path))
+        out += [f for f in kocom.capture_files(path) if f not in out] or [path]
+    return out
+
+
+def analyze(paths, jobs):
+    total = Stats()
+    if jobs <= 1 or len(paths) == 1:
+        init_worker()
+        for path in paths:
+            total.merge(analyze_file(path))
+        return total
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as pool:
+        for stats in pool.map(analyze_file, paths):
+            total.merge(stats)
+    return total
+
+
+def pct(n, total):
+    return '{:5.1f}%'.format(100.0 * n / total) if total else '    -'
+
+
+def table(title, counter, total, name=str, limit=None):
+    print('\n[{}]'.format(title))
+    if not counter:
+        print('  (none)')
+        return
+    for key, n in counter.most_common(limit):
+        print('  {:<32} {:>10} {}'.format(name(key), n, pct(n, total)))
+
+
+def histogram(title, hist):
+    total = sum(hist.counts)
+    print('\n[{}] {} samples'.format(title, total))
+    if not total:
+        return
+    peak = max(hist.counts)
+    for label, n in zip(hist.labels(), hist.counts):
+        print('  {} {:>10} {} {}'.format(label, n, pct(n, total), '#' * int(round(40.0 * n / peak))))
+
+
+def report(s):
+    checked = s.frames + s.bad_checksum + s.bad_trailer
+    print('[summary] {} files, {} bytes, {} valid frames'.format(s.files, s.bytes, s.frames))
+    if s.first is not None:
+        print('  span          {:.0f}s'.format(s.last - s.first))
+    print('  bad checksum  {:>10} {}'.format(s.bad_checksum, pct(s.bad_checksum, checked)))
+    print('  bad trailer   {:>10} {}'.format(s.bad_trailer, pct(s.bad_trailer, checked)))
+    print('  dropped bytes {:>10} {}'.format(s.dropped, pct(s.dropped, s.bytes)))
+    table('frame types', s.types, s.frames)
+    table('devices', s.devices, s.frames)
+    table('commands', s.commands, s.frames, name=lambda k: '{} {}'.format(*k))
+    table('rooms', s.rooms, s.frames, name=lambda k: '{} {}'.format(*k))
+    table('unknown packet types', s.unknown_types, s.frames)
+    table('unknown device codes', s.unknown_devices, s.frames)
+    table('unknown command codes', s.unknown_commands, s.frames)
+    histogram('inter-frame gap', s.gaps)
+    histogram('send -> ack', s.acks)
+    if s.acks.counts or s.unacked:
+        print('  not acked {}'.format(s.unacked))
+
+
+def to_json(s):
+    join = lambda counter: {' '.join(map(str, k)) if isinstance(k, tuple) else str(k): n for k, n in counter.most_common()}
+    return {
+        'files': s.files, 'bytes': s.bytes, 'frames': s.frames,
+        'bad_checksum': s.bad_checksum, 'bad_trailer': s.bad_trailer, 'dropped_bytes': s.dropped,
+        'span_seconds': None if s.first is None else s.last - s.first,
+        'types': join(s.types), 'devices': join(s.devices), 'commands': join(s.commands), 'rooms': join(s.rooms),
+        'unknown_types': join(s.unknown_types), 'unknown_devices': join(s.unknown_devices), 'unknown_commands': join(s.unknown_commands),
+        'inter_frame_gap': s.gaps.to_dict(), 'ack_latency': s.acks.to_dict(), 'not_acked': s.unacked,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Kocom RS485 capture analyzer')
+    parser.add_argument('files', nargs='+', help='bus capture files ([RS485] capture) or hex dumps / kocom logs')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='worker processes (default: CPU count)')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    stats = analyze(expand(args.files), args.jobs)
+    if args.json:
+        print(json.dumps(to_json(stats), indent=2, ensure_ascii=False))
+    else:
+        report(stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Kocom Wallpad / EW11 Simulator
+EW11 처럼 TCP 로 RS485 버스를 제공하는 로컬 시뮬레이터 (부하/지연 테스트용)
+
+ - protocol.json / packets.json 의 aa55 ... 0d0d 프레임 사용
+ - 월패드, 난방(thermo), 조명(light), 환기(fan), 가스(gas), 엘리베이터(elevator) 에뮬레이션
+ - 질의(3a)/명령에 같은 시퀀스 코드로 ACK, 이어서 상태 보고 및 월패드 ACK
+ - 프레임 속도(baud), ACK 지연, 드롭/손상 비율, 월패드 백그라운드 폴링 설정 가능
+ - --collisions : 전송 중인 프레임과 겹쳐 보낸 클라이언트 프레임은 유실 (반이중 버스 충돌)
+ - 접속한 모든 클라이언트가 하나의 버스를 공유 (보낸 프레임은 다른 클라이언트에게 전달)
+
+Usage:
+    python3 kocom_simulator.py [--port 8899] [--ack-delay 0.05] [--drop 0.01] [--corrupt 0.01] [--chatter 1]
+
+kocom.conf:
+    [RS485]
+    type = socket
+    socket_server = 127.0.0.1
+    socket_port = 8899
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+import kocom
+
+
+class Device:
+    """One emulated device: its address and current 8 byte state value (hex)"""
+    def __init__(self, name, sub_h, value):
+        self.name = name
+        self.addr = kocom.device_h_dic[name] + sub_h
+        self.value = value
+
+    def apply(self, cmd, value):
+        """Apply a command frame from a controller, return the new state value"""
+        if self.name == 'thermo':
+            # heat mode, away and set temp come from the command, the room keeps its current temp
+            self.value = value[:6] + self.value[6:]
+        elif self.name == 'gas':
+            self.value = '0' * 16
+        elif cmd == kocom.cmd_h_dic['state']:
+            self.value = value
+        return self.value
+
+    def drift(self, rnd):
+        """Slow random change between polls, like a room warming up"""
+        if self.name == 'thermo':
+            cur = int(self.value[8:10], 16) + rnd.choice((-1, 0, 0, 1))
+            self.value = self.value[:8] + '{:02x}'.format(max(10, min(35, cur))) + self.value[10:]
+
+
+class Bus:
+    """Shared half-duplex bus: frames go out one at a time at the configured baud rate"""
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.clients = set()
+        self.queue = asyncio.Queue()
+        self.frame_time = kocom.packet_size * 10 / args.baud if args.baud > 0 else 0
+        self.stats = {'rx': 0, 'tx': 0, 'acks': 0, 'dropped': 0, 'corrupted': 0, 'collisions': 0}
+        self.busy_until = 0         # end of the frame the bus is sending
+        self.client_until = 0       # end of the frame a client is sending
+        self.client_collided = False
+        self.wallpad = kocom.device_h_dic['wallpad'] + '00'
+        self.devices = {}
+        thermo_on = kocom.packet_config['parsing']['thermo']['heat_mode_on']
+        for i in range(args.rooms):
+            self.add(Device('thermo', '{:02x}'.format(i), thermo_on + '0017001600' + '0000'))
+            self.add(Device('light', '{:02x}'.format(i), '0' * 16))
+        self.add(Device('fan', '00', kocom.packet_config['parsing']['fan']['state_off'] + '000000000000'))
+        self.add(Device('gas', '00', '0' * 16))
+
+    def add(self, device):
+        self.devices[device.addr] = device
+
+    def frame(self, type_t, seq_h, dest, src, cmd, value):
+        payload = kocom.type_h_dic[type_t] + seq_h + '00' + dest + src + cmd + value
+        return bytes.fromhex(kocom.header_h + payload + kocom.chksum(payload) + kocom.trailer_h)
+
+    def emit(self, frame, exclude=None, faulty=True):
+        """Queue a frame for the bus; device replies may be dropped or corrupted"""
+        if faulty and self.rnd.random() < self.args.drop:
+            self.stats['dropped'] += 1
+            return
+        if faulty and self.rnd.random() < self.args.corrupt:
+            self.stats['corrupted'] += 1
+            frame = self.garble(frame)
+        self.queue.put_nowait((frame, exclude))
+
+    def garble(self, frame):
+        frame = bytearray(frame)
+        frame[self.rnd.randrange(4, kocom.chksum_position)] ^= 0x5a
+        return bytes(frame)
+
+    def deliver(self, frame, exclude=None):
+        for w in list(self.clients):
+            if w is exclude:
+                continue
+            try:
+                w.write(frame)
+            except Exception:
+                self.clients.discard(w)
+
+    async def writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            frame, exclude = await self.queue.get()
+            if self.frame_time:
+                # the frame is on the wire for frame_time and arrives complete at its end
+                start = loop.time()
+                self.busy_until = start + self.frame_time
+                await asyncio.sleep(self.frame_time)
+                if self.args.collisions and start < self.client_until:
+                    self.client_collided = True
+                    frame = self.garble(frame)
+            self.deliver(frame, exclude)
+            self.stats['tx'] += 1
+
+    async def reply(self, seq_h, dest, src, cmd, value):
+        """Device side of one exchange: ACK, state report, then the wallpad's ACK of the report"""
+        device = self.devices[dest]
+        await asyncio.sleep(max(0, self.rnd.gauss(self.args.ack_delay, self.args.ack_jitter)))
+        self.emit(self.frame('ack', seq_h, src, dest, cmd, value))
+        self.stats['acks'] += 1
+        if cmd != kocom.cmd_h_dic['query']:
+            device.apply(cmd, value)
+        await asyncio.sleep(self.args.response_delay)
+        report_cmd = kocom.cmd_h_dic['state'] if device.name != 'gas' else kocom.cmd_h_dic['off']
+        self.emit(self.frame('send', 'c', src, dest, report_cmd, device.value))
+        if src == self.wallpad:
+            await asyncio.sleep(self.args.ack_delay)
+            self.emit(self.frame('ack', 'c', dest, src, report_cmd, device.value))
+
+    async def elevator(self, src):
+        """Wallpad reports the car's floor to the elevator device until it arrives"""
+        self.emit(self.frame('ack', 'c', src, self.wallpad, kocom.cmd_h_dic['on'], '0' * 16), faulty=False)
+        for floor in range(self.args.elevator_from, self.args.elevator_floor - 1, -1):
+            await asyncio.sleep(1)
+            self.emit(self.frame('send', 'c', src, self.wallpad, kocom.cmd_h_dic['on'], '00{:02x}'.format(floor) + '0' * 12))
+
+    async def arrive(self, p, sender):
+        """A client frame occupies the bus for frame_time; if anything else was on
+        the wire meanwhile nobody hears it and the other frame is garbled"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        collided = now < self.busy_until or now < self.client_until
+        self.client_until = now + self.frame_time
+        self.client_collided = False
+        await asyncio.sleep(self.frame_time)
+        if collided or self.client_collided:
+            self.stats['collisions'] += 1
+            if self.args.verbose:
+                logging.info('[SIM] collision {}'.format(p.hex))
+            return
+        self.received(p, sender)
+
+    def received(self, p, sender):
+        """A frame written by a client: forward it to the other clients, then answer it"""
+        self.stats['rx'] += 1
+        self.deliver(p.raw, exclude=sender)
+        if p.type != 'send':
+            return
+        if p.dest_h in self.devices:
+            asyncio.ensure_future(self.reply(p.seq_h, p.dest_h, p.src_h, p.cmd_h, p.value_h))
+        elif p.dest_h == self.wallpad and p.src == 'elevator' and p.cmd == 'on':
+            asyncio.ensure_future(self.elevator(p.src_h))
+
+    async def chatter(self):
+        """The wallpad's own polling of every device, which kocom sees as background traffic"""
+        if self.args.chatter <= 0:
+            return
+        devices = list(self.devices.values())
+        loop = asyncio.get_running_loop()
+        period = 1 / self.args.chatter
+        due = loop.time()
+        while True:
+            # steady cadence like a real wallpad, with a little jitter
+            due += period
+            await asyncio.sleep(max(0, due + self.rnd.gauss(0, period * 0.02) - loop.time()))
+            device = self.rnd.choice(devices)
+            device.drift(self.rnd)
+            self.emit(self.frame('send', 'c', device.addr, self.wallpad, kocom.cmd_h_dic['query'], '0' * 16), faulty=False)
+            await self.reply('c', device.addr, self.wallpad, kocom.cmd_h_dic['query'], '0' * 16)
+
+    async def report(self):
+        started = time.time()
+        try:
+            while True:
+                await asyncio.sleep(self.args.stats_interval)
+                self.log_stats(started)
+        finally:
+            self.log_stats(started)
+
+    def log_stats(self, started):
+        logging.info('[SIM] {:.0f}s clients {} rx {rx} tx {tx} acks {acks} dropped {dropped} corrupted {corrupted} collisions {collisions}'.format(
+            time.time() - started, len(self.clients), **self.stats))
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        logging.info('[SIM] client connected {}'.format(peer))
+        self.clients.add(writer)
+        scanner = kocom.FrameScanner()
+        try:
+            while True:
+                data = await reader.read(kocom.READ_CHUNK_SIZE)
+                if not data:
+                    break
+                for frame in scanner.feed(data):
+                    p = kocom.Packet(frame)
+                    if self.args.verbose:
+                        logging.info('[SIM] recv {}'.format(p.hex))
+                    if self.args.collisions and self.frame_time:
+                        asyncio.ensure_future(self.arrive(p, writer))
+                    else:
+                        self.received(p, writer)
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+            logging.info('[SIM] client disconnected {}'.format(peer))
+
+
+async def serve(args):
+    bus = Bus(args)
+    server = await asyncio.start_server(bus.handle, args.host, args.port)
+    logging.info('[SIM] listening on {}:{} ({} rooms, chatter {}/s, ack delay {:.0f} ms, drop {}, corrupt {})'.format(
+        args.host, args.port, args.rooms, args.chatter, args.ack_delay * 1000, args.drop, args.corrupt))
+    async with server:
+        await asyncio.gather(server.serve_forever(), bus.writer(), bus.chatter(), bus.report())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Kocom wallpad / EW11 RS485 simulator')
+    parser.add_argument('--host', default='127.0.0.1', help='listen address')
+    parser.add_argument('--port', type=int, default=8899, help='listen port (EW11 default 8899)')
+    parser.add_argument('--baud', type=int, default=9600, help='bus speed used to space frames, 0 for no limit')
+    parser.add_argument('--rooms', type=int, default=4, help='thermostat and light rooms')
+    parser.add_argument('--ack-delay', type=float, default=0.05, help='mean device ACK delay in seconds')
+    parser.add_argument('--ack-jitter', type=float, default=0.01, help='standard deviation of the ACK delay')
+    parser.add_argument('--response-delay', type=float, default=0.05, help='delay between the ACK and the state report')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability of dropping a device reply')
+    parser.add_argument('--corrupt', type=float, default=0.0, help='probability of corrupting a device reply')
+    parser.add_argument('--collisions', action='store_true', help='lose client frames that overlap another frame on the bus')
+    parser.add_argument('--chatter', type=float, default=0.5, help='wallpad polls per second at a steady cadence, 0 to disable')
+    parser.add_argument('--elevator-from', type=int, default=20, help='floor the elevator starts from when called')
+    parser.add_argument('--elevator-floor', type=int, default=15, help='floor the elevator stops at')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    parser.add_argument('--stats-interval', type=float, default=10, help='seconds between stats lines')
+    parser.add_argument('--verbose', action='store_true', help='log every received frame')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s[%(asctime)s]:%(message)s ', level=logging.INFO)
+    kocom.load_json_config()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
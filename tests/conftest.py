@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""
+kocom.py 단위 테스트 공통 설정
+ - packets.json / protocol.json 을 읽고 kocom 모듈의 전역 상태(settings, state_store 등)를 테스트마다 새로 채움
+ - 버스 송신(send_wait_response)은 각 테스트가 필요한 만큼 가로챔
+"""
+
+import configparser
+import logging
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import kocom
+
+kocom.load_json_config()
+
+CONFIG = {
+    'Device': {
+        'enabled': 'light_livingroom, light_room1, thermo_livingroom, thermo_room1',
+        'light_controller': '0100',
+        'light_merge_window': '0',
+    },
+    'Log': {'show_query_hex': 'False', 'show_recv_hex': 'False'},
+}
+
+
+class PollStub:
+    """PollScheduler 대용 : refresh() 요청만 기록"""
+    def __init__(self):
+        self.refreshed = []
+
+    def refresh(self, device_h):
+        self.refreshed.append(device_h)
+
+
+class KeepaliveStub:
+    def extend(self, duration):
+        pass
+
+
+def frame(src_h, dest_h, cmd_h, value_h, type_h=None):
+    """payload 로 체크섬/헤더/트레일러를 붙인 21 바이트 프레임"""
+    payload = (type_h or kocom.type_h_dic['send']) + kocom.seq_h_dic[1] + '00' + dest_h + src_h + cmd_h + value_h
+    return bytes.fromhex(kocom.header_h + payload + kocom.chksum(payload) + kocom.trailer_h)
+
+
+@pytest.fixture
+def env(monkeypatch):
+    """설정과 런타임 객체를 새로 만든 kocom 모듈"""
+    config = configparser.ConfigParser()
+    config.read_dict(CONFIG)
+    monkeypatch.setattr(kocom, 'config', config, raising=False)
+    monkeypatch.setattr(kocom, 'settings', kocom.build_settings(config), raising=False)
+    monkeypatch.setattr(kocom, 'state_store', kocom.StateStore(kocom.polling_interval), raising=False)
+    monkeypatch.setattr(kocom, 'poll_scheduler', PollStub())
+    monkeypatch.setattr(kocom, 'batch_keepalive', KeepaliveStub(), raising=False)
+    monkeypatch.setattr(kocom, 'tracer', None)
+    monkeypatch.setattr(kocom, 'engine', None)
+    logging.getLogger().setLevel(logging.WARNING)
+    return kocom
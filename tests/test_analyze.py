@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""kocom_analyze : 캡처 파일 / hex 로그 분석"""
+
+import pytest
+
+import kocom_analyze
+from conftest import frame
+
+import kocom
+
+
+def query(ack=False):
+    """월패드 → 거실 조명 조회, ack=True 면 그 ACK"""
+    if ack:
+        return frame('0e00', '0100', '3a', '0' * 16, kocom.type_h_dic['ack'])
+    return frame('0100', '0e00', '3a', '0' * 16)
+
+
+def write_capture(path, sessions):
+    """sessions : [(wall clock, monotonic time, [(monotonic time, bytes), ...]), ...]"""
+    with open(path, 'wb') as f:
+        for i, (wall, mono, chunks) in enumerate(sessions):
+            if i == 0:
+                f.write(kocom.CAPTURE_MAGIC)
+            else:
+                f.write(kocom.CAPTURE_RECORD.pack(mono, kocom.CAPTURE_SESSION))
+            f.write(kocom.CAPTURE_HEADER.pack(wall, mono))
+            for t, data in chunks:
+                f.write(kocom.CAPTURE_RECORD.pack(t, len(data)) + data)
+
+
+def test_two_sessions(env, tmp_path):
+    path = str(tmp_path / 'bus.cap')
+    write_capture(path, [
+        # 첫 실행 : 조회 → ACK, 그리고 ACK 없이 끝난 조회
+        (1000.0, 50.0, [(50.1, query()), (50.12, query(ack=True)), (51.0, query())]),
+        # 재시작 : monotonic 시계가 처음부터 다시 시작, 직전 실행의 조회에 대한 ACK 로 보이는 프레임
+        (2000.0, 10.0, [(10.5, query(ack=True)), (11.0, query()), (11.03, query(ack=True))]),
+    ])
+    s = kocom_analyze.analyze_file(path)
+    assert s.frames == 6
+    assert (s.first, s.last) == pytest.approx((1000.0 + 0.1, 2000.0 + 1.03))
+    assert s.unacked == 1
+    assert sum(s.acks.counts) == 2
+    assert sum(s.gaps.counts) == 4          # 세션 사이의 간격은 세지 않음
+
+
+def test_hex_line_bytes(env):
+    assert kocom.hex_line_bytes('INFO[2026-10-18 12:03:27,281]:[recv] aa55 30bc ') == bytes.fromhex('aa5530bc')
+    assert kocom.hex_line_bytes('aa 55 30 bc\n') == bytes.fromhex('aa5530bc')
+    assert kocom.hex_line_bytes('INFO[2026-10-18 12:03:27,281]:[MQTT] queue depth 12') == b''   # 로그 본문의 숫자
+    assert kocom.hex_line_bytes('aa55 3 0bc') == b'\xaa\x55'      # 바이트 단위가 아닌 토큰은 버림
+
+
+def test_text_log(env, tmp_path):
+    path = tmp_path / 'kocom.log'
+    path.write_text('\n'.join([
+        'INFO[2026-10-18 12:03:27,281]:[recv] ' + query().hex(),
+        'INFO[2026-10-18 12:03:27,301]:[SEND|light] ' + query().hex(),     # 보낸 패킷은 버스 수신이 아님
+        'INFO[2026-10-18 12:03:27,320]:[recv] ' + query(ack=True).hex(),
+        ' '.join('{:02x}'.format(b) for b in query()),                    # hex 덤프
+        'INFO[2026-10-18 12:03:28,000]:[MQTT] publish queue depth 0 (high water 12)',
+    ]) + '\n')
+    s = kocom_analyze.analyze_file(str(path))
+    assert (s.frames, s.dropped, s.bytes) == (3, 0, 3 * kocom.packet_size)
+    assert s.first is None and sum(s.acks.counts) == 0       # 로그에는 타이밍 없음
+    assert s.types == {'send': 2, 'ack': 1}
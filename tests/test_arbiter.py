@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+"""BusArbiter : 수신 간격 학습과 재생(replay) 중의 송신"""
+
+import time
+
+import pytest
+
+from conftest import frame
+
+
+@pytest.fixture
+def arbiter(env, monkeypatch):
+    a = env.BusArbiter(env.protocol_config['timing'], True)
+    monkeypatch.setattr(env, 'bus_arbiter', a)
+    return a
+
+
+def test_frames_of_one_read_chunk_add_no_gap(env, arbiter):
+    query, ack = frame('0100', '0e00', '3a', '0' * 16), frame('0e00', '0100', '3a', '0' * 16, env.type_h_dic['ack'])
+    arbiter.received(100.0, query)
+    arbiter.received(100.0, ack)        # 같은 청크에서 읽힌 프레임
+    arbiter.received(100.0, None)
+    assert list(arbiter.gaps) == []
+    arbiter.received(100.03, query)
+    assert list(arbiter.gaps) == [pytest.approx(0.03)]
+
+
+def test_replay_write_waits_for_the_arbiter(env, arbiter, tmp_path):
+    replay = env.ReplayRS485(str(tmp_path / 'missing.cap'))
+    replay.conn = True
+    replay.last_read_time = time.time()
+    arbiter.received(time.time(), None)
+    started = time.time()
+    assert replay.write(frame('0100', '0e00', '3a', '0' * 16)) == env.packet_size
+    assert time.time() - started >= env.read_write_gap * 0.9
+    assert arbiter.writes == 1
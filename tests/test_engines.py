@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+"""
+두 엔진(thread / asyncio)의 종단 간 확인
+ - kocom_simulator.py (RS485 버스) 와 bench_startup.py 의 최소 브로커로 kocom.py 를 실행
+ - 기동 후 상태 publish, MQTT 명령 → 버스 → 상태 반영까지
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import bench_startup
+
+TIMEOUT = 20
+
+
+@pytest.fixture(scope='module')
+def broker():
+    return bench_startup.Broker()
+
+
+@pytest.fixture(params=['thread', 'asyncio'])
+def kocom_proc(request, broker, tmp_path):
+    rs485_port = bench_startup.free_port()
+    (tmp_path / 'kocom.conf').write_text(bench_startup.CONFIG.format(
+        rs485_port=rs485_port, engine=request.param, mqtt_port=broker.port, snapshot=tmp_path / 'state.json'))
+    broker.reset()
+    sim = bench_startup.start_simulator(rs485_port)
+    proc = subprocess.Popen([sys.executable, os.path.join(bench_startup.HERE, 'kocom.py')], cwd=str(tmp_path),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    yield proc
+    bench_startup.stop(proc)
+    bench_startup.stop(sim)
+
+
+def lights(check):
+    return lambda payload: check(json.loads(payload))
+
+
+def test_startup_and_light_command(broker, kocom_proc):
+    assert broker.wait('discovery', TIMEOUT) is not None
+    assert broker.wait('subscribe', TIMEOUT) is not None
+    state = broker.wait_topic('kocom/livingroom/light/state', lights(lambda s: True), TIMEOUT)
+    assert json.loads(state) == {'light_1': 'off', 'light_2': 'off', 'light_3': 'off'}     # 시뮬레이터 초기 상태
+
+    broker.publish('kocom/livingroom/light/1/command', 'on')
+    broker.publish('kocom/livingroom/light/3/command', 'on')
+    state = broker.wait_topic('kocom/livingroom/light/state', lights(lambda s: s['light_3'] == 'on'), TIMEOUT)
+    assert json.loads(state) == {'light_1': 'on', 'light_2': 'off', 'light_3': 'on'}
+
+    broker.publish('kocom/room/thermo/0/heat_mode/command', 'heat')
+    state = broker.wait_topic('kocom/room/thermo/0/state', lambda payload: json.loads(payload)['heat_mode'] == 'heat', TIMEOUT)
+    assert state is not None
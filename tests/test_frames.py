@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""FrameScanner : 잡음/손상 프레임 사이에서 aa55 헤더로 재동기화"""
+
+from conftest import frame
+
+import kocom
+
+A = frame('0100', '0e00', '3a', '0' * 16)
+B = frame('0e00', '0100', '00', 'ff00ff0000000000')
+
+
+def test_noise_and_split_frames(env):
+    s = kocom.FrameScanner()
+    assert s.feed(b'\x01\x02\x03' + A[:10]) == []
+    assert s.feed(A[10:] + B[:1]) == [A]
+    assert s.feed(B[1:] + b'\xaa') == [B]       # 끝의 헤더 일부는 다음 청크를 위해 남김
+    assert s.feed(b'\x55') == []
+    assert bytes(s.buf) == b'\xaa\x55'
+    assert (s.frames, s.dropped, s.invalid) == (2, 3, 0)
+
+
+def test_resync_inside_a_corrupt_frame(env):
+    s = kocom.FrameScanner()
+    broken = bytearray(A)
+    broken[12] ^= 0xff          # checksum 오류
+    # 손상된 프레임이 잘리고 그 안에서 다음 프레임이 시작하는 경우 : 중간의 헤더부터 다시 파싱
+    assert s.feed(bytes(broken[:8]) + B + A) == [B, A]
+    assert (s.invalid, s.bad_checksum, s.dropped) == (1, 1, 8)
+
+
+def test_bad_trailer(env):
+    s = kocom.FrameScanner()
+    assert s.feed(A[:-1] + b'\x00' + B) == [B]
+    assert (s.invalid, s.bad_trailer, s.bad_checksum) == (1, 1, 0)
+
+
+def test_byte_by_byte_matches_one_chunk(env):
+    stream = b'\x00\xaa' + A + b'\xaa\xaa\x55\x00' + B + b'\x0d\x0d' + A
+    whole = kocom.FrameScanner().feed(stream)
+    s = kocom.FrameScanner()
+    single = [f for i in range(len(stream)) for f in s.feed(stream[i:i + 1])]
+    assert single == whole == [A, B, A]
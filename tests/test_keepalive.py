@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+"""BatchOffKeepalive : 일괄소등 해제 패킷이 명령의 버스 사용을 막지 않는지"""
+
+import threading
+import time
+
+import pytest
+
+
+class BusyArbiter:
+    """busy_until 까지 버스가 사용 중이라고 답하는 BusArbiter 대용"""
+    def __init__(self, busy_until):
+        self.busy_until = busy_until
+
+    def delay(self, now, last_read_time, started):
+        return self.busy_until - now
+
+
+class Bus:
+    def __init__(self, arbiter):
+        self.arbiter = arbiter
+        self.last_read_time = time.time()
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append((time.time(), self.arbiter.delay(time.time(), self.last_read_time, time.time())))
+        return len(data)
+
+
+@pytest.fixture
+def keepalive(env, monkeypatch):
+    arbiter = BusyArbiter(time.time() + 0.3)
+    monkeypatch.setattr(env, 'bus_arbiter', arbiter)
+    monkeypatch.setattr(env, 'rs485', Bus(arbiter), raising=False)
+    monkeypatch.setattr(env, 'send_lock', threading.Lock(), raising=False)
+    k = env.BatchOffKeepalive()
+    k.end_time = time.time() + 0.7
+    return k
+
+
+def test_busy_bus_does_not_hold_the_send_lock(env, keepalive):
+    t = threading.Thread(target=keepalive.transmit, daemon=True)
+    t.start()
+    time.sleep(0.05)
+    started = time.time()
+    assert env.send_lock.acquire(timeout=1)      # send() 가 기다리는 동안 버스 대기
+    waited = time.time() - started
+    time.sleep(0.1)
+    env.send_lock.release()
+    t.join(2)
+    assert waited < 0.05
+    assert env.rs485.writes
+    assert all(delay <= 0 for _, delay in env.rs485.writes)     # 버스가 비었을 때만 전송
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""LightBatcher : 방 단위 조명 명령 병합과 명령 값을 만드는 기준 비트맵"""
+
+import json
+
+import pytest
+
+from conftest import frame
+
+
+class FakeLights:
+    """send_wait_response 대용 : 조명 컨트롤러 하나의 실제 비트맵을 들고 조회/상태 명령에 응답"""
+    def __init__(self, kocom, value, answer=True):
+        self.kocom = kocom
+        self.value = value
+        self.answer = answer
+        self.queries = 0
+        self.sent = []
+
+    def __call__(self, dest, src=None, cmd=None, value='0'*16, log=None, check_ack=True, publish=True):
+        k = self.kocom
+        if cmd == k.cmd_h_dic['query']:
+            self.queries += 1
+        else:
+            self.sent.append(value)
+            self.value = value
+        if not self.answer:
+            return k.empty_packet()
+        p = k.Packet(frame(dest, src or '0100', k.cmd_h_dic['state'], self.value))
+        k.state_store.update(dest, p)
+        return p
+
+
+@pytest.fixture
+def lights(env, monkeypatch):
+    bus = FakeLights(env, '0000ff0000000000')       # 버스 상태 : 3번 조명만 켜짐
+    monkeypatch.setattr(env, 'send_wait_response', bus)
+    return bus
+
+
+def restore(env, tmp_path, value):
+    path = tmp_path / 'state.json'
+    path.write_text(json.dumps({'0e00': [env.cmd_h_dic['state'], value, 1700000000]}))
+    snapshot = env.StateSnapshot(str(path), 10)
+    snapshot.restore(env.state_store)
+    return snapshot
+
+
+def test_restored_bitmap_is_read_from_the_bus_first(env, lights, tmp_path):
+    restore(env, tmp_path, '00ff000000000000')       # 스냅샷 : 2번 조명만 켜짐 (버스와 다름)
+    env.LightBatcher(0).add('0e00', {1: 'ff'})
+    assert lights.queries == 1
+    assert lights.sent == ['ff00ff0000000000']       # 2번은 그대로 꺼짐, 3번은 그대로 켜짐
+
+
+def test_expired_bitmap_is_read_from_the_bus_first(env, lights):
+    env.state_store.update('0e00', env.Packet(frame('0e00', '0100', '00', 'ffffff0000000000')))
+    env.state_store.expire()        # RS485 재접속
+    env.LightBatcher(0).add('0e00', {2: '00'})
+    assert lights.queries == 1
+    assert lights.sent == ['0000ff0000000000']
+
+
+def test_fresh_bitmap_is_used_without_a_query(env, lights):
+    env.state_store.update('0e00', env.Packet(frame('0e00', '0100', '00', '0000ff0000000000')))
+    env.LightBatcher(0).add('0e00', {1: 'ff'})
+    assert lights.queries == 0
+    assert lights.sent == ['ff00ff0000000000']
+    assert env.poll_scheduler.refreshed == []
+
+
+def test_silent_controller_falls_back_to_the_restored_bitmap(env, lights, tmp_path):
+    lights.answer = False
+    restore(env, tmp_path, '00ff000000000000')
+    env.LightBatcher(0).add('0e00', {1: 'ff'})
+    assert lights.sent == ['ffff000000000000']
+    assert env.poll_scheduler.refreshed == ['0e00']     # ACK 로 확인되지 않은 방은 폴러가 다시 읽음
+
+
+class Timers:
+    """threading.Timer 대용 : 시작된 flush 타이머만 기록"""
+    def __init__(self):
+        self.started = []
+
+    def __call__(self, interval, function, args=()):
+        self.started.append(args)
+        return self
+
+    def start(self):
+        pass
+
+
+def test_commands_within_the_window_are_merged(env, lights, monkeypatch):
+    timers = Timers()
+    monkeypatch.setattr(env.threading, 'Timer', timers)
+    env.state_store.update('0e00', env.Packet(frame('0e00', '0100', '00', '0000000000000000')))
+    batcher = env.LightBatcher(0.1)
+    batcher.add('0e00', {1: 'ff'})
+    batcher.add('0e00', {2: 'ff', 1: '00'})
+    batcher.add('0e00', {3: 'ff'})
+    batcher.pending['0e01'] = {1: 'ff'}
+    batcher.flush('0e00')
+    batcher.flush('0e00')       # 이미 보낸 방의 늦은 타이머는 아무것도 보내지 않음
+    assert timers.started == [('0e00',)]      # 방마다 첫 명령만 타이머를 시작
+    assert lights.sent == ['00ffff0000000000']
+    assert batcher.pending == {'0e01': {1: 'ff'}}
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""SIGHUP 설정 재적용 : reload_settings()"""
+
+import configparser
+
+from conftest import CONFIG
+
+
+def test_reload_applies_publish_and_light_settings(env, monkeypatch):
+    publisher = env.MqttPublisher(4, 'drop_oldest', 600)
+    batcher = env.LightBatcher(0.1)
+    monkeypatch.setattr(env, 'publisher', publisher)
+    monkeypatch.setattr(env, 'light_batcher', batcher)
+
+    reloaded = configparser.ConfigParser()
+    reloaded.read_dict(CONFIG)
+    reloaded.read_dict({
+        'MQTT': {'publish_queue_size': '2', 'publish_overflow': 'drop_new', 'state_refresh_interval': '0'},
+        'Device': {'light_merge_window': '0.5'},
+    })
+    monkeypatch.setattr(env, 'load_config', lambda: reloaded)
+    env.reload_settings()
+
+    assert env.settings.light_merge_window == 0.5
+    assert batcher.window == 0.5
+    assert (publisher.q.maxsize, publisher.overflow, publisher.refresh_interval) == (2, 'drop_new', 0)
+    assert publisher.q.qsize() == 1        # 이전 주기로 대기 중인 publisher 스레드를 깨우는 작업
+    assert publisher.submit(print, 'kept') is True
+    assert publisher.submit(print, 'dropped') is False      # 새 크기와 drop_new 적용
+    assert publisher.dropped == 1
+
+
+def test_failed_reload_keeps_settings(env, monkeypatch):
+    before = env.settings
+    broken = configparser.ConfigParser()
+    broken.read_dict(CONFIG)
+    broken.read_dict({'MQTT': {'publish_queue_size': 'many'}})
+    monkeypatch.setattr(env, 'load_config', lambda: broken)
+    env.reload_settings()
+    assert env.settings is before
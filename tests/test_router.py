@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""CommandRouter : discovery 의 명령 토픽 → 핸들러와 장치 주소"""
+
+import pytest
+
+import kocom
+
+
+class Client:
+    def __init__(self):
+        self.subscribed = []
+
+    def subscribe(self, topics):
+        self.subscribed += topics
+
+
+@pytest.fixture
+def router(env):
+    r = kocom.CommandRouter(kocom.COMMAND_PATTERNS)
+    for topic in ('kocom/room/thermo/1/set_temp/command',
+                  'kocom/room/thermo/1/heat_mode/command',
+                  'kocom/livingroom/light/1/command',
+                  'kocom/livingroom/light/2/command',
+                  'kocom/livingroom/fan/command',
+                  'kocom/myhome/query/command'):
+        r.add(topic)
+    return r
+
+
+def test_registered_topics(router):
+    assert router.resolve('kocom/room/thermo/1/set_temp/command') == (kocom.handle_thermo_set_temp, ('3601',))
+    assert router.resolve('kocom/room/thermo/1/heat_mode/command') == (kocom.handle_thermo_heat_mode, ('3601',))
+    assert router.resolve('kocom/livingroom/fan/command') == (kocom.handle_fan, ('4800',))
+    assert router.resolve('kocom/myhome/query/command') == (kocom.handle_query, ())
+
+
+def test_light_wildcard(router):
+    # 여러 조명을 한 번에 켜는 토픽은 등록되지 않았어도 방의 + 구독으로 받아 처음 쓸 때 해석
+    assert 'kocom/livingroom/light/12/command' not in router.routes
+    assert router.resolve('kocom/livingroom/light/12/command') == (kocom.handle_light, ('0e00', 'livingroom', '12', 3))
+    assert 'kocom/livingroom/light/12/command' in router.routes
+
+
+def test_unknown_topics(router):
+    assert router.resolve('kocom/room/thermo/2/set_temp/command') is None      # discovery 에 없는 장치
+    assert router.resolve('kocom/master/light/1/command') is None              # 구독하지 않은 방
+    router.add('kocom/attic/light/1/command')                                  # 모르는 방은 등록하지 않음
+    assert router.resolve('kocom/attic/light/1/command') is None
+
+
+def test_subscriptions(router):
+    client = Client()
+    router.subscribe(client)
+    assert client.subscribed == [(topic, 0) for topic in (
+        'kocom/room/thermo/1/set_temp/command',
+        'kocom/room/thermo/1/heat_mode/command',
+        'kocom/livingroom/light/+/command',
+        'kocom/livingroom/fan/command',
+        'kocom/myhome/query/command')]
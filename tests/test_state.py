@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""StateStore 만료/재확인과 StateSnapshot 복원"""
+
+import json
+import time
+
+from conftest import frame
+
+import kocom
+
+
+def light(value, age=0):
+    return kocom.Packet(frame('0e00', '0100', '00', value), time.time() - age)
+
+
+def test_expiry(env):
+    store = kocom.StateStore(300)
+    store.update('0e00', light('ff00000000000000', age=10))
+    assert store.get('0e00').value == 'ff00000000000000'
+    assert store.peek('0e00')[1] is False
+
+    store.update('0e00', light('ff00000000000000', age=301))        # ttl 이 지난 상태
+    assert store.get('0e00') is None
+    p, stale = store.peek('0e00')
+    assert p.value == 'ff00000000000000' and stale
+
+    store.invalidate('0e00')
+    assert store.peek('0e00') == (None, True)
+
+
+def test_expire_until_confirmed(env):
+    store = kocom.StateStore(300)
+    store.update('0e00', light('ff00000000000000'))
+    store.expire()          # RS485 재접속 : 상태는 남기되 버스가 다시 알려줄 때까지 확인되지 않음
+    assert store.get('0e00') is None
+    assert store.peek('0e00')[1]
+    store.update('0e00', light('00ff000000000000'))
+    assert store.get('0e00').value == '00ff000000000000'
+
+
+def test_snapshot_restore(env, tmp_path, monkeypatch):
+    path = tmp_path / 'state.json'
+    path.write_text(json.dumps({
+        '0e00': ['00', 'ff00000000000000', 1700000000],
+        '3600': ['00', '1100170000160000', 1700000100],
+        '0e01': ['00', 'ff', 1700000000],                   # 8 바이트가 아닌 값
+        '3601': ['ee', '1100170000160000', 1700000000],     # 알 수 없는 명령
+        '0e03': ['00', 'ff00000000000000', 1700000000],     # 사용하지 않는 장치
+        '2c00': ['00', '0000000000000000', 1700000000],     # 상태 장치가 아님
+    }))
+    store = kocom.StateStore(300)
+    snapshot = kocom.StateSnapshot(str(path), 10)
+    snapshot.restore(store)
+
+    assert sorted(snapshot.states) == ['0e00', '3600']
+    assert sorted(p.src_h for p in snapshot.restored) == ['0e00', '3600']
+    assert store.get('0e00') is None        # 복원된 상태는 버스가 확인할 때까지 stale
+    p, stale = store.peek('0e00')
+    assert (p.value, p.time, stale) == ('ff00000000000000', 1700000000, True)
+
+    published = []
+    monkeypatch.setattr(kocom, 'state_snapshot', snapshot)
+    monkeypatch.setattr(kocom, 'state_store', store)
+    monkeypatch.setattr(kocom, 'publish_status', published.append)
+    store.update('3600', kocom.Packet(frame('3600', '0100', '00', '1100180000170000')))
+    kocom.publish_restored()        # 버스가 이미 알려준 장치는 옛 상태를 publish 하지 않음
+    assert [p.src_h for p in published] == ['0e00']
+
+
+def test_unreadable_snapshot_is_ignored(env, tmp_path):
+    path = tmp_path / 'state.json'
+    path.write_text('{"0e00": [')
+    store = kocom.StateStore(300)
+    snapshot = kocom.StateSnapshot(str(path), 10)
+    snapshot.restore(store)
+    assert snapshot.restored == [] and store.states == {}